@@ -0,0 +1,328 @@
+# bench.py - микробенчмарки database.py, отрисовки кофе и рассылки ежедневного отчёта
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/traty_bench python bench.py
+#   python bench.py --sizes 1000,100000 --out results.json
+#   python bench.py --compare old.json new.json
+#
+# ⚠️ База из BENCH_DATABASE_URL перед каждым размером ОЧИЩАЕТСЯ и заполняется заново -
+# не указывайте рабочую базу.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timedelta, timezone, time as dt_time
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Окружение - до импорта модулей бота: они читают его при импорте
+BENCH_DATABASE_URL = os.environ.get("BENCH_DATABASE_URL")
+if BENCH_DATABASE_URL:
+    os.environ["DATABASE_URL"] = BENCH_DATABASE_URL
+os.environ.setdefault("BOT_TOKEN", "1000000001:bench")
+# Меряем запросы, а не кэш в памяти
+os.environ["STATS_CACHE_TTL"] = "0"
+# Рассылку меряем без лимитов Telegram: интересна скорость самого конвейера
+os.environ.setdefault("BROADCAST_RATE", "1000000")
+os.environ.setdefault("BROADCAST_BURST", "1000000")
+os.environ.setdefault("BROADCAST_PER_CHAT_INTERVAL", "0")
+SIZES = [1_000, 100_000, 10_000_000]
+ROWS_PER_USER = 100
+CATEGORIES = [
+    "Супермаркеты и продукты питания", "Рестораны и кафе", "Транспорт", "Онлайн-шопинг",
+    "Развлечения", "Связь и интернет", "Красота и уход", "Фитнес и здоровье",
+]
+SQL_SEED_RESET = '''
+    TRUNCATE expenses, daily_category_totals, users, coffee_file_ids, coffee_shares,
+             bot_user_data, bot_conversations
+    RESTART IDENTITY
+'''
+SQL_SEED_USERS = '''
+    INSERT INTO users (user_id, username, first_name)
+    SELECT g, 'bench' || g, 'Bench ' || g FROM generate_series(1, %(users)s) AS g
+'''
+# Траты случайно размазаны по пользователям и последним 365 дням (включая вчера)
+SQL_SEED_EXPENSES = '''
+    INSERT INTO expenses (user_id, amount, category, date)
+    SELECT 1 + floor(random() * %(users)s)::bigint,
+           round((50 + random() * 5000)::numeric, 2),
+           (%(categories)s::text[])[1 + floor(random() * %(n_categories)s)::int],
+           CURRENT_DATE - floor(random() * 365)::int
+    FROM generate_series(1, %(rows)s)
+'''
+def _summary(name, group, size, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    return {
+        'group': group,
+        'size': size,
+        'name': name,
+        'repeat': len(timings_ms),
+        'min_ms': round(timings_ms[0], 3),
+        'p50_ms': round(timings_ms[len(timings_ms) // 2], 3),
+        'p95_ms': round(timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))], 3),
+        'mean_ms': round(statistics.fmean(timings_ms), 3),
+    }
+def _print_row(row):
+    size = f"{row['size']:,}" if row['size'] else "-"
+    print(f"{row['group']:<7}{size:>12}  {row['name']:<44}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['min_ms']:>10.2f}")
+def measure(fn, repeat):
+    timings = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - t0)
+    return timings
+async def measure_async(fn, repeat):
+    timings = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        await fn(i)
+        timings.append(time.perf_counter() - t0)
+    return timings
+# ==================== БАЗА ДАННЫХ ====================
+def seed(rows: int) -> list:
+    """Пересоздаёт данные под размер rows; возвращает замеры самих фаз заполнения"""
+    import psycopg
+    from database import rebuild_daily_totals
+    users = max(10, rows // ROWS_PER_USER)
+    params = {'users': users, 'rows': rows, 'categories': CATEGORIES, 'n_categories': len(CATEGORIES)}
+    results = []
+    print(f"🌱 Заполняю: {rows:,} трат, {users:,} пользователей...", flush=True)
+    with psycopg.connect(BENCH_DATABASE_URL, autocommit=True) as conn:
+        conn.execute(SQL_SEED_RESET)
+        conn.execute('SELECT setseed(0.42)')
+        conn.execute(SQL_SEED_USERS, params)
+        t0 = time.perf_counter()
+        conn.execute(SQL_SEED_EXPENSES, params)
+        results.append(_summary('seed_expenses', 'seed', rows, [time.perf_counter() - t0]))
+    # Полная пересборка агрегата - заодно замер rebuild_daily_totals() по всей таблице
+    t0 = time.perf_counter()
+    rebuild_daily_totals()
+    results.append(_summary('rebuild_daily_totals[all]', 'db', rows, [time.perf_counter() - t0]))
+    with psycopg.connect(BENCH_DATABASE_URL, autocommit=True) as conn:
+        # Карта видимости для index-only scan и свежая статистика планировщика
+        conn.execute('VACUUM ANALYZE expenses')
+        conn.execute('VACUUM ANALYZE daily_category_totals')
+        conn.execute('VACUUM ANALYZE users')
+    return results
+def bench_db_sync(rows: int, repeat: int) -> list:
+    import database as db
+    users = max(10, rows // ROWS_PER_USER)
+    rnd = random.Random(1)
+    user = lambda: rnd.randint(1, users)
+    today = str(datetime.now().date())
+    cases = [
+        ('add_or_update_user', lambda i: (db.known_users.clear(), db.add_or_update_user(user(), f"u{i}", "Bench"))),
+        ('get_all_users', lambda i: db.get_all_users()),
+        ('save_expense', lambda i: db.save_expense(user(), 100 + i, "Транспорт", today)),
+        ('get_user_stats[days=1]', lambda i: db.get_user_stats(user(), 1)),
+        ('get_user_stats[days=30]', lambda i: db.get_user_stats(user(), 30)),
+        ('get_user_operations[limit=30]', lambda i: db.get_user_operations(user(), 30)),
+        ('get_expense_by_id', lambda i: db.get_expense_by_id(rnd.randint(1, rows))),
+        # Удаляем с конца диапазона id, чтобы не задевать то, что читают другие замеры
+        ('delete_expense', lambda i: db.delete_expense(rows - i)),
+        ('rebuild_daily_totals[user]', lambda i: db.rebuild_daily_totals(user())),
+    ]
+    results = []
+    for name, fn in cases:
+        # get_all_users на больших размерах тянет всех пользователей - хватит пары повторов
+        n = 3 if name == 'get_all_users' and rows > 100_000 else repeat
+        results.append(_summary(name, 'db', rows, measure(fn, n)))
+        _print_row(results[-1])
+    return results
+async def bench_db_async(rows: int, repeat: int) -> list:
+    import psycopg
+    import database as db
+    users = max(10, rows // ROWS_PER_USER)
+    rnd = random.Random(2)
+    user = lambda: rnd.randint(1, users)
+    today = str(datetime.now().date())
+    yesterday = datetime.now().date() - timedelta(days=1)
+    async def add_user(i):
+        db.known_users.clear()
+        await db.add_or_update_user_async(user(), f"a{i}", "Bench")
+    async def full_report(i):
+        async for _ in db.iter_daily_reports_async(yesterday):
+            pass
+    async def batch(i):
+        await db.save_expenses_batch_async([(user(), 100 + j, "Транспорт", today) for j in range(200)])
+    today_date = datetime.now().date()
+    # Свои траты для update_expense_async - с начала диапазона id, delete_expense* удаляют с конца
+    with psycopg.connect(BENCH_DATABASE_URL) as conn:
+        owned = conn.execute('SELECT id, user_id FROM expenses ORDER BY id LIMIT %s', (repeat,)).fetchall()
+    async def update_expense(i):
+        expense_id, user_id = owned[i % len(owned)]
+        await db.update_expense_async(user_id, expense_id, 100 + i, CATEGORIES[i % len(CATEGORIES)])
+    async def claim_reports(i):
+        # Цикл утренней рассылки без отправки: забрать пачку и закрыть её
+        reports = await db.claim_due_reports_async(100)
+        await db.finish_reports_async([(r['user_id'], r['day']) for r in reports], [])
+    async def persist(i):
+        user_data = {user(): os.urandom(256) for _ in range(50)}
+        conversations = {('bench', (u, u)): (u, None if i % 2 else b"state") for u in list(user_data)[:10]}
+        await db.save_persisted_batch_async(user_data, [], conversations)
+    cases = [
+        ('add_or_update_user_async', add_user),
+        ('get_all_users_async', lambda i: db.get_all_users_async()),
+        ('save_expense_async', lambda i: db.save_expense_async(user(), 100 + i, "Транспорт", today)),
+        ('save_expenses_batch_async[200]', batch),
+        ('get_user_stats_async[days=1]', lambda i: db.get_user_stats_async(user(), 1)),
+        ('get_user_stats_async[days=30]', lambda i: db.get_user_stats_async(user(), 30)),
+        ('get_user_operations_async[limit=30]', lambda i: db.get_user_operations_async(user(), 30)),
+        ('get_user_operations_page_async[first]', lambda i: db.get_user_operations_page_async(user(), 10)),
+        ('get_user_operations_page_async[before]', lambda i: db.get_user_operations_page_async(user(), 10, before=rnd.randint(1, rows))),
+        ('get_period_stats_async[30 days]', lambda i: db.get_period_stats_async(user(), today_date - timedelta(days=29), today_date)),
+        ('update_expense_async', update_expense),
+        ('get_expense_by_id_async', lambda i: db.get_expense_by_id_async(rnd.randint(1, rows))),
+        ('delete_expense_async', lambda i: db.delete_expense_async(rows - repeat - i)),
+        ('iter_daily_reports_async[all users]', full_report),
+        ('save_coffee_file_id_async', lambda i: db.save_coffee_file_id_async(f"bench:{i}", f"file-{i}")),
+        ('get_coffee_file_id_async', lambda i: db.get_coffee_file_id_async(f"bench:{i}")),
+        ('save_coffee_share_async', lambda i: db.save_coffee_share_async(user(), f"file-{i}", "bench")),
+        ('load_coffee_shares_async[1000]', lambda i: db.load_coffee_shares_async(3600, 1000)),
+        ('rebuild_daily_totals_async[user]', lambda i: db.rebuild_daily_totals_async(user())),
+        ('load_persisted_user_async', lambda i: db.load_persisted_user_async(user())),
+        ('save_persisted_batch_async[50 users]', persist),
+        ('update_user_schedule_async', lambda i: db.update_user_schedule_async(user(), report_time=dt_time(7 + i % 3))),
+        ('claim_due_reports_async[100]+finish', claim_reports),
+    ]
+    # Всем пора слать отчёт - иначе claim_due_reports_async меряет пустую выборку
+    with psycopg.connect(BENCH_DATABASE_URL, autocommit=True) as conn:
+        conn.execute('UPDATE users SET next_report_at = now() - interval \'1 minute\', report_lease_until = NULL')
+    results = []
+    await db.open_pool()
+    try:
+        for name, fn in cases:
+            heavy = name in ('get_all_users_async', 'iter_daily_reports_async[all users]')
+            n = 3 if heavy and rows > 100_000 else repeat
+            results.append(_summary(name, 'db', rows, await measure_async(fn, n)))
+            _print_row(results[-1])
+    finally:
+        await db.close_pool()
+    return results
+# ==================== ОТРИСОВКА ====================
+def bench_render(repeat: int) -> list:
+    import coffee_render
+    import coffee_index
+    coffee_render.load_templates()
+    template = sorted(coffee_render.get_templates())[0]
+    output = os.path.join(tempfile.mkdtemp(), "coffee_output.jpg")
+    cases = [
+        # bot.py: шаблоны в памяти, JPEG-байты без диска
+        ('coffee_render.generate_coffee_image', lambda i: coffee_render.generate_coffee_image("15.10", 10 + i, "👍", template=template)),
+        # coffee_index.py: читает шаблон с диска и пишет файл
+        ('coffee_index.generate_coffee_image', lambda i: coffee_index.generate_coffee_image("15.10", 10 + i, "👍", output_path=output)),
+    ]
+    results = []
+    for name, fn in cases:
+        fn(0)  # прогрев: шрифты, шаблоны
+        results.append(_summary(name, 'render', None, measure(fn, repeat)))
+        _print_row(results[-1])
+    return results
+# ==================== РАССЫЛКА ====================
+class _StubBot:
+    """Вместо Telegram: считает сообщения и (по желанию) имитирует задержку сети"""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+class _StubContext:
+    def __init__(self, bot):
+        self.bot = bot
+async def bench_report(rows: int, send_latency: float) -> list:
+    import database as db
+    from bot import send_daily_report
+    await db.open_pool()
+    try:
+        bot = _StubBot(send_latency)
+        t0 = time.perf_counter()
+        stats = await send_daily_report(_StubContext(bot))
+        elapsed = time.perf_counter() - t0
+    finally:
+        await db.close_pool()
+    row = _summary('send_daily_report', 'report', rows, [elapsed])
+    row.update(messages=bot.sent, failed=stats.failed, per_second=round(bot.sent / elapsed, 1) if elapsed else 0.0,
+               send_latency_ms=send_latency * 1000)
+    _print_row(row)
+    return [row]
+# ==================== ЗАПУСК ====================
+def _meta(args) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': args.sizes,
+        'repeat': args.repeat,
+        'only': args.only,
+    }
+def compare(old_path: str, new_path: str):
+    """Печатает изменение p50 между двумя прогонами"""
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return data['meta'], {(r['group'], r['size'], r['name']): r for r in data['results']}
+    old_meta, old = load(old_path)
+    new_meta, new = load(new_path)
+    print(f"p50: {old_meta.get('commit')} -> {new_meta.get('commit')}")
+    for key in sorted(old.keys() & new.keys(), key=lambda k: (k[0], k[1] or 0, k[2])):
+        before, after = old[key]['p50_ms'], new[key]['p50_ms']
+        change = (after - before) / before * 100 if before else 0.0
+        mark = "🔺" if change > 10 else "🔻" if change < -10 else "  "
+        size = f"{key[1]:,}" if key[1] else "-"
+        print(f"{mark} {key[0]:<7}{size:>12}  {key[2]:<44}{before:>10.2f}{after:>10.2f}{change:>+8.1f}%")
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота учёта трат")
+    parser.add_argument('--sizes', default=",".join(map(str, SIZES)), help="размеры expenses через запятую")
+    parser.add_argument('--repeat', type=int, default=30, help="повторов на замер")
+    parser.add_argument('--only', default="db,render,report", help="группы: db, render, report")
+    parser.add_argument('--send-latency', type=float, default=0, help="имитация задержки send_message, мс")
+    parser.add_argument('--out', default="bench_results.json", help="куда сохранить JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="сравнить два JSON и выйти")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    os.chdir(ROOT)  # coffee_index.py ищет шаблоны относительно текущей папки
+    # INFO-логи на каждую трату искажают замеры (basicConfig в bot.py после этого ничего не меняет)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    groups = set(args.only.split(','))
+    if groups & {'db', 'report'} and not BENCH_DATABASE_URL:
+        sys.exit("❌ Укажите BENCH_DATABASE_URL (отдельная база: она будет очищена)")
+
+    results = []
+    print(f"{'группа':<7}{'размер':>12}  {'замер':<44}{'p50, мс':>10}{'p95, мс':>10}{'min, мс':>10}")
+    if 'render' in groups:
+        results += bench_render(args.repeat)
+    if groups & {'db', 'report'}:
+        from migrations import run_migrations
+        run_migrations()
+        for rows in args.sizes:
+            seeded = seed(rows)
+            for row in seeded:
+                _print_row(row)
+            results += seeded
+            if 'db' in groups:
+                results += bench_db_sync(rows, args.repeat)
+                results += asyncio.run(bench_db_async(rows, args.repeat))
+            if 'report' in groups:
+                results += asyncio.run(bench_report(rows, args.send_latency / 1000))
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump({'meta': _meta(args), 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты: {args.out}")
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,67 @@
 import logging
 import asyncio
 import os
-from datetime import datetime, timedelta, time
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from datetime import datetime, timedelta, time, timezone
+from telegram import (
+    Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultCachedPhoto
+)
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
-    ConversationHandler, filters, ContextTypes, InlineQueryHandler
+    ConversationHandler, filters, ContextTypes, InlineQueryHandler, CallbackQueryHandler
 )
+from telegram.error import BadRequest
 from database import (
-    init_database, add_or_update_user, get_all_users,
-    save_expense, get_user_stats, get_user_operations,
-    delete_expense, get_expense_by_id
+    open_pool, close_pool, start_cache_listener, stop_cache_listener,
+    add_or_update_user_async, get_all_users_async,
+    get_user_stats_async, get_user_operations_page_async, get_period_stats_async,
+    delete_expense_async, update_expense_async, iter_daily_reports_async, rebuild_daily_totals_async,
+    claim_due_reports_async, finish_reports_async, get_user_schedule_async, find_timezone_async, update_user_schedule_async,
+    transaction, read_cache, known_users
 )
+from migrations import run_migrations
+from broadcast import broadcast, is_retryable
+from coffee_render import generate_coffee_image, load_templates, pick_coffee_template, calculate_coffee_index
+from coffee_cache import coffee_file_ids, coffee_cache_key
+from coffee_prerender import coffee_prerender, coffee_caption, PRERENDER_LEAD_MINUTES
+from share_store import share_store
+from render_pool import render_pool, RenderPoolBusy
+from expense_writer import expense_writer
+from pg_persistence import BOT_PERSISTENCE, PostgresPersistence, loader_handler
+import metrics
+from metrics import timed_handler
+from query_trace import QUERY_TRACE, SLOW_QUERY_MS, SLOW_QUERY_LOG, tracer
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("❌ Установите BOT_TOKEN в Railway Variables")
 TIMEZONE_OFFSET = int(os.environ.get("TIMEZONE_OFFSET", 3))
 ADMIN_ID = int(os.environ.get("ADMIN_ID", 37888528))
+# Bot API (можно направить на локальный сервер для офлайн-прогонов)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# polling - один процесс забирает апдейты сам; webhook - Telegram присылает их по HTTP
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", 8443)))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес, напр. https://bot.example.com
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+# Сколько операций на странице «📄 Операции» и в /fix
+OPERATIONS_PAGE_SIZE = int(os.environ.get("OPERATIONS_PAGE_SIZE", 10))
+FIX_PAGE_SIZE = 5
+# /range: самый длинный период и до какой длины показывать траты по дням
+STATS_RANGE_MAX_DAYS = 366
+STATS_DAILY_MAX_DAYS = 31
+# Утренние отчёты: раз в REPORT_TICK_SECONDS забираем тех, у кого по их часам
+# наступило время отчёта, не больше REPORT_BATCH_SIZE за раз (остальные - в следующий тик)
+REPORT_TICK_SECONDS = int(os.environ.get("REPORT_TICK_SECONDS", 60))
+REPORT_BATCH_SIZE = int(os.environ.get("REPORT_BATCH_SIZE", 1000))
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
-from PIL import Image, ImageDraw, ImageFont
-import random
-COFFEE_DIR = "coffee_templates"
-COFFEE_PRICE = 213
-def get_random_coffee_template():
-    if not os.path.exists(COFFEE_DIR):
-        raise FileNotFoundError(f"❌ Папка {COFFEE_DIR} не найдена!")
-    templates = [f for f in os.listdir(COFFEE_DIR) if f.lower().endswith(('.jpg', '.png', '.jpeg'))]
-    if not templates:
-        raise FileNotFoundError(f"❌ Нет картинок в папке {COFFEE_DIR}/")
-    return os.path.join(COFFEE_DIR, random.choice(templates))
-def get_coffee_emoji(cups: int) -> str:
-    if cups <= 10:
-        return "❤️"
-    elif cups <= 50:
-        return "👍"
-    elif cups <= 100:
-        return "🤯"
-    else:
-        return "😱"
-def calculate_coffee_index(amount: float) -> dict:
-    cups = round(amount / COFFEE_PRICE)
-    emoji = get_coffee_emoji(cups)
-    return {'cups': cups, 'emoji': emoji, 'amount': amount}
-    
-def generate_coffee_image(date: str, cups: int, emoji: str, output_path: str = "coffee_output.jpg") -> str:
-    try:
-        template_path = get_random_coffee_template()
-        logger.info(f"☕ Используется шаблон: {template_path}")
-        
-        img = Image.open(template_path).convert("RGB")
-        if img.size != (1000, 1000):
-            img = img.resize((1000, 1000), Image.Resampling.LANCZOS)
-        
-        draw = ImageDraw.Draw(img)
-        
-        # Текст одной строкой
-        text = f"Мои траты за {date} – это {cups} чашек кофе"
-        
-        # 👇 ШРИФТ ИЗ GIT-репозитория
-        font_path = os.path.join(os.path.dirname(__file__), "fonts", "Arial.ttf")
-        
-        font_size = 43
-        font = ImageFont.truetype(font_path, font_size)
-        logger.info(f"✅ Arial загружен из репозитория")
-        
-        # Позиция: СВЕРХУ (y=140)
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        x = (1000 - text_width) / 2
-        y = 140
-        
-        # Черный текст
-        draw.text((x, y), text, font=font, fill="black")
-        
-        img.save(output_path, quality=95)
-        logger.info(f"✅ Картинка готова: {output_path}")
-        
-        return output_path
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка: {e}")
-        logger.exception("Traceback:")
-        raise
-        
+RENDER_BUSY_TEXT = "⏳ Сейчас очень много желающих узнать свой индекс кофе. Попробуй через минутку!"
 AMOUNT, CATEGORY = range(2)
 FIX_SELECT, FIX_ACTION, FIX_AMOUNT, FIX_CATEGORY = range(2, 6)
 CATEGORIES = [
@@ -101,8 +76,13 @@ CATEGORIES = [
     ["📌 Другое"]
 ]
 def get_moscow_time():
-    from datetime import timezone
     return datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET)
+async def get_user_time(user_id: int) -> datetime:
+    """Текущее время в часовом поясе пользователя (МСК, если его ещё нет в БД)"""
+    schedule = await get_user_schedule_async(user_id)
+    if schedule is None:
+        return get_moscow_time()
+    return datetime.now(timezone.utc) + timedelta(seconds=schedule['utc_offset'])
 def format_date(dt=None):
     """Форматирует дату в ГГГГ-ММ-ДД для БД"""
     if dt is None:
@@ -117,38 +97,179 @@ def get_main_menu():
         ["☕ Индекс кофе"]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+def parse_utc_offset(text: str):
+    """+3, UTC+3, GMT-5 -> имя пояса Etc/GMT* (знак у них обратный); None, если это не смещение"""
+    value = text.upper()
+    for prefix in ("UTC", "GMT"):
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+    if len(value) < 2 or value[0] not in "+-" or not value[1:].isdigit():
+        return None
+    hours = int(value)
+    if not -12 <= hours <= 14:
+        return None
+    return f"Etc/GMT{-hours:+d}" if hours else "Etc/UTC"
+def format_schedule(schedule: dict) -> str:
+    """Пояс пользователя со смещением и время отчёта"""
+    hours, seconds = divmod(abs(schedule['utc_offset']), 3600)
+    offset = f"{'-' if schedule['utc_offset'] < 0 else '+'}{hours}" + (f":{seconds // 60:02d}" if seconds else "")
+    return (f"🕰️ Часовой пояс: {schedule['timezone']} (UTC{offset})\n"
+            f"📨 Отчёт за вчера приходит в {schedule['report_time']:%H:%M} по твоему времени")
+def parse_user_date(text: str, today):
+    """ДД.ММ.ГГГГ, ДД.ММ (текущий год) или ГГГГ-ММ-ДД"""
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    return datetime.strptime(f"{text}.{today.year}", "%d.%m.%Y").date()
+def format_period_stats(title: str, compare_label: str, stats: dict) -> str:
+    """Текст сводки за период: итог со сравнением, категории, траты по дням"""
+    start, end = stats['start'], stats['end']
+    dates = start.strftime('%d.%m') if start == end else f"{start.strftime('%d.%m')}–{end.strftime('%d.%m')}"
+    message = f"📊 {title} ({dates}):\n\n"
+    if not stats['has_data']:
+        message += "💰 Траты: 0 руб.\n\nЗа этот период трат нет."
+        if stats['prev_total']:
+            message += f"\n{compare_label.capitalize()}: {stats['prev_total']:.2f} руб."
+        return message
+    message += f"💰 Всего: {stats['total']:.2f} руб."
+    if stats['prev_total']:
+        change = (stats['total'] - stats['prev_total']) / stats['prev_total'] * 100
+        arrow = "📈" if change > 0 else "📉"
+        message += f"\n{arrow} {change:+.0f}% ({compare_label}: {stats['prev_total']:.2f} руб.)"
+    categories_text = "\n".join(
+        f"• {cat['category']}: {cat['total']:.2f} руб." + (f" (было {cat['prev_total']:.2f})" if cat['prev_total'] else "")
+        for cat in stats['categories'] if cat['total']
+    )
+    message += f"\n\n🏆 Категории:\n{categories_text}"
+    days = stats['days']
+    if 1 < len(days) <= STATS_DAILY_MAX_DAYS:
+        peak = max(day['total'] for day in days)
+        days_text = "\n".join(
+            " ".join(filter(None, (day['day'].strftime('%d.%m'), '▇' * round(day['total'] / peak * 10), f"{day['total']:.2f}")))
+            for day in days
+        )
+        message += f"\n\n📅 По дням:\n{days_text}"
+    return message
+async def reply_period_stats(update: Update, title: str, compare_label: str, start, end, prev_start=None, prev_end=None):
+    stats = await get_period_stats_async(update.effective_user.id, start, end, prev_start, prev_end)
+    await update.message.reply_text(format_period_stats(title, compare_label, stats))
+def build_operations_page(page: dict, prefix: str, numbered: bool = False):
+    """Строки страницы операций и инлайн-кнопки «новее / старее» (callback_data: prefix:a|b:id)"""
+    operations = page['operations']
+    lines = []
+    for idx, op in enumerate(operations, start=1):
+        line = f"{op['date']} | {op['category']} | {op['amount']:.2f} руб."
+        lines.append(f"{idx}. {line}" if numbered else f"• {line}")
+    buttons = []
+    if page['has_newer']:
+        buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"{prefix}:a:{operations[0]['id']}"))
+    if page['has_older']:
+        buttons.append(InlineKeyboardButton("Старее ➡️", callback_data=f"{prefix}:b:{operations[-1]['id']}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+async def load_operations_page(user_id: int, data: str, limit: int) -> dict:
+    """Страница по callback_data кнопки; если там уже пусто (траты удалили) - самая свежая"""
+    _, direction, cursor_id = data.split(":")
+    cursor = {'before': int(cursor_id)} if direction == "b" else {'after': int(cursor_id)}
+    page = await get_user_operations_page_async(user_id, limit=limit, **cursor)
+    if not page['operations']:
+        page = await get_user_operations_page_async(user_id, limit=limit)
+    return page
+async def edit_page_message(query, text: str, reply_markup):
+    """Перелистывание: меняем то же сообщение, а не шлём новое"""
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Двойное нажатие на ту же кнопку - текст не изменился
+        if "not modified" not in str(e):
+            raise
+def build_report_message(stats: dict):
+    """Текст утреннего отчёта и клавиатура к нему"""
+    first_name = stats['first_name']
+    if stats['has_data']:
+        top_categories = stats['categories'][:3]
+        categories_text = "\n".join(f"• {cat['category']}: {cat['total']:.2f} руб." for cat in top_categories)
+        message = (f"☀️ Доброе утро, {first_name}!\n\n"
+                  f"📊 Вчера ты потратил: {stats['total']:.2f} руб.\n\n"
+                  f"🏆 Топ категории:\n{categories_text}")
+        keyboard = [["☕ Индекс кофе"], ["🔙 Главное меню"]]
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    else:
+        message = (f"☀️ Доброе утро, {first_name}!\n\n"
+                  f"📊 Вчера у тебя не было трат.\n"
+                  f"Отличный день для экономии! 💪")
+        reply_markup = get_main_menu()
+    return message, reply_markup
+@timed_handler
 async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
-    users = get_all_users()
-    if not users:
+    yesterday = (get_moscow_time() - timedelta(days=1)).date()
+    if coffee_prerender.needs_catch_up(yesterday):
+        # Ночной прогон пропущен (рестарт, /testreport) - догоняем: уже загруженное берётся из кэша
+        await prerender_coffee_job(context)
+    logger.info(f"📨 Начинаю рассылку отчётов за {yesterday}")
+    async def jobs():
+        # Все пользователи и их топ категорий приходят одним потоковым запросом
+        async for stats in iter_daily_reports_async(yesterday):
+            coffee = coffee_prerender.get(stats['user_id'], yesterday, stats['total'])
+            yield stats['user_id'], (*build_report_message(stats), coffee)
+    stats = await broadcast(jobs(), report_sender(context.bot))
+    if not stats.total:
         logger.info("📭 Нет пользователей для отчёта")
-        return
-    logger.info(f"📨 Начинаю рассылку отчётов для {len(users)} пользователей")
-    for user in users:
-        user_id = user['user_id']
-        first_name = user['first_name']
-        stats = get_user_stats(user_id, days=1)
-        if stats['has_data']:
-            top_categories = stats['categories'][:3]
-            categories_text = "\n".join(f"• {cat['category']}: {cat['total']:.2f} руб." for cat in top_categories)
-            message = (f"☀️ Доброе утро, {first_name}!\n\n"
-                      f"📊 Вчера ты потратил: {stats['total']:.2f} руб.\n\n"
-                      f"🏆 Топ категории:\n{categories_text}")
-            keyboard = [["☕ Индекс кофе"], ["🔙 Главное меню"]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return stats
+@timed_handler
+async def send_due_reports(context: ContextTypes.DEFAULT_TYPE):
+    """Отчёты тем, у кого по их часовому поясу наступило время отчёта - каждому за его «вчера»"""
+    reports = await claim_due_reports_async(REPORT_BATCH_SIZE)
+    if not reports:
+        return None
+    yesterday = (get_moscow_time() - timedelta(days=1)).date()
+    reported_yesterday = [stats['user_id'] for stats in reports if stats['day'] == yesterday]
+    if reported_yesterday and coffee_prerender.needs_catch_up(yesterday, reported_yesterday):
+        # Ночной прогон пропущен (рестарт) или у кого-то из пачки день тогда ещё шёл (западные пояса) -
+        # догоняем перед пачкой; готовое берётся из кэша, не вышло - отчёты уйдут без картинок
+        await prerender_coffee_job(context)
+    logger.info(f"📨 Рассылка отчётов: {len(reports)} польз.")
+    async def jobs():
+        for stats in reports:
+            coffee = coffee_prerender.get(stats['user_id'], stats['day'], stats['total'])
+            yield stats['user_id'], (*build_report_message(stats), coffee)
+    # Дату следующего отчёта переносим только тем, кому отчёт ушёл (или повтор не поможет);
+    # остальных - и всех, до кого рассылка не дошла - возьмёт следующий тик
+    days = {stats['user_id']: stats['day'] for stats in reports}
+    sent = []
+    def on_result(chat_id, error):
+        if error is None or not is_retryable(error):
+            sent.append((chat_id, days.pop(chat_id)))
+    try:
+        return await broadcast(jobs(), report_sender(context.bot), on_result=on_result)
+    finally:
+        await finish_reports_async(sent, list(days.items()))
+def report_sender(bot):
+    async def send(chat_id, payload):
+        message, reply_markup, coffee = payload
+        if coffee:
+            # Картинка кофе уже загружена ночью - отправляем её file_id вместе с отчётом
+            await bot.send_photo(chat_id=chat_id, photo=coffee['file_id'], caption=message, reply_markup=reply_markup)
         else:
-            message = (f"☀️ Доброе утро, {first_name}!\n\n"
-                      f"📊 Вчера у тебя не было трат.\n"
-                      f"Отличный день для экономии! 💪")
-            reply_markup = get_main_menu()
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
-            logger.info(f"✅ Отчёт отправлен пользователю {user_id}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
-        await asyncio.sleep(0.5)
+            await bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup)
+    return send
+@timed_handler
+async def prerender_coffee_job(context: ContextTypes.DEFAULT_TYPE):
+    """Готовит картинки кофе за вчера до утреннего отчёта"""
+    if not coffee_prerender.enabled:
+        return None
+    yesterday = (get_moscow_time() - timedelta(days=1)).date()
+    try:
+        return await coffee_prerender.run(context.bot, yesterday)
+    except Exception as e:
+        logger.error(f"❌ Ошибка предотрисовки картинок кофе: {e}")
+        logger.exception("Traceback:")
+        return None
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_or_update_user(user_id=user.id, username=user.username, first_name=user.first_name)
+    await add_or_update_user_async(user_id=user.id, username=user.username, first_name=user.first_name)
     logger.info("=" * 50)
     logger.info("🔍 ПРОВЕРКА ФАЙЛОВОЙ СИСТЕМЫ:")
     logger.info(f"📂 Текущая директория: {os.getcwd()}")
@@ -163,26 +284,38 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("=" * 50)
     await update.message.reply_text(f"👋 Привет, {user.first_name}!\n\n💰 Я помогу тебе вести учёт трат.\nВыбери действие из меню ниже:", reply_markup=get_main_menu())
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "📖 Помощь по боту:\n\n"
         "📌 /start - главное меню\n"
         "📌 /stats - статистика за сегодня\n"
+        "📌 /today, /week, /month - траты за день, неделю, месяц со сравнением\n"
+        "📌 /range 01.10 15.10 - траты за любой период\n"
+        "📌 /timezone - часовой пояс (Europe/Moscow или +3)\n"
+        "📌 /reporttime 08:30 - время утреннего отчёта\n"
         "📌 /fix - исправить последние траты\n"
         "📌 /myid - показать ваш user_id\n"
         "📌 /testreport - тестовый отчёт (только админ)\n"
+        "📌 /renderstats - загрузка пула отрисовки (только админ)\n"
+        "📌 /rebuildtotals - пересчитать агрегаты статистики (только админ)\n"
+        "📌 /cachestats - статистика кэша (только админ)\n"
+        "📌 /slowqueries - самые тяжёлые запросы к БД (только админ)\n"
+        "📌 /prerender - подготовить картинки кофе за вчера (только админ)\n"
         "📌 /cancel - отменить операцию\n\n"
         "Как пользоваться:\n"
         "1️⃣ Нажми «💸 Добавить траты»\n"
         "2️⃣ Введи сумму (например: 350)\n"
         "3️⃣ Выбери категорию\n\n"
         "Ежедневные отчеты:\n"
-        "📨 Каждый день в 9:00 (МСК) бот пришлёт отчёт о вчерашних тратах"
+        "📨 Каждый день в 9:00 по твоему времени (меняется через /timezone и /reporttime) бот пришлёт отчёт о вчерашних тратах"
     )
+@timed_handler
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    stats = get_user_stats(user_id, days=0)
-    date_today = format_date()
+    now = await get_user_time(user_id)
+    stats = await get_user_stats_async(user_id, days=0, today=now.date())
+    date_today = format_date(now)
     if stats['has_data']:
         top_categories = stats['categories'][:3]
         categories_text = "\n".join(f"• {cat['category']}: {cat['total']:.2f} руб." for cat in top_categories)
@@ -190,26 +323,118 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         message = f"📊 Статистика за сегодня ({date_today}):\n\n💰 Общие траты: 0 руб.\n\nПока нет трат. Используй кнопку «💸 Добавить траты»"
     await update.message.reply_text(message)
+@timed_handler
+async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today = (await get_user_time(update.effective_user.id)).date()
+    await reply_period_stats(update, "Сегодня", "вчера", today, today)
+@timed_handler
+async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # С понедельника по сегодня; сравниваем с теми же днями прошлой недели
+    today = (await get_user_time(update.effective_user.id)).date()
+    start = today - timedelta(days=today.weekday())
+    week = timedelta(days=7)
+    await reply_period_stats(update, "Неделя", "прошлая неделя", start, today, start - week, today - week)
+@timed_handler
+async def month_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # С 1-го числа по сегодня; сравниваем с тем же числом дней прошлого месяца
+    today = (await get_user_time(update.effective_user.id)).date()
+    start = today.replace(day=1)
+    prev_start = (start - timedelta(days=1)).replace(day=1)
+    prev_end = min(prev_start + (today - start), start - timedelta(days=1))
+    await reply_period_stats(update, "Месяц", "прошлый месяц", start, today, prev_start, prev_end)
+@timed_handler
+async def range_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /range 01.10 15.10 или /range 01.10.2025 (по сегодня)
+    today = (await get_user_time(update.effective_user.id)).date()
+    try:
+        if not context.args or len(context.args) > 2:
+            raise ValueError("нужны одна или две даты")
+        start = parse_user_date(context.args[0], today)
+        end = parse_user_date(context.args[1], today) if len(context.args) > 1 else today
+        if start > end or (end - start).days >= STATS_RANGE_MAX_DAYS:
+            raise ValueError("неверный период")
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Использование: /range ДД.ММ[.ГГГГ] [ДД.ММ[.ГГГГ]]\n"
+            f"Например: /range 01.10 15.10 (не длиннее {STATS_RANGE_MAX_DAYS} дней)"
+        )
+        return
+    await reply_period_stats(update, "Период", "предыдущий такой же период", start, end)
+@timed_handler
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /timezone Asia/Yekaterinburg или /timezone +5
+    user = update.effective_user
+    if not context.args:
+        await add_or_update_user_async(user_id=user.id, username=user.username, first_name=user.first_name)
+        schedule = await get_user_schedule_async(user.id)
+        await update.message.reply_text(
+            f"{format_schedule(schedule)}\n\n"
+            "Изменить: /timezone Europe/Moscow или /timezone +3\n"
+            "Время отчёта: /reporttime 08:30"
+        )
+        return
+    zone = parse_utc_offset(context.args[0]) or await find_timezone_async(context.args[0])
+    if zone is None:
+        await update.message.reply_text(
+            "❌ Не знаю такого часового пояса.\n"
+            "Укажи название (Europe/Moscow, Asia/Novosibirsk) или смещение от UTC: /timezone +7"
+        )
+        return
+    # Профиль и новое расписание - одним соединением и одним COMMIT
+    async with transaction():
+        await add_or_update_user_async(user_id=user.id, username=user.username, first_name=user.first_name)
+        schedule = await update_user_schedule_async(user.id, timezone=zone)
+    now = await get_user_time(user.id)
+    await update.message.reply_text(f"✅ Готово! У тебя сейчас {now:%H:%M}.\n\n{format_schedule(schedule)}")
+@timed_handler
+async def report_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /reporttime 08:30
+    user = update.effective_user
+    try:
+        if len(context.args) != 1:
+            raise ValueError("нужно одно время")
+        report_time = datetime.strptime(context.args[0], "%H:%M").time()
+    except ValueError:
+        await update.message.reply_text("❌ Использование: /reporttime ЧЧ:ММ\nНапример: /reporttime 08:30")
+        return
+    async with transaction():
+        await add_or_update_user_async(user_id=user.id, username=user.username, first_name=user.first_name)
+        schedule = await update_user_schedule_async(user.id, report_time=report_time)
+    await update.message.reply_text(f"✅ Готово!\n\n{format_schedule(schedule)}")
+@timed_handler
 async def operations_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    operations = get_user_operations(user_id, limit=30)
-    if not operations:
+    page = await get_user_operations_page_async(user_id, limit=OPERATIONS_PAGE_SIZE)
+    if not page['operations']:
         await update.message.reply_text("📭 У вас пока нет операций.\nИспользуй кнопку «💸 Добавить траты» для начала учёта.", reply_markup=get_main_menu())
         return
-    message = "📋 Последние 30 операций:\n\n"
-    for op in operations:
-        message += f"• {op['date']} | {op['category']} | {op['amount']:.2f} руб.\n"
+    text, inline_keyboard = build_operations_page(page, "ops")
+    await update.message.reply_text(f"📋 Последние операции:\n\n{text}", reply_markup=inline_keyboard)
     keyboard = [["🔧 Редактировать"], ["🔙 Главное меню"]]
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+    await update.message.reply_text("Выбери действие:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+@timed_handler
+async def operations_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки «новее / старее» под списком операций"""
+    query = update.callback_query
+    page = await load_operations_page(query.from_user.id, query.data, OPERATIONS_PAGE_SIZE)
+    await query.answer()
+    if not page['operations']:
+        await edit_page_message(query, "📭 У вас пока нет операций.", None)
+        return
+    text, inline_keyboard = build_operations_page(page, "ops")
+    title = "📋 Более ранние операции:" if page['has_newer'] else "📋 Последние операции:"
+    await edit_page_message(query, f"{title}\n\n{text}", inline_keyboard)
 
+@timed_handler
 async def myid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await update.message.reply_text(f"📋 Ваш user_id: {user_id}")
+@timed_handler
 async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("❌ Эта команда только для админа")
         return
-    users = get_all_users()
+    users = await get_all_users_async()
     if not users:
         await update.message.reply_text("📭 Пользователей пока нет")
         return
@@ -218,21 +443,122 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         username = user['username'] or 'нет username'
         message += f"• {user['first_name']} (@{username}) - {user['user_id']}\n"
     await update.message.reply_text(message)
+@timed_handler
 async def test_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("❌ Эта команда только для админа")
         return
     await update.message.reply_text("🔄 Отправляю тестовый отчёт...\n(Все пользователи получат отчёт за вчера)")
     try:
-        await send_daily_report(context)
-        await update.message.reply_text("✅ Отчёт успешно отправлен!")
+        stats = await send_daily_report(context)
+        await update.message.reply_text(f"✅ Отчёт отправлен!\n\n📨 Доставлено: {stats.sent}\n❌ Ошибок: {stats.failed}\n⏳ 429: {stats.rate_limited}\n⏱️ {stats.elapsed:.1f} с ({stats.throughput:.1f} сообщ/с)")
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
         logger.error(f"Ошибка в test_report_command: {e}")
+@timed_handler
+async def render_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для админа")
+        return
+    stats = render_pool.stats()
+    await update.message.reply_text(
+        f"🎨 Пул отрисовки ({stats['mode']}):\n\n"
+        f"👷 Воркеров: {stats['workers']}, очередь до {stats['queue_size']}\n"
+        f"⚙️ В работе: {stats['in_flight']}, ждут: {stats['queue_depth']}\n"
+        f"✅ Готово: {stats['completed']}, ❌ ошибок: {stats['failed']}, 🚫 отказов: {stats['rejected']}\n"
+        f"⏱️ Отрисовка p50/p95: {stats['render_p50'] * 1000:.0f}/{stats['render_p95'] * 1000:.0f} мс\n"
+        f"⏳ Ожидание p50/p95: {stats['wait_p50'] * 1000:.0f}/{stats['wait_p95'] * 1000:.0f} мс\n"
+        f"🗂️ Кэш file_id (память): попаданий {coffee_file_ids.hits}, промахов {coffee_file_ids.misses}"
+    )
+@timed_handler
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для админа")
+        return
+    stats = read_cache.stats()
+    total = stats['hits'] + stats['misses'] + stats['collapsed']
+    hit_rate = stats['hits'] / total * 100 if total else 0
+    await update.message.reply_text(
+        f"🗄️ Кэш статистики и операций:\n\n"
+        f"👥 Пользователей в кэше: {stats['users']}\n"
+        f"✅ Попаданий: {stats['hits']} ({hit_rate:.0f}%)\n"
+        f"❌ Промахов: {stats['misses']}\n"
+        f"🔗 Схлопнуто одинаковых запросов: {stats['collapsed']}\n"
+        f"🧹 Сбросов после записи: {stats['invalidations']}\n\n"
+        f"🙋 Известных пользователей: {len(known_users)} "
+        f"(попаданий {known_users.hits}, промахов {known_users.misses})"
+    )
+@timed_handler
+async def prerender_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для админа")
+        return
+    if not coffee_prerender.enabled:
+        await update.message.reply_text("ℹ️ Предотрисовка выключена (задайте COFFEE_STORAGE_CHAT_ID)")
+        return
+    await update.message.reply_text("🎨 Готовлю картинки кофе за вчера...")
+    stats = await prerender_coffee_job(context)
+    if stats is None:
+        await update.message.reply_text("❌ Ошибка предотрисовки, подробности в логах")
+        return
+    await update.message.reply_text(
+        f"✅ Готово за {stats['elapsed']:.1f} с\n\n"
+        f"👥 Пользователей с тратами: {stats['users']}\n"
+        f"🖼️ Различных картинок: {stats['images']}, нарисовано сейчас: {stats['rendered']}\n"
+        f"📨 Готово к отчёту: {stats['ready']}"
+    )
+@timed_handler
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для админа")
+        return
+    if not QUERY_TRACE:
+        await update.message.reply_text("ℹ️ Трассировка запросов выключена (QUERY_TRACE=1)")
+        return
+    # /slowqueries - по суммарному времени, /slowqueries max|slow|count - по другому полю
+    order_by = context.args[0] if context.args else 'total'
+    if order_by not in ('total', 'max', 'slow', 'count'):
+        await update.message.reply_text("❌ Использование: /slowqueries [total|max|slow|count]")
+        return
+    top = tracer.top(10, order_by)
+    if not top:
+        await update.message.reply_text("📭 Запросов пока не было")
+        return
+    message = f"🐢 Тяжёлые запросы (порог {SLOW_QUERY_MS:.0f} мс, сортировка: {order_by}):\n\n"
+    for i, item in enumerate(top, 1):
+        message += (
+            f"{i}. {item['function'] or '?'} ← {item['handler'] or 'фон'}\n"
+            f"   {item['count']} раз, ср. {item['total'] / item['count'] * 1000:.1f} мс, "
+            f"max {item['max'] * 1000:.1f} мс, медленных {item['slow']}, "
+            f"строк ср. {item['rows'] / item['count']:.1f}\n"
+            f"   {item['query'][:120]}\n"
+        )
+    message += f"\n📝 Планы EXPLAIN: {SLOW_QUERY_LOG}"
+    await update.message.reply_text(message)
+@timed_handler
+async def rebuild_totals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для админа")
+        return
+    # /rebuildtotals - все пользователи, /rebuildtotals <user_id> - один
+    try:
+        user_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("❌ Использование: /rebuildtotals [user_id]")
+        return
+    await update.message.reply_text("🔁 Пересчитываю дневные агрегаты...")
+    try:
+        rows = await rebuild_daily_totals_async(user_id)
+        await update.message.reply_text(f"✅ Готово! Строк в агрегате: {rows}")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        logger.error(f"Ошибка в rebuild_totals_command: {e}")
+@timed_handler
 async def coffee_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("🧪 КОМАНДА /coffeetest ВЫЗВАНА!")
     user_id = update.effective_user.id
-    stats = get_user_stats(user_id, days=0)
+    now = await get_user_time(user_id)
+    stats = await get_user_stats_async(user_id, days=0, today=now.date())
     logger.info(f"📊 Статистика: {stats}")
     if not stats['has_data']:
         await update.message.reply_text("☕ Нет трат за сегодня! Добавь траты сначала.", reply_markup=get_main_menu())
@@ -240,25 +566,29 @@ async def coffee_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         coffee_data = calculate_coffee_index(stats['total'])
         await update.message.reply_text("⏳ Готовлю индекс кофе...")
-        today = datetime.now().strftime("%d.%m")
-        image_path = generate_coffee_image(date=today, cups=coffee_data['cups'], emoji=coffee_data['emoji'])
+        today = now.strftime("%d.%m")
+        image_bytes = await render_pool.submit(generate_coffee_image, date=today, cups=coffee_data['cups'], emoji=coffee_data['emoji'])
         share_button = InlineKeyboardButton("📤 Поделиться", switch_inline_query="Слежу за тратами в боте @tratyallday_bot и вот что он мне рассказал 😄")
         inline_keyboard = InlineKeyboardMarkup([[share_button]])
-        with open(image_path, 'rb') as photo:
-            await update.message.reply_photo(photo=photo, caption=f"☕ Твои траты за {today} = {coffee_data['cups']} чашек кофе {coffee_data['emoji']}", reply_markup=inline_keyboard)
+        caption = f"☕ Твои траты за {today} = {coffee_data['cups']} чашек кофе {coffee_data['emoji']}"
+        message = await update.message.reply_photo(photo=image_bytes, caption=caption, reply_markup=inline_keyboard)
+        await share_store.set(user_id, message.photo[-1].file_id, caption)
         await update.message.reply_text("Выбери действие:", reply_markup=get_main_menu())
-        os.remove(image_path)
         logger.info("✅ Тестовый индекс кофе отправлен")
+    except RenderPoolBusy:
+        await update.message.reply_text(RENDER_BUSY_TEXT, reply_markup=get_main_menu())
     except Exception as e:
         logger.error(f"❌ Ошибка генерации индекса кофе: {e}")
         logger.exception("Traceback:")
         await update.message.reply_text(f"❌ Ошибка: {str(e)}", reply_markup=get_main_menu())
 
+@timed_handler
 async def begin_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_or_update_user(user_id=user.id, username=user.username, first_name=user.first_name)
+    await add_or_update_user_async(user_id=user.id, username=user.username, first_name=user.first_name)
     await update.message.reply_text("💰 Введи сумму траты (только число, например: 1200):", reply_markup=ReplyKeyboardRemove())
     return AMOUNT
+@timed_handler
 async def get_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     try:
@@ -271,27 +601,45 @@ async def get_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Неверный формат! Введи число (например: 500 или 75.50):", reply_markup=ReplyKeyboardRemove())
         return AMOUNT
+@timed_handler
 async def get_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     category = update.message.text
     amount = context.user_data.get('amount', 0)
     user_id = update.effective_user.id
-    date_today = format_date()
+    date_today = format_date(await get_user_time(user_id))
     clean_cat = clean_category(category)
-    success = save_expense(user_id=user_id, amount=amount, category=clean_cat, date=date_today)
+    success = await expense_writer.save(user_id=user_id, amount=amount, category=clean_cat, date=date_today)
     if success:
         await update.message.reply_text(f"✅ Запись добавлена!\n\n📅 Дата: {date_today}\n💸 Сумма: {amount:.2f} руб.\n📂 Категория: {clean_cat}", reply_markup=get_main_menu())
     else:
         await update.message.reply_text("❌ Ошибка при сохранении! Попробуй еще раз.", reply_markup=get_main_menu())
     context.user_data.clear()
     return ConversationHandler.END
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Операция отменена.", reply_markup=get_main_menu())
     context.user_data.clear()
     return ConversationHandler.END
+@timed_handler
 async def coffee_index_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 'Индекс кофе'"""
     user_id = update.effective_user.id
-    stats = get_user_stats(user_id, days=1)
+    now = await get_user_time(user_id)
+    day = (now - timedelta(days=1)).date()
+    # Сумма ровно за вчера - по ней же считала чашки предотрисовка
+    stats = await get_period_stats_async(user_id, day, day)
+    # После утреннего отчёта картинка обычно уже готова - если с тех пор сумма не поменялась
+    prerendered = coffee_prerender.get(user_id, day, stats['total'])
+    if prerendered:
+        share_button = InlineKeyboardButton("📤 Поделиться", switch_inline_query="")
+        await update.message.reply_photo(
+            photo=prerendered['file_id'],
+            caption=prerendered['caption'],
+            reply_markup=InlineKeyboardMarkup([[share_button]])
+        )
+        await share_store.set(user_id, prerendered['file_id'], prerendered['caption'])
+        await update.message.reply_text("Выбери действие:", reply_markup=get_main_menu())
+        return ConversationHandler.END
 
     if not stats['has_data']:
         await update.message.reply_text(
@@ -302,32 +650,9 @@ async def coffee_index_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     try:
         coffee_data = calculate_coffee_index(stats['total'])
-        yesterday = (datetime.now() - timedelta(days=1)).strftime("%d.%m")
-
-        # Генерируем картинку
-        image_path = generate_coffee_image(
-            date=yesterday,
-            cups=coffee_data['cups'],
-            emoji=coffee_data['emoji']
-        )
+        yesterday = (now - timedelta(days=1)).strftime("%d.%m")
 
-        # 👇 БЛОК ДЛЯ КАНАЛА (получение file_id)
-        CHANNEL_ID = -1003897413238  # ID МОЕГО ПРИВАТНОГО ТЕХНИЧЕСКОГО КАНАЛА
-        
-        # Открываем файл и отправляем в канал
-        with open(image_path, 'rb') as photo:
-            channel_message = await context.bot.send_photo(
-                chat_id=CHANNEL_ID,
-                photo=photo
-            )
-        
-        # Получаем file_id (последняя версия фото — самая большая)
-        photo_file_id = channel_message.photo[-1].file_id
-        logger.info(f"✅ Получен file_id для канала: {photo_file_id}")
-        
-        # Можно сохранить в context.bot_data или в БД
-        context.bot_data['coffee_file_id'] = photo_file_id
-        # 👆 КОНЕЦ БЛОКА
+        caption = coffee_caption(yesterday, coffee_data['cups'], coffee_data['emoji'])
 
         # Кнопка для инлайн-шеринга (используем file_id)
         share_button = InlineKeyboardButton(
@@ -336,22 +661,39 @@ async def coffee_index_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         inline_keyboard = InlineKeyboardMarkup([[share_button]])
 
-        # Отправляем пользователю
-        with open(image_path, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption=f"☕ Твои траты за {yesterday} = {coffee_data['cups']} чашек кофе {coffee_data['emoji']}",
-                reply_markup=inline_keyboard
-            )
+        # Картинка зависит только от (шаблон, дата, чашки) - одинаковые не рисуем и не грузим повторно
+        template = pick_coffee_template(yesterday, coffee_data['cups'])
+        cache_key = coffee_cache_key(template, yesterday, coffee_data['cups'])
+        async with coffee_file_ids.lock(cache_key):
+            photo_file_id = await coffee_file_ids.get(cache_key)
+            if photo_file_id:
+                # Попадание: отправляем по file_id, без отрисовки и загрузки
+                await update.message.reply_photo(photo=photo_file_id, caption=caption, reply_markup=inline_keyboard)
+            else:
+                # Промах: рисуем в пуле воркеров и загружаем один раз - сразу пользователю
+                image_bytes = await render_pool.submit(
+                    generate_coffee_image,
+                    date=yesterday,
+                    cups=coffee_data['cups'],
+                    emoji=coffee_data['emoji'],
+                    template=template
+                )
+                message = await update.message.reply_photo(photo=image_bytes, caption=caption, reply_markup=inline_keyboard)
+                # Получаем file_id (последняя версия фото — самая большая)
+                photo_file_id = message.photo[-1].file_id
+                await coffee_file_ids.put(cache_key, photo_file_id)
+                logger.info(f"✅ Получен file_id для {cache_key}: {photo_file_id}")
+
+        # Картинка именно этого пользователя для кнопки «Поделиться»
+        await share_store.set(user_id, photo_file_id, caption)
 
         await update.message.reply_text(
             "Выбери действие:",
             reply_markup=get_main_menu()
         )
 
-        # Удаляем временный файл
-        os.remove(image_path)
-
+    except RenderPoolBusy:
+        await update.message.reply_text(RENDER_BUSY_TEXT, reply_markup=get_main_menu())
     except Exception as e:
         logger.error(f"❌ Ошибка генерации индекса кофе: {e}")
         await update.message.reply_text(
@@ -363,52 +705,78 @@ async def coffee_index_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # ==================== INLINE-ОБРАБОТЧИК ====================
 
+@timed_handler
 async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик инлайн-запросов (когда жмут Поделиться)"""
-    query = update.inline_query.query
     user_id = update.effective_user.id
     
     try:
-        photo_file_id = context.bot_data.get('coffee_file_id')
+        # Только память: ни БД, ни отрисовки на нажатие «Поделиться»
+        share = share_store.get(user_id)
         
-        if not photo_file_id:
-            await update.inline_query.answer([], cache_time=60)
+        if not share:
+            await update.inline_query.answer([], cache_time=10, is_personal=True)
             return
         
         result = InlineQueryResultCachedPhoto(
-            id="1",
-            photo_file_id=photo_file_id,
+            id="coffee",
+            photo_file_id=share['file_id'],
             title="Мой индекс кофе ☕",
-            description="Нажми, чтобы поделиться картинкой с друзьями"
+            description="Нажми, чтобы поделиться картинкой с друзьями",
+            caption=share['caption']
         )
         
         results = [result]
-        await update.inline_query.answer(results, cache_time=10)
+        # is_personal: Telegram кэширует ответ отдельно для каждого пользователя
+        await update.inline_query.answer(results, cache_time=30, is_personal=True)
         logger.info(f"✅ Inline-запрос обработан для пользователя {user_id}")
         
     except Exception as e:
         logger.error(f"❌ Ошибка inline-запроса: {e}")
         logger.exception("Traceback:")
-        await update.inline_query.answer([], cache_time=0)
+        await update.inline_query.answer([], cache_time=0, is_personal=True)
         
+def build_fix_message(page: dict):
+    text, inline_keyboard = build_operations_page(page, "fix", numbered=True)
+    title = "🔧 Более ранние траты:" if page['has_newer'] else "🔧 Последние траты:"
+    return f"{title}\n\n{text}\n\n💬 Введи номер траты (1-{len(page['operations'])}):", inline_keyboard
+@timed_handler
 async def fix_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    operations = get_user_operations(user_id, limit=5)
-    if not operations:
+    page = await get_user_operations_page_async(user_id, limit=FIX_PAGE_SIZE)
+    if not page['operations']:
         await update.message.reply_text("📭 У тебя пока нет трат для исправления.\nИспользуй кнопку «💸 Добавить траты» для начала учёта.", reply_markup=get_main_menu())
         return ConversationHandler.END
-    context.user_data['fix_operations'] = operations
-    message = "🔧 Последние 5 трат:\n\n"
-    for idx, op in enumerate(operations, start=1):
-        message += f"{idx}. {op['date']} | {op['category']} | {op['amount']:.2f} руб.\n"
-    message += "\n💬 Введи номер траты (1-5):"
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    context.user_data['fix_operations'] = page['operations']
+    message, inline_keyboard = build_fix_message(page)
+    if inline_keyboard is None:
+        await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    else:
+        # У сообщения одна клавиатура: меню убираем отдельным, список идёт с кнопками листания
+        await update.message.reply_text("🔧 Выбор траты для исправления", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(message, reply_markup=inline_keyboard)
     return FIX_SELECT
+@timed_handler
+async def fix_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листает список /fix; номер траты дальше вводится как обычно, уже по текущей странице"""
+    query = update.callback_query
+    if 'fix_operations' not in context.user_data:
+        # Диалог /fix уже закончен - старые кнопки ничего не делают
+        await query.answer("Список устарел, начни заново: /fix")
+        return
+    page = await load_operations_page(query.from_user.id, query.data, FIX_PAGE_SIZE)
+    await query.answer()
+    if not page['operations']:
+        return
+    context.user_data['fix_operations'] = page['operations']
+    message, inline_keyboard = build_fix_message(page)
+    await edit_page_message(query, message, inline_keyboard)
+@timed_handler
 async def fix_select_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
+    operations = context.user_data.get('fix_operations', [])
     try:
         number = int(text)
-        operations = context.user_data.get('fix_operations', [])
         if number < 1 or number > len(operations):
             raise ValueError("Неверный номер")
         selected = operations[number - 1]
@@ -417,8 +785,9 @@ async def fix_select_expense(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(f"✅ Выбрана трата:\n\n📅 {selected['date']}\n📂 {selected['category']}\n💸 {selected['amount']:.2f} руб.\n\nЧто делаем?", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
         return FIX_ACTION
     except (ValueError, IndexError):
-        await update.message.reply_text("❌ Неверный номер! Введи число от 1 до 5:", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(f"❌ Неверный номер! Введи число от 1 до {len(operations)}:", reply_markup=ReplyKeyboardRemove())
         return FIX_SELECT
+@timed_handler
 async def fix_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = update.message.text
     if action == "❌ Отмена":
@@ -431,7 +800,7 @@ async def fix_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("❌ Ошибка! Трата не найдена.", reply_markup=get_main_menu())
             context.user_data.clear()
             return ConversationHandler.END
-        success = delete_expense(selected['id'])
+        success = await delete_expense_async(selected['id'])
         if success:
             await update.message.reply_text(f"✅ Трата удалена!\n\n📅 {selected['date']}\n📂 {selected['category']}\n💸 {selected['amount']:.2f} руб.", reply_markup=get_main_menu())
         else:
@@ -445,6 +814,7 @@ async def fix_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         keyboard = [["🔄 Перезаписать"], ["🗑️ Удалить"], ["❌ Отмена"]]
         await update.message.reply_text("❌ Используй кнопки для выбора действия:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
         return FIX_ACTION
+@timed_handler
 async def fix_get_new_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     try:
@@ -457,6 +827,7 @@ async def fix_get_new_amount(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await update.message.reply_text("❌ Неверный формат! Введи число (например: 500 или 75.50):", reply_markup=ReplyKeyboardRemove())
         return FIX_AMOUNT
+@timed_handler
 async def fix_get_new_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     category = update.message.text
     new_amount = context.user_data.get('new_amount', 0)
@@ -467,16 +838,16 @@ async def fix_get_new_category(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data.clear()
         return ConversationHandler.END
     clean_cat = clean_category(category)
-    delete_expense(selected['id'])
-    date_today = format_date()
-    success = save_expense(user_id=user_id, amount=new_amount, category=clean_cat, date=date_today)
-    if success:
-        await update.message.reply_text(f"✅ Готово! Запись обновлена:\n\n📅 Дата: {date_today}\n💸 Сумма: {new_amount:.2f} руб.\n📂 Категория: {clean_cat}", reply_markup=get_main_menu())
+    # Одним запросом: та же запись (id и дата) с новой суммой и категорией
+    updated = await update_expense_async(user_id, selected['id'], new_amount, clean_cat)
+    if updated:
+        await update.message.reply_text(f"✅ Готово! Запись обновлена:\n\n📅 Дата: {format_date(updated['date'])}\n💸 Сумма: {new_amount:.2f} руб.\n📂 Категория: {clean_cat}", reply_markup=get_main_menu())
     else:
         await update.message.reply_text("❌ Ошибка при обновлении! Попробуй позже.", reply_markup=get_main_menu())
     context.user_data.clear()
     return ConversationHandler.END
 
+@timed_handler
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if text == "💸 Добавить траты":
@@ -495,19 +866,68 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("❌ Неизвестная команда. Используй кнопки меню.", reply_markup=get_main_menu())
         return ConversationHandler.END
+async def on_startup(application: Application):
+    """Открывает пул соединений с БД и пул отрисовки до начала обработки апдейтов"""
+    await open_pool()
+    # Записи других реплик сбрасывают кэш чтений через NOTIFY
+    await start_cache_listener()
+    await share_store.load()
+    render_pool.start()
+    expense_writer.start()
+async def on_shutdown(application: Application):
+    """Закрывает пулы при остановке бота"""
+    # Сначала дописываем очередь трат, пока пул соединений ещё открыт
+    await expense_writer.stop()
+    await asyncio.to_thread(render_pool.shutdown)
+    await coffee_prerender.shutdown()
+    await stop_cache_listener()
+    await close_pool()
 def main():
-    init_database()
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Схема меняется только через миграции; если версия актуальна, DDL не выполняется
+    run_migrations()
+    # Шаблоны кофе декодируются один раз, а не на каждый запрос
+    load_templates()
+    # /metrics для Prometheus, если задан METRICS_PORT
+    metrics.start_server()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    # Незаконченные диалоги и user_data в Postgres: переживают рестарт и делятся между репликами
+    persistence = PostgresPersistence() if BOT_PERSISTENCE else None
+    if persistence:
+        builder = builder.persistence(persistence)
+    application = builder.build()
     job_queue = application.job_queue
-    job_queue.run_daily(send_daily_report, time=time(hour=(9 - TIMEZONE_OFFSET) % 24, minute=0))
+    # Отчёты идут пачками по часовым поясам и времени, выбранному пользователями (/timezone, /reporttime)
+    job_queue.run_repeating(send_due_reports, interval=REPORT_TICK_SECONDS, first=10)
+    # Картинки кофе готовим к 9:00 МСК - времени отчёта по умолчанию
+    report_time = time(hour=(9 - TIMEZONE_OFFSET) % 24, minute=0)
+    if coffee_prerender.enabled:
+        prerender_at = datetime.combine(datetime.now().date(), report_time) - timedelta(minutes=PRERENDER_LEAD_MINUTES)
+        job_queue.run_daily(prerender_coffee_job, time=prerender_at.time())
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("today", today_command))
+    application.add_handler(CommandHandler("week", week_command))
+    application.add_handler(CommandHandler("month", month_command))
+    application.add_handler(CommandHandler("range", range_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("reporttime", report_time_command))
     application.add_handler(CommandHandler("myid", myid_command))
     application.add_handler(CommandHandler("users", users_command))
     application.add_handler(CommandHandler("testreport", test_report_command))
     application.add_handler(CommandHandler("coffeetest", coffee_test_command))
+    application.add_handler(CommandHandler("renderstats", render_stats_command))
+    application.add_handler(CommandHandler("rebuildtotals", rebuild_totals_command))
+    application.add_handler(CommandHandler("cachestats", cache_stats_command))
+    application.add_handler(CommandHandler("slowqueries", slow_queries_command))
+    application.add_handler(CommandHandler("prerender", prerender_command))
     
     conv_handler_expense = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^💸 Добавить траты$"), begin_expense)],
@@ -516,6 +936,8 @@ def main():
             CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_category)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name="expense",
+        persistent=BOT_PERSISTENCE,
     )
     
     conv_handler_fix = ConversationHandler(
@@ -530,12 +952,20 @@ def main():
             FIX_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, fix_get_new_category)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name="fix",
+        persistent=BOT_PERSISTENCE,
     )
     
+    if persistence:
+        # Пользователь подгружается из БД до того, как диалоги проверят своё состояние
+        persistence.track_conversations(conv_handler_expense, conv_handler_fix)
+        application.add_handler(loader_handler(), group=-1)
     application.add_handler(conv_handler_expense)
     application.add_handler(conv_handler_fix)
     application.add_handler(MessageHandler(filters.Regex("^(📈 Статистика|📄 Операции|☕ Индекс кофе|🔙 Главное меню)$"), menu_handler))
     application.add_handler(InlineQueryHandler(inline_query_handler))
+    application.add_handler(CallbackQueryHandler(operations_page_callback, pattern=r"^ops:[ab]:\d+$"))
+    application.add_handler(CallbackQueryHandler(fix_page_callback, pattern=r"^fix:[ab]:\d+$"))
 
     logger.info("=" * 50)
     logger.info("🤖 Бот учета трат запущен! v2.1 COFFEE UPDATE")
@@ -543,8 +973,24 @@ def main():
     logger.info("💾 База данных: PostgreSQL")
     logger.info("🔧 Доступна команда /fix для исправления трат")
     logger.info("☕ Доступна функция 'Индекс кофе'")
+    logger.info(f"📡 Режим получения апдейтов: {BOT_MODE}")
     logger.info("=" * 50)
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # При SIGTERM/SIGINT оба режима сначала перестают принимать апдейты,
+    # затем дорабатывают уже принятые и только потом вызывают on_shutdown
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("❌ Для BOT_MODE=webhook установите WEBHOOK_URL")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 if __name__ == '__main__':
     main()
@@ -0,0 +1,223 @@
+# broadcast.py - массовая рассылка с учётом лимитов Telegram
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import timedelta
+from collections import Counter
+from dataclasses import dataclass, field
+from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError, TimedOut
+import metrics
+logger = logging.getLogger(__name__)
+# Telegram: не больше ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+BROADCAST_BURST = int(os.environ.get("BROADCAST_BURST", 5))
+BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get("BROADCAST_PER_CHAT_INTERVAL", 1.0))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 20))
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", 3))
+# Всего попыток на сообщение, включая повторы после 429 (те в max_retries не входят)
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get("BROADCAST_MAX_ATTEMPTS", 10))
+BROADCAST_BACKOFF = float(os.environ.get("BROADCAST_BACKOFF", 1.0))  # базовая пауза перед повтором, сек
+def _seconds(value) -> float:
+    """retry_after в секундах (PTB отдаёт int или timedelta в зависимости от версии)"""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+def is_retryable(error) -> bool:
+    """
+    Может ли отправка пройти позже: только 429 и сбой сети до ответа Telegram
+
+    Блокировка бота, неверный запрос и неизвестные ошибки повтором не лечатся.
+    TimedOut - тоже нет: сообщение могло уйти, повтор пришлёт его второй раз.
+    """
+    if isinstance(error, RetryAfter):
+        return True
+    return isinstance(error, NetworkError) and not isinstance(error, (BadRequest, TimedOut))
+class TokenBucket:
+    """Токен-бакет: в среднем rate отправок в секунду, пачкой не больше capacity"""
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (после 429 от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Пустой бакет наполняется только после паузы - иначе сразу после неё ушла бы целая пачка
+        self._tokens = 0.0
+        self._updated = self._paused_until
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+@dataclass
+class BroadcastStats:
+    """Итоги рассылки"""
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    rate_limited: int = 0
+    elapsed: float = 0.0
+    errors: Counter = field(default_factory=Counter)
+    @property
+    def total(self) -> int:
+        return self.sent + self.failed
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+class Broadcaster:
+    """
+    Рассылает сообщения пачкой воркеров с общим токен-бакетом
+
+    send(chat_id, payload) - корутина, которая отправляет одно сообщение
+    и бросает исключения telegram.error как обычный Bot. on_result(chat_id,
+    error) вызывается один раз на задание с итогом: None - доставлено.
+    """
+    def __init__(self, send, rate=BROADCAST_RATE, burst=BROADCAST_BURST,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL,
+                 concurrency=BROADCAST_CONCURRENCY, max_retries=BROADCAST_MAX_RETRIES,
+                 max_attempts=BROADCAST_MAX_ATTEMPTS, backoff=BROADCAST_BACKOFF, on_result=None):
+        self.send = send
+        self.on_result = on_result
+        self.bucket = TokenBucket(rate, burst)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.stats = BroadcastStats()
+        self._last_sent = {}
+        self._chat_locks = {}
+    async def _wait_chat(self, chat_id):
+        """Выдерживает паузу между сообщениями в один и тот же чат"""
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    async def _send_to_chat(self, chat_id, payload):
+        """Одна попытка отправки; задания в один чат идут по очереди, с паузой между ними"""
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        async with lock:
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.send(chat_id, payload)
+            finally:
+                self._last_sent[chat_id] = time.monotonic()
+    async def _deliver(self, chat_id, payload):
+        failures = 0
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                await self._send_to_chat(chat_id, payload)
+                self.stats.sent += 1
+                metrics.broadcast_messages.inc(result="sent")
+                metrics.broadcast_progress.inc()
+                if self.on_result:
+                    self.on_result(chat_id, None)
+                return
+            except RetryAfter as e:
+                # 429: Telegram сам говорит, сколько ждать - тормозим всю рассылку.
+                # Это не ошибка доставки, поэтому в max_retries не засчитывается
+                retry_after = _seconds(e.retry_after)
+                self.stats.rate_limited += 1
+                metrics.broadcast_rate_limited.inc()
+                logger.warning(f"⏳ 429 для {chat_id}, пауза {retry_after:.0f} с")
+                self.bucket.pause(retry_after)
+                if attempts >= self.max_attempts:
+                    self._fail(chat_id, e)
+                    return
+                self.stats.retried += 1
+                metrics.broadcast_messages.inc(result="retried")
+                continue
+            except (BadRequest, Forbidden, TimedOut) as e:
+                # Заблокировал бота, удалил аккаунт и т.п. - повтор не поможет;
+                # TimedOut - ответа не дождались, но сообщение могло уйти
+                self._fail(chat_id, e)
+                return
+            except NetworkError as e:
+                error = e
+                await asyncio.sleep(self.backoff * 2 ** failures + random.uniform(0, self.backoff))
+            except Exception as e:
+                self._fail(chat_id, e)
+                return
+            failures += 1
+            if failures > self.max_retries or attempts >= self.max_attempts:
+                self._fail(chat_id, error)
+                return
+            self.stats.retried += 1
+            metrics.broadcast_messages.inc(result="retried")
+    def _fail(self, chat_id, error):
+        self.stats.failed += 1
+        self.stats.errors[type(error).__name__] += 1
+        metrics.broadcast_messages.inc(result="failed")
+        metrics.broadcast_progress.inc()
+        logger.error(f"❌ Ошибка отправки пользователю {chat_id}: {error}")
+        if self.on_result:
+            self.on_result(chat_id, error)
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            job = await queue.get()
+            try:
+                if job is None:
+                    return
+                await self._deliver(*job)
+            finally:
+                queue.task_done()
+    async def run(self, jobs) -> BroadcastStats:
+        """
+        Рассылает все задания (chat_id, payload)
+
+        jobs может быть обычным или асинхронным итератором - например,
+        потоком строк из iter_daily_reports_async, без загрузки всех в память.
+        """
+        started = time.monotonic()
+        metrics.broadcast_running.set(1)
+        metrics.broadcast_progress.set(0)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            if hasattr(jobs, '__aiter__'):
+                async for job in jobs:
+                    await queue.put(job)
+            else:
+                for job in jobs:
+                    await queue.put(job)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.stats.elapsed = time.monotonic() - started
+            metrics.broadcast_running.set(0)
+        stats = self.stats
+        metrics.broadcast_duration.set(stats.elapsed)
+        metrics.broadcast_throughput.set(stats.throughput)
+        logger.info(
+            f"📊 Рассылка завершена: отправлено={stats.sent}, ошибок={stats.failed}, "
+            f"429={stats.rate_limited}, повторов={stats.retried}, "
+            f"за {stats.elapsed:.1f} с ({stats.throughput:.1f} сообщ/с)"
+        )
+        if stats.errors:
+            logger.info(f"📊 Ошибки по типам: {dict(stats.errors)}")
+        return stats
+async def broadcast(jobs, send, **kwargs) -> BroadcastStats:
+    """Короткая форма: Broadcaster(send, **kwargs).run(jobs)"""
+    return await Broadcaster(send, **kwargs).run(jobs)
@@ -0,0 +1,133 @@
+# cache.py - простые in-process кэши
+import time
+import asyncio
+from collections import OrderedDict
+_MISSING = object()
+class LRUCache:
+    """
+    LRU-кэш с ограничением по размеру и необязательным TTL (секунды)
+
+    Не потокобезопасен: рассчитан на использование из event loop бота.
+    """
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def _lookup(self, key):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return _MISSING
+        value, expires = item
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+    def clear(self):
+        self._data.clear()
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+    def __len__(self):
+        return len(self._data)
+class _Inflight:
+    """Загрузка, которую сейчас ждут один или несколько вызовов"""
+    __slots__ = ('task', 'stale')
+    def __init__(self):
+        self.task = None
+        self.stale = False
+class UserReadThroughCache:
+    """
+    Read-through кэш чтений, разложенный по пользователям: (user_id, key) -> значение
+
+    - LRU по пользователям + TTL на каждое значение, не больше max_keys
+      значений на пользователя (вытесняются самые старые);
+    - invalidate_user() сбрасывает ровно записи одного пользователя;
+    - одновременные промахи по одному ключу схлопываются в одну загрузку.
+    """
+    def __init__(self, maxsize: int, ttl: float, max_keys: int = 64):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._users = LRUCache(maxsize)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.invalidations = 0
+    async def get_or_load(self, user_id, key, loader):
+        """Значение из кэша или результат await loader() (одна загрузка на ключ)"""
+        entries = self._users._lookup(user_id)
+        if entries is not _MISSING:
+            item = entries.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self.hits += 1
+                return item[0]
+        inflight = self._inflight.get((user_id, key))
+        if inflight is not None:
+            self.collapsed += 1
+        else:
+            self.misses += 1
+            inflight = _Inflight()
+            # Загрузка - своя задача: отмена одного из ожидающих не отменяет её для остальных
+            inflight.task = asyncio.get_running_loop().create_task(self._load(user_id, key, loader, inflight))
+            # Ошибку забирают ожидающие; если их нет - не засоряем лог "exception was never retrieved"
+            inflight.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[(user_id, key)] = inflight
+        return await asyncio.shield(inflight.task)
+    async def _load(self, user_id, key, loader, inflight):
+        try:
+            value = await loader()
+        finally:
+            if self._inflight.get((user_id, key)) is inflight:
+                del self._inflight[(user_id, key)]
+        # Если пока грузили, данные пользователя поменялись - результат уже устарел
+        if not inflight.stale:
+            self._store(user_id, key, value)
+        return value
+    def _store(self, user_id, key, value):
+        now = time.monotonic()
+        entries = self._users._lookup(user_id)
+        if entries is _MISSING:
+            entries = {}
+            self._users.set(user_id, entries)
+        else:
+            # Истёкшие значения (старые страницы, периоды) выбрасываем, а не копим до записи
+            for expired in [k for k, item in entries.items() if item[1] <= now]:
+                del entries[expired]
+            entries.pop(key, None)
+        entries[key] = (value, now + self.ttl)
+        while len(entries) > self.max_keys:
+            del entries[next(iter(entries))]
+    def invalidate_user(self, user_id):
+        """Сбрасывает все закэшированные чтения пользователя (после записи)"""
+        self.invalidations += 1
+        self._users.pop(user_id)
+        for (inflight_user, key) in [k for k in self._inflight if k[0] == user_id]:
+            self._inflight.pop((inflight_user, key)).stale = True
+    def clear(self):
+        self._users.clear()
+    def stats(self) -> dict:
+        return {
+            'users': len(self._users),
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,51 @@
+# coffee_cache.py - кэш Telegram file_id для картинок кофе (LRU в памяти + таблица в Postgres)
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from cache import LRUCache
+from coffee_render import RENDER_VERSION
+from database import get_coffee_file_id_async, save_coffee_file_id_async
+logger = logging.getLogger(__name__)
+COFFEE_CACHE_SIZE = int(os.environ.get("COFFEE_CACHE_SIZE", 5000))
+def coffee_cache_key(template: str, date: str, cups: int) -> str:
+    """Картинка зависит только от шаблона, даты и числа чашек"""
+    return f"v{RENDER_VERSION}:{template}:{date}:{cups}"
+class CoffeeFileIdCache:
+    """file_id по ключу картинки: сначала память, потом БД"""
+    def __init__(self, maxsize=COFFEE_CACHE_SIZE):
+        self._memory = LRUCache(maxsize)
+        self._locks = {}
+    async def get(self, key: str):
+        file_id = self._memory.get(key)
+        if file_id is None:
+            file_id = await get_coffee_file_id_async(key)
+            if file_id is not None:
+                self._memory.set(key, file_id)
+        return file_id
+    async def put(self, key: str, file_id: str):
+        self._memory.set(key, file_id)
+        try:
+            await save_coffee_file_id_async(key, file_id)
+        except Exception as e:
+            # Без записи в БД кэш всё равно работает в памяти этого процесса
+            logger.error(f"❌ Не удалось сохранить file_id в БД: {e}")
+    @asynccontextmanager
+    async def lock(self, key: str):
+        """Одна отрисовка и загрузка на ключ: остальные ждут и получают готовый file_id"""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+    @property
+    def hits(self):
+        return self._memory.hits
+    @property
+    def misses(self):
+        return self._memory.misses
+coffee_file_ids = CoffeeFileIdCache()
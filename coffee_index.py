@@ -1,12 +1,15 @@
 import os
 import random
-from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+from PIL import Image, ImageFont
 import logging
+from text_render import draw_text_centered
 logger = logging.getLogger(__name__)
 # Папка с шаблонами кофе
 COFFEE_DIR = "coffee_templates"
 # Константа: цена чашки кофе
 COFFEE_PRICE = 213
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 def get_random_coffee_template():
     """Выбирает случайную картинку с кофе"""
     if not os.path.exists(COFFEE_DIR):
@@ -17,6 +20,14 @@ def get_random_coffee_template():
         raise FileNotFoundError(f"❌ Нет картинок в папке {COFFEE_DIR}/")
     
     return os.path.join(COFFEE_DIR, random.choice(templates))
+@lru_cache(maxsize=16)
+def get_font(size: int):
+    """Шрифт грузится с диска один раз на каждый размер"""
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        logger.warning("⚠️ Используется стандартный шрифт")
+        return ImageFont.load_default(size)
 def get_coffee_emoji(cups: int) -> str:
     """Возвращает эмодзи в зависимости от количества чашек"""
     if cups <= 10:
@@ -64,54 +75,21 @@ def generate_coffee_image(date: str, cups: int, emoji: str, output_path: str = "
         logger.info(f"☕ Используется шаблон: {template_path}")
         
         img = Image.open(template_path).convert("RGB")
-        draw = ImageDraw.Draw(img)
-        
         width, height = img.size
         
         # Размеры шрифтов
-        title_font_size = int(height * 0.08)
-        cups_font_size = int(height * 0.15)
-        
-        # Загружаем шрифты
-        try:
-            title_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", title_font_size)
-            cups_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", cups_font_size)
-        except:
-            title_font = ImageFont.load_default()
-            cups_font = ImageFont.load_default()
-            logger.warning("⚠️ Используется стандартный шрифт")
+        title_font = get_font(int(height * 0.08))
+        cups_font = get_font(int(height * 0.15))
         
         # Текст сверху
         title_text = f"Твои траты за {date}"
-        
-        # Основной текст (большой)
-        main_text = f"{cups} чашек кофе {emoji}"
-        
-        # Позиции
-        y_title = height * 0.1
-        y_main = height * 0.4
-        
-        # Рисуем заголовок
-        bbox = draw.textbbox((0, 0), title_text, font=title_font)
-        text_width = bbox[2] - bbox[0]
-        x_title = (width - text_width) / 2
-        
-        # Контур заголовка
-        for adj in range(-2, 3):
-            for adj_y in range(-2, 3):
-                draw.text((x_title + adj, y_title + adj_y), title_text, font=title_font, fill="black")
-        draw.text((x_title, y_title), title_text, font=title_font, fill="white")
-        
-        # Рисуем основной текст
-        bbox = draw.textbbox((0, 0), main_text, font=cups_font)
-        text_width = bbox[2] - bbox[0]
-        x_main = (width - text_width) / 2
-        
-        # Контур основного текста
-        for adj in range(-3, 4):
-            for adj_y in range(-3, 4):
-                draw.text((x_main + adj, y_main + adj_y), main_text, font=cups_font, fill="black")
-        draw.text((x_main, y_main), main_text, font=cups_font, fill="white")
+
+        # Основной текст (большой), по кускам: хвост «чашек кофе» берётся из кэша
+        main_parts = (f"{cups}", f" чашек кофе {emoji}")
+
+        # Белый текст с чёрным контуром, за один проход на строку
+        draw_text_centered(img, height * 0.1, title_text, title_font, fill="white", stroke_width=2)
+        draw_text_centered(img, height * 0.4, main_parts, cups_font, fill="white", stroke_width=3)
         
         # Сохраняем
         img.save(output_path, quality=95)
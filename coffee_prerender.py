@@ -0,0 +1,167 @@
+# coffee_prerender.py - ночная предотрисовка картинок «Индекс кофе» к утреннему отчёту
+#
+# До рассылки: одним запросом считаем вчерашние чашки всех пользователей, рисуем
+# только различные картинки (шаблон, чашки) в пуле процессов и загружаем каждую
+# один раз в служебный чат COFFEE_STORAGE_CHAT_ID ради file_id. Отчёт и кнопка
+# «☕ Индекс кофе» потом отправляют готовый file_id - в 9:00 без отрисовки.
+# Западнее МСК к 8:30 «вчера» ещё не закончилось: таких пропускаем, их догоняет
+# прогон перед пачкой их отчётов.
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from broadcast import Broadcaster
+from coffee_cache import coffee_file_ids, coffee_cache_key
+from coffee_render import generate_coffee_image, load_templates, pick_coffee_template, calculate_coffee_index
+from database import get_daily_totals_async
+logger = logging.getLogger(__name__)
+# Чат, куда загружаются картинки (бот должен иметь право туда писать); без него предотрисовка выключена
+COFFEE_STORAGE_CHAT_ID = int(os.environ.get("COFFEE_STORAGE_CHAT_ID", 0))
+# За сколько минут до утреннего отчёта запускать предотрисовку
+PRERENDER_LEAD_MINUTES = int(os.environ.get("PRERENDER_LEAD_MINUTES", 30))
+PRERENDER_WORKERS = int(os.environ.get("PRERENDER_WORKERS", os.cpu_count() or 2))
+# Загрузки идут в один чат: Telegram пропускает примерно одно сообщение в секунду
+PRERENDER_UPLOAD_INTERVAL = float(os.environ.get("PRERENDER_UPLOAD_INTERVAL", 1.0))
+def coffee_caption(date: str, cups: int, emoji: str) -> str:
+    return f"☕ Твои траты за {date} = {cups} чашек кофе {emoji}"
+class CoffeePrerender:
+    """Готовые картинки кофе за один день: user_id -> file_id и подпись"""
+    def __init__(self, storage_chat_id=COFFEE_STORAGE_CHAT_ID, workers=PRERENDER_WORKERS,
+                 upload_interval=PRERENDER_UPLOAD_INTERVAL):
+        self.storage_chat_id = storage_chat_id
+        self.workers = workers
+        self.upload_interval = upload_interval
+        self.day = None
+        # День последнего запуска, даже неудачного: догоняющий запуск - не чаще раза в день
+        self.attempted = None
+        self._by_user = {}
+        # У кого день ещё шёл во время прогона (западные пояса): их дорисует следующий
+        self._waiting = set()
+        self._lock = asyncio.Lock()
+        self._executor = None
+    @property
+    def enabled(self) -> bool:
+        return bool(self.storage_chat_id)
+    def get(self, user_id: int, day, total: float):
+        """
+        {'file_id', 'caption', 'cups', 'emoji'} или None, если за этот день не готовили
+
+        total - сумма за day на момент отправки: после предотрисовки трату могли
+        исправить или удалить (/fix), и тогда готовая картинка уже не та - None.
+        """
+        if day != self.day:
+            return None
+        coffee = self._by_user.get(user_id)
+        if coffee is None or coffee['cups'] != calculate_coffee_index(total)['cups']:
+            return None
+        return coffee
+    def needs_catch_up(self, day, user_ids=()) -> bool:
+        """
+        За day ещё не готовили (и не пытались): ночной прогон пропущен; или среди
+        user_ids есть те, у кого на момент прогона day ещё не закончился
+        """
+        if not self.enabled:
+            return False
+        return self.attempted != day or not self._waiting.isdisjoint(user_ids)
+    async def run(self, bot, day) -> dict:
+        """Готовит картинки за day; повторный запуск догружает только недостающие"""
+        async with self._lock:
+            self.attempted = day
+            return await self._run(bot, day)
+    async def shutdown(self):
+        """Останавливает пул процессов (ожидание воркеров - вне event loop)"""
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Пул живёт между запусками: процессы поднимаются один раз, а не на каждый прогон
+        if self._executor is None:
+            # spawn: не форкаем процесс с уже запущенным event loop и потоками
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_templates,
+            )
+        return self._executor
+    async def _run(self, bot, day) -> dict:
+        started = time.monotonic()
+        date = day.strftime("%d.%m")
+        totals = await get_daily_totals_async(day)
+        # Пользователь -> ключ картинки; различных картинок обычно на порядки меньше, чем людей
+        users = {}
+        images = {}
+        waiting = set()
+        for user_id, total, day_over in totals:
+            if not day_over:
+                # Картинка по половине дня устареет к отчёту - не рисуем и не грузим
+                waiting.add(user_id)
+                continue
+            coffee = calculate_coffee_index(total)
+            template = pick_coffee_template(date, coffee['cups'])
+            key = coffee_cache_key(template, date, coffee['cups'])
+            users[user_id] = (key, coffee)
+            images[key] = (template, coffee['cups'], coffee['emoji'])
+        file_ids = {}
+        missing = []
+        for key in images:
+            file_id = await coffee_file_ids.get(key)
+            if file_id:
+                file_ids[key] = file_id
+            else:
+                missing.append(key)
+        if missing:
+            await self._render_and_upload(bot, date, missing, images, file_ids)
+        self.day = day
+        self._waiting = waiting
+        self._by_user = {
+            user_id: {
+                'file_id': file_ids[key],
+                'caption': coffee_caption(date, coffee['cups'], coffee['emoji']),
+                'cups': coffee['cups'],
+                'emoji': coffee['emoji'],
+            }
+            for user_id, (key, coffee) in users.items() if key in file_ids
+        }
+        stats = {
+            'users': len(users), 'images': len(images), 'rendered': len(missing),
+            'ready': len(self._by_user), 'waiting': len(waiting), 'elapsed': time.monotonic() - started,
+        }
+        logger.info(
+            f"☕ Предотрисовка за {date}: пользователей {stats['users']}, картинок {stats['images']}, "
+            f"нарисовано {stats['rendered']}, готово {stats['ready']}, день не закончился у {stats['waiting']}, "
+            f"за {stats['elapsed']:.1f} с"
+        )
+        return stats
+    async def _render_and_upload(self, bot, date, keys, images, file_ids):
+        """Рисует в пуле процессов и загружает по мере готовности, с лимитами рассылки"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        futures = [loop.run_in_executor(executor, _render, date, *images[key]) for key in keys]
+        async def jobs():
+            for future in asyncio.as_completed(futures):
+                try:
+                    key, image_bytes = await future
+                except Exception as e:
+                    # Эту картинку нарисуют по запросу, как раньше
+                    logger.error(f"❌ Ошибка предотрисовки: {e}")
+                    continue
+                yield self.storage_chat_id, (key, image_bytes)
+        async def upload(chat_id, payload):
+            key, image_bytes = payload
+            message = await bot.send_photo(chat_id=chat_id, photo=image_bytes, disable_notification=True)
+            file_ids[key] = message.photo[-1].file_id
+            await coffee_file_ids.put(key, file_ids[key])
+            try:
+                # file_id остаётся рабочим и после удаления сообщения - не засоряем чат
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось удалить загруженную картинку: {e}")
+        uploader = Broadcaster(upload, per_chat_interval=self.upload_interval, concurrency=2)
+        await uploader.run(jobs())
+def _render(date, template, cups, emoji):
+    """Выполняется в процессе пула: ключ возвращаем вместе с картинкой"""
+    return coffee_cache_key(template, date, cups), generate_coffee_image(date, cups, emoji, template=template)
+coffee_prerender = CoffeePrerender()
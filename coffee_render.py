@@ -0,0 +1,114 @@
+# coffee_render.py - шаблоны, шрифты и отрисовка картинки "Индекс кофе" в памяти
+import io
+import os
+import random
+import logging
+import threading
+import time
+import zlib
+from functools import lru_cache
+from PIL import Image, ImageFont
+import metrics
+from text_render import draw_text_centered
+logger = logging.getLogger(__name__)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+COFFEE_DIR = os.path.join(BASE_DIR, "coffee_templates")
+# 👇 ШРИФТ ИЗ GIT-репозитория
+FONT_PATH = os.path.join(BASE_DIR, "fonts", "Arial.ttf")
+TEMPLATE_SIZE = (1000, 1000)
+JPEG_QUALITY = 95
+# Поднимать при любом изменении внешнего вида картинки: старые file_id в кэше станут неактуальны
+RENDER_VERSION = 1
+# Цена чашки кофе, руб.
+COFFEE_PRICE = 213
+# Имя файла -> уже декодированный RGB-шаблон 1000x1000
+_templates = {}
+_templates_lock = threading.Lock()
+def load_templates() -> dict:
+    """Декодирует и приводит к 1000x1000 все шаблоны один раз (при старте бота)"""
+    if not os.path.exists(COFFEE_DIR):
+        raise FileNotFoundError(f"❌ Папка {COFFEE_DIR} не найдена!")
+    names = sorted(f for f in os.listdir(COFFEE_DIR) if f.lower().endswith(('.jpg', '.png', '.jpeg')))
+    if not names:
+        raise FileNotFoundError(f"❌ Нет картинок в папке {COFFEE_DIR}/")
+    templates = {}
+    for name in names:
+        with Image.open(os.path.join(COFFEE_DIR, name)) as img:
+            img = img.convert("RGB")
+            if img.size != TEMPLATE_SIZE:
+                img = img.resize(TEMPLATE_SIZE, Image.Resampling.LANCZOS)
+            img.load()
+            templates[name] = img
+    _templates.clear()
+    _templates.update(templates)
+    logger.info(f"✅ Загружено шаблонов кофе: {len(_templates)}")
+    return _templates
+def get_templates() -> dict:
+    """Реестр шаблонов (загружается при первом обращении, если не загружен при старте)"""
+    if not _templates:
+        # Рендер может идти из нескольких потоков пула - грузим один раз
+        with _templates_lock:
+            if not _templates:
+                load_templates()
+    return _templates
+def get_random_coffee_template() -> str:
+    """Выбирает случайный шаблон, возвращает его имя"""
+    return random.choice(list(get_templates()))
+def pick_coffee_template(date: str, cups: int) -> str:
+    """Шаблон, детерминированно выбранный по (дата, чашки) - одинаковые картинки можно кэшировать"""
+    names = sorted(get_templates())
+    return names[zlib.crc32(f"{date}:{cups}".encode()) % len(names)]
+def get_coffee_emoji(cups: int) -> str:
+    if cups <= 10:
+        return "❤️"
+    elif cups <= 50:
+        return "👍"
+    elif cups <= 100:
+        return "🤯"
+    else:
+        return "😱"
+def calculate_coffee_index(amount: float) -> dict:
+    """Чашки кофе и эмодзи для суммы трат - и для картинки по запросу, и для предотрисовки"""
+    cups = round(amount / COFFEE_PRICE)
+    return {'cups': cups, 'emoji': get_coffee_emoji(cups), 'amount': amount}
+@lru_cache(maxsize=16)
+def get_font(size: int, path: str = FONT_PATH) -> ImageFont.FreeTypeFont:
+    """Шрифт грузится с диска один раз на каждый размер"""
+    return ImageFont.truetype(path, size)
+def generate_coffee_image(date: str, cups: int, emoji: str, template: str = None) -> bytes:
+    """
+    Рисует картинку с индексом кофе и возвращает JPEG-байты
+
+    Шаблон копируется из реестра, на диск ничего не пишется - одновременные
+    запросы разных пользователей друг другу не мешают.
+    """
+    try:
+        if template is None:
+            template = get_random_coffee_template()
+        logger.info(f"☕ Используется шаблон: {template}")
+        started = time.perf_counter()
+        img = get_templates()[template].copy()
+
+        # Текст одной строкой, по кускам: дата и «N чашек кофе» повторяются
+        # между картинками, их растры берутся из кэша text_render
+        parts = (f"Мои траты за {date}", " – это ", f"{cups} чашек кофе")
+        font = get_font(43)
+
+        # Черный текст СВЕРХУ (y=140), по центру
+        draw_text_centered(img, 140, parts, font, fill="black")
+        drawn = time.perf_counter()
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        image_bytes = buffer.getvalue()
+        # В режиме process эти метрики остаются в воркере; общее время и размер видны в render_pool
+        metrics.render_seconds.observe(drawn - started, stage="draw")
+        metrics.render_seconds.observe(time.perf_counter() - drawn, stage="encode")
+        logger.info(f"✅ Картинка готова: {len(image_bytes)} байт")
+
+        return image_bytes
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка: {e}")
+        logger.exception("Traceback:")
+        raise
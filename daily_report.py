@@ -1,17 +1,18 @@
-# daily_report.py - отдельный файл для отправки ежедневных отчетов всем пользователям
+# daily_report.py - разовая рассылка наступивших ежедневных отчетов без запуска бота
 import os
 import sys
 import asyncio
 import logging
-from datetime import datetime, timedelta
-import requests
 from pathlib import Path
 
 # Добавляем путь к проекту, чтобы импортировать наши модули
 sys.path.append(str(Path(__file__).parent))
 
-# Импортируем ТОЛЬКО функции из базы данных (НЕ импортируем bot.py!)
-from database import get_all_users, get_user_stats, init_database
+# Импортируем ТОЛЬКО функции из базы данных и рассылки (НЕ импортируем bot.py!)
+from database import open_pool, close_pool, claim_due_reports_async, finish_reports_async
+from broadcast import broadcast, BROADCAST_CONCURRENCY, is_retryable
+from telegram import Bot
+from telegram.request import HTTPXRequest
 
 # Получаем токен из переменных окружения
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -19,6 +20,17 @@ if not BOT_TOKEN:
     print("❌ Установите BOT_TOKEN в переменные окружения Railway")
     sys.exit(1)
 
+# Адрес Bot API (можно подменить на локальный фейковый сервер для бенчмарков)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# HTTP-клиент: размер пула соединений и таймауты, сек
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", BROADCAST_CONCURRENCY))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 10))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("HTTP_WRITE_TIMEOUT", 10))
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", 5))
+# Сколько отчётов забирать из БД за раз
+REPORT_BATCH_SIZE = int(os.environ.get("REPORT_BATCH_SIZE", 1000))
+
 # Настройка логирования для этого файла (СВОЙ логгер, не из bot.py)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -26,83 +38,98 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def build_message(stats: dict, yesterday: str) -> str:
+    """Формирует текст отчёта для одного пользователя"""
+    first_name = stats['first_name']
+    if stats['has_data']:
+        # Берём топ-3 категории
+        top_categories = stats['categories'][:3]
+        categories_text = ""
+        for cat in top_categories:
+            categories_text += f"• {cat['category']}: {cat['total']:.2f} руб.\n"
+        
+        return (
+            f"☀️ Доброе утро, {first_name}!\n\n"
+            f"📊 За вчера ({yesterday}) ты потратил: {stats['total']:.2f} руб.\n\n"
+            f"🏆 Топ категории:\n{categories_text}\n"
+            f"Хорошего дня! 💫"
+        )
+    return (
+        f"☀️ Доброе утро, {first_name}!\n\n"
+        f"📊 Вчера у тебя не было трат.\n"
+        f"Отличный день для экономии! 💪"
+    )
+
+def create_bot() -> Bot:
+    """
+    Bot с общим пулом keep-alive соединений (httpx под капотом PTB)
+
+    TELEGRAM_API_URL позволяет направить рассылку на локальный фейковый
+    Bot API, чтобы прогонять её офлайн и замерять скорость.
+    """
+    request = HTTPXRequest(
+        connection_pool_size=HTTP_POOL_SIZE,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+    )
+    return Bot(token=BOT_TOKEN, base_url=TELEGRAM_API_URL, request=request)
+
 async def send_daily_reports():
-    """Отправляет ежедневные отчеты всем пользователям"""
-    
-    logger.info("🚀 Запуск ежедневной рассылки отчетов...")
-    
-    # Инициализируем базу данных (на всякий случай)
-    init_database()
-    
-    # Получаем всех пользователей
-    users = get_all_users()
+    """
+    Отправляет отчёты всем, у кого по их часовому поясу уже наступило время отчёта
+
+    Отчёты забираются теми же пачками, что и в боте (claim_due_reports_async),
+    поэтому скрипт можно запускать вручную или по cron рядом с ботом: никто не
+    получит отчёт дважды. Доставленные отчёты закрываются между пачками, с
+    временной ошибкой - остаются на следующий запуск (или тик бота).
+    """
     
-    if not users:
-        logger.info("📭 Нет пользователей для рассылки")
-        return
+    logger.info("🚀 Запуск рассылки наступивших отчетов...")
     
-    logger.info(f"📨 Начинаю рассылку для {len(users)} пользователей")
+    days = {}      # user_id -> день отчёта: забраны и ещё не закрыты
+    sent = []      # [(user_id, day)] доставлены или повтор не поможет
+    def on_result(chat_id, error):
+        if error is None or not is_retryable(error):
+            sent.append((chat_id, days.pop(chat_id)))
+    async def close_sent():
+        batch = sent[:]
+        sent.clear()
+        await finish_reports_async(batch, [])
     
-    successful = 0
-    failed = 0
+    async def jobs():
+        while True:
+            # Перед новой пачкой закрываем уже отправленные; с временной ошибкой
+            # держат аренду до конца запуска, так что повторно их не заберём
+            await close_sent()
+            reports = await claim_due_reports_async(REPORT_BATCH_SIZE)
+            if not reports:
+                return
+            logger.info(f"📨 Пачка отчётов: {len(reports)} польз.")
+            for stats in reports:
+                days[stats['user_id']] = stats['day']
+                # Дата «вчера» у каждого своя - по его часовому поясу
+                yield stats['user_id'], build_message(stats, stats['day'].strftime("%d.%m"))
     
-    for user in users:
-        user_id = user['user_id']
-        first_name = user['first_name']
-        
-        # Получаем статистику за вчера (days=1)
-        stats = get_user_stats(user_id, days=1)
-        
-        # Формируем сообщение
-        if stats['has_data']:
-            # Берём топ-3 категории
-            top_categories = stats['categories'][:3]
-            categories_text = ""
-            for cat in top_categories:
-                categories_text += f"• {cat['category']}: {cat['total']:.2f} руб.\n"
-            
-            # Вчерашняя дата для заголовка
-            yesterday = (datetime.now() - timedelta(days=1)).strftime("%d.%m")
-            
-            message = (
-                f"☀️ Доброе утро, {first_name}!\n\n"
-                f"📊 За вчера ({yesterday}) ты потратил: {stats['total']:.2f} руб.\n\n"
-                f"🏆 Топ категории:\n{categories_text}\n"
-                f"Хорошего дня! 💫"
-            )
-        else:
-            message = (
-                f"☀️ Доброе утро, {first_name}!\n\n"
-                f"📊 Вчера у тебя не было трат.\n"
-                f"Отличный день для экономии! 💪"
-            )
-        
-        # Отправляем через Telegram API
-        try:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-            data = {
-                "chat_id": user_id,
-                "text": message
+    await open_pool()
+    try:
+        async with create_bot() as bot:
+            async def send(chat_id, text):
                 # parse_mode не используем, чтобы избежать ошибок
-            }
-            
-            response = requests.post(url, json=data, timeout=10)
+                await bot.send_message(chat_id=chat_id, text=text)
             
-            if response.status_code == 200:
-                logger.info(f"✅ Отчёт отправлен пользователю {user_id} ({first_name})")
-                successful += 1
-            else:
-                logger.error(f"❌ Ошибка отправки пользователю {user_id}: {response.status_code}")
-                failed += 1
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка при отправке пользователю {user_id}: {e}")
-            failed += 1
-        
-        # Небольшая задержка, чтобы не спамить Telegram
-        await asyncio.sleep(0.3)
+            try:
+                stats = await broadcast(jobs(), send, on_result=on_result)
+            finally:
+                # Не ушедшие (временная ошибка, сбой рассылки) - следующему запуску или тику бота
+                await finish_reports_async(sent, list(days.items()))
+    finally:
+        await close_pool()
     
-    logger.info(f"📊 Рассылка завершена: успешно={successful}, ошибок={failed}")
+    if not stats.total:
+        logger.info("📭 Нет пользователей для рассылки")
+    return stats
 
 def main():
     """Точка входа"""
@@ -1,71 +1,430 @@
 import os
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from decimal import Decimal
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from cache import LRUCache, UserReadThroughCache
+from metrics import timed_query, db_connections_opened
+from query_trace import connection_kwargs, sync_connection_kwargs
 logger = logging.getLogger(__name__)
 # Получаем URL БД из переменных Railway
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Настройки асинхронного пула соединений
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # ожидание свободного соединения, сек
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", 300))
+# Кэш чтений статистики/операций: размер (пользователей) и TTL, сек
+STATS_CACHE_SIZE = int(os.environ.get("STATS_CACHE_SIZE", 10000))
+STATS_CACHE_TTL = float(os.environ.get("STATS_CACHE_TTL", 300))
+STATS_CACHE_KEYS_PER_USER = int(os.environ.get("STATS_CACHE_KEYS_PER_USER", 64))
+KNOWN_USERS_CACHE_SIZE = int(os.environ.get("KNOWN_USERS_CACHE_SIZE", 50000))
+_pool = None
+# Записи через *_async сбрасывают кэш своего пользователя сразу, а записи других
+# процессов (реплики, daily_report.py) - через NOTIFY read_cache (миграция 12),
+# который слушает start_cache_listener()
+READ_CACHE_CHANNEL = 'read_cache'
+# Пауза перед переподключением слушателя NOTIFY (удваивается до максимума), сек
+CACHE_LISTENER_RETRY_MAX = float(os.environ.get("CACHE_LISTENER_RETRY_MAX", 30))
+_cache_listener = None
+read_cache = UserReadThroughCache(STATS_CACHE_SIZE, STATS_CACHE_TTL, STATS_CACHE_KEYS_PER_USER)
+# user_id -> (username, first_name), которые уже лежат в БД; None - строка есть,
+# но профиль неизвестен (создана заглушкой при сохранении траты)
+known_users = LRUCache(KNOWN_USERS_CACHE_SIZE)
+# user_id -> часовой пояс, время отчёта и смещение от UTC; TTL - чтобы подхватить переход на летнее время
+USER_SCHEDULE_CACHE_TTL = float(os.environ.get("USER_SCHEDULE_CACHE_TTL", 600))
+user_schedules = LRUCache(KNOWN_USERS_CACHE_SIZE, USER_SCHEDULE_CACHE_TTL)
+# Открытая transaction(): её соединение и пользователи, чей кэш сбросить после COMMIT
+_unit_of_work = ContextVar("unit_of_work", default=None)
+
+# ==================== SQL ====================
+
+SQL_UPSERT_USER = '''
+    INSERT INTO users (user_id, username, first_name)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (user_id)
+    DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name
+    -- Неизменённый профиль не переписываем (нет лишней версии строки и WAL)
+    WHERE (users.username, users.first_name)
+        IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name)
+'''
+SQL_ENSURE_USER = '''
+    INSERT INTO users (user_id, username, first_name)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO NOTHING
+'''
+SQL_ALL_USERS = 'SELECT user_id, username, first_name FROM users'
+# Трата и дневной агрегат обновляются одним запросом (а значит, в одной транзакции)
+SQL_INSERT_EXPENSE = '''
+    WITH inserted AS (
+        INSERT INTO expenses (user_id, amount, category, date)
+        VALUES (%s, %s, %s, %s)
+        RETURNING user_id, date, category, amount
+    )
+    INSERT INTO daily_category_totals AS t (user_id, day, category, total, count)
+    SELECT user_id, date, category, amount, 1 FROM inserted
+    ON CONFLICT (user_id, day, category)
+    DO UPDATE SET total = t.total + EXCLUDED.total, count = t.count + EXCLUDED.count
+'''
+# Пакетная вставка: массивы разворачиваются через unnest, агрегат обновляется
+# по сгруппированным строкам (одна строка агрегата не может обновиться дважды за запрос)
+SQL_ENSURE_USERS_BATCH = '''
+    INSERT INTO users (user_id, username, first_name)
+    SELECT DISTINCT u, 'unknown', 'Unknown' FROM unnest(%s::bigint[]) AS u
+    ON CONFLICT (user_id) DO NOTHING
+'''
+SQL_INSERT_EXPENSES_BATCH = '''
+    WITH inserted AS (
+        INSERT INTO expenses (user_id, amount, category, date)
+        SELECT * FROM unnest(%s::bigint[], %s::numeric[], %s::varchar[], %s::date[])
+        RETURNING user_id, date, category, amount
+    )
+    INSERT INTO daily_category_totals AS t (user_id, day, category, total, count)
+    SELECT user_id, date, category, SUM(amount), COUNT(*)
+    FROM inserted
+    GROUP BY user_id, date, category
+    ON CONFLICT (user_id, day, category)
+    DO UPDATE SET total = t.total + EXCLUDED.total, count = t.count + EXCLUDED.count
+'''
+# Статистика читается из агрегата: стоимость не зависит от числа трат пользователя
+SQL_USER_STATS = '''
+    SELECT category, SUM(total) as total
+    FROM daily_category_totals
+    WHERE user_id = %s AND day >= %s
+    GROUP BY category
+    HAVING SUM(count) > 0
+    ORDER BY total DESC
+'''
+SQL_USER_OPERATIONS = '''
+    SELECT id, date, category, amount 
+    FROM expenses 
+    WHERE user_id = %s 
+    ORDER BY id DESC 
+    LIMIT %s
+'''
+# Сводка за период одним запросом: GROUPING SETS даёт категории, дни и общий итог,
+# FILTER делит каждую группу на текущий и сравниваемый период
+SQL_PERIOD_STATS = '''
+    SELECT GROUPING(category, day) AS level, category, day,
+           SUM(total) FILTER (WHERE day BETWEEN %(start)s AND %(end)s) AS total,
+           SUM(total) FILTER (WHERE day BETWEEN %(prev_start)s AND %(prev_end)s) AS prev_total
+    FROM daily_category_totals
+    WHERE user_id = %(user_id)s AND count > 0
+      AND (day BETWEEN %(start)s AND %(end)s OR day BETWEEN %(prev_start)s AND %(prev_end)s)
+    GROUP BY GROUPING SETS ((category), (day), ())
+'''
+# Постраничный просмотр по ключу (keyset): страница - один проход по idx_expenses_user_id_desc,
+# сколько бы операций ни было у пользователя. Запрашиваем на одну строку больше - есть ли ещё
+SQL_USER_OPERATIONS_BEFORE = '''
+    SELECT id, date, category, amount
+    FROM expenses
+    WHERE user_id = %s AND id < %s
+    ORDER BY id DESC
+    LIMIT %s
+'''
+SQL_USER_OPERATIONS_AFTER = '''
+    SELECT id, date, category, amount
+    FROM expenses
+    WHERE user_id = %s AND id > %s
+    ORDER BY id ASC
+    LIMIT %s
+'''
+SQL_DELETE_EXPENSE = '''
+    WITH deleted AS (
+        DELETE FROM expenses 
+        WHERE id = %s
+        RETURNING user_id, date, category, amount
+    ),
+    adjusted AS (
+        UPDATE daily_category_totals t
+        SET total = t.total - d.amount, count = t.count - 1
+        FROM deleted d
+        WHERE t.user_id = d.user_id AND t.day = d.date AND t.category = d.category
+    )
+    SELECT user_id, date, category, amount FROM deleted
+'''
+# Правка траты одним запросом: id и дата остаются прежними, агрегат получает только
+# разницу. Строка сама блокируется до чтения старых значений (FOR UPDATE), поэтому
+# параллельная правка не собьёт агрегат. Если категория сменилась, из старой трата
+# вычитается, а опустевшая строка удаляется - это другая строка, чем в added.
+SQL_UPDATE_EXPENSE = '''
+    WITH updated AS (
+        UPDATE expenses e
+        SET amount = %(amount)s, category = %(category)s
+        FROM (
+            SELECT id, category, amount FROM expenses
+            WHERE id = %(id)s AND user_id = %(user_id)s
+            FOR UPDATE
+        ) old
+        WHERE e.id = old.id
+        RETURNING e.id, e.user_id, e.date, e.category, e.amount,
+                  old.category AS old_category, old.amount AS old_amount
+    ),
+    decremented AS (
+        UPDATE daily_category_totals t
+        SET total = t.total - u.old_amount, count = t.count - 1
+        FROM updated u
+        WHERE u.category <> u.old_category AND t.count > 1
+          AND t.user_id = u.user_id AND t.day = u.date AND t.category = u.old_category
+    ),
+    emptied AS (
+        DELETE FROM daily_category_totals t
+        USING updated u
+        WHERE u.category <> u.old_category AND t.count <= 1
+          AND t.user_id = u.user_id AND t.day = u.date AND t.category = u.old_category
+    ),
+    added AS (
+        INSERT INTO daily_category_totals AS t (user_id, day, category, total, count)
+        SELECT user_id, date, category,
+               CASE WHEN category = old_category THEN amount - old_amount ELSE amount END,
+               CASE WHEN category = old_category THEN 0 ELSE 1 END
+        FROM updated
+        ON CONFLICT (user_id, day, category)
+        DO UPDATE SET total = t.total + EXCLUDED.total, count = t.count + EXCLUDED.count
+    )
+    SELECT id, user_id, date, category, amount FROM updated
+'''
+# Опустевшие строки агрегата убираем отдельным запросом в той же транзакции
+SQL_CLEANUP_TOTALS = '''
+    DELETE FROM daily_category_totals
+    WHERE user_id = %s AND day = %s AND category = %s AND count <= 0
+'''
+SQL_REBUILD_TOTALS_DELETE = '''
+    DELETE FROM daily_category_totals
+    WHERE %(user_id)s::bigint IS NULL OR user_id = %(user_id)s
+'''
+SQL_REBUILD_TOTALS_INSERT = '''
+    INSERT INTO daily_category_totals (user_id, day, category, total, count)
+    SELECT user_id, date, category, SUM(amount), COUNT(*)
+    FROM expenses
+    WHERE %(user_id)s::bigint IS NULL OR user_id = %(user_id)s
+    GROUP BY user_id, date, category
+'''
+SQL_EXPENSE_BY_ID = '''
+    SELECT id, user_id, date, category, amount 
+    FROM expenses 
+    WHERE id = %s
+'''
+SQL_DAILY_REPORT = '''
+    WITH per_category AS (
+        SELECT user_id, category, total
+        FROM daily_category_totals
+        WHERE day = %(day)s AND count > 0
+    ),
+    ranked AS (
+        SELECT user_id, category, total,
+               SUM(total) OVER (PARTITION BY user_id) AS user_total,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY total DESC, category) AS rank
+        FROM per_category
+    )
+    SELECT u.user_id, u.first_name, r.user_total, r.category, r.total, r.rank
+    FROM users u
+    LEFT JOIN ranked r ON r.user_id = u.user_id AND r.rank <= %(top)s
+    ORDER BY u.user_id, r.rank
+'''
+# Очередная пачка утренних отчётов: берём тех, у кого по их времени наступил час
+# отчёта и кого не держит другой рассыльщик, ставим аренду report_lease_until
+# (SKIP LOCKED - параллельный процесс возьмёт других) и возвращаем топ категорий
+# за их местное «вчера». next_report_at переносится только после отправки
+# (SQL_COMPLETE_REPORTS); если процесс упал, отчёт снова возьмут, когда аренда истечёт.
+# slot - местная дата последнего наступившего времени отчёта: после простоя бота
+# отчёт уходит один, за настоящее вчера, а не за каждый пропущенный день.
+SQL_CLAIM_DUE_REPORTS = '''
+    WITH due AS (
+        SELECT user_id,
+               ((now() AT TIME ZONE timezone) - report_time::interval)::date AS slot
+        FROM users
+        WHERE next_report_at <= now()
+          AND (report_lease_until IS NULL OR report_lease_until <= now())
+        ORDER BY next_report_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    claimed AS (
+        UPDATE users u
+        SET report_lease_until = now() + make_interval(secs => %(lease)s)
+        FROM due
+        WHERE u.user_id = due.user_id
+        RETURNING u.user_id, u.first_name, due.slot - 1 AS day
+    ),
+    per_category AS (
+        SELECT c.user_id, t.category, t.total
+        FROM claimed c
+        JOIN daily_category_totals t ON t.user_id = c.user_id AND t.day = c.day
+        WHERE t.count > 0
+    ),
+    ranked AS (
+        SELECT user_id, category, total,
+               SUM(total) OVER (PARTITION BY user_id) AS user_total,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY total DESC, category) AS rank
+        FROM per_category
+    )
+    SELECT c.user_id, c.first_name, c.day, r.user_total, r.category, r.total
+    FROM claimed c
+    LEFT JOIN ranked r ON r.user_id = c.user_id AND r.rank <= %(top)s
+    ORDER BY c.user_id, r.rank
+'''
+# Отчёт за day ушёл (или повтор не поможет) - следующий на местное послезавтра от day,
+# то есть завтра от слота; назад next_report_at не двигается
+SQL_COMPLETE_REPORTS = '''
+    UPDATE users u
+    SET next_report_at = GREATEST(u.next_report_at, ((d.day + 2) + u.report_time) AT TIME ZONE u.timezone),
+        report_lease_until = NULL,
+        report_failures = 0
+    FROM unnest(%s::bigint[], %s::date[]) AS d(user_id, day)
+    WHERE u.user_id = d.user_id
+'''
+# Временная ошибка отправки: снимаем аренду, отчёт возьмёт следующий тик. После
+# %(max_failures)s таких тиков подряд отчёт за этот день пропускаем, как отправленный
+SQL_RELEASE_REPORTS = '''
+    UPDATE users u
+    SET next_report_at = CASE WHEN u.report_failures + 1 >= %(max_failures)s
+                              THEN GREATEST(u.next_report_at, ((d.day + 2) + u.report_time) AT TIME ZONE u.timezone)
+                              ELSE u.next_report_at END,
+        report_failures = CASE WHEN u.report_failures + 1 >= %(max_failures)s THEN 0 ELSE u.report_failures + 1 END,
+        report_lease_until = NULL
+    FROM unnest(%(user_ids)s::bigint[], %(days)s::date[]) AS d(user_id, day)
+    WHERE u.user_id = d.user_id
+    RETURNING u.user_id, u.report_failures = 0 AS skipped
+'''
+SQL_USER_SCHEDULE = '''
+    SELECT timezone, report_time, next_report_at,
+           EXTRACT(EPOCH FROM (now() AT TIME ZONE timezone) - (now() AT TIME ZONE 'UTC'))::int AS utc_offset
+    FROM users
+    WHERE user_id = %s
+'''
+# Следующий отчёт - на день позже последнего отправленного (next_report_at - 1 день),
+# считая по новому поясу: сегодняшний отчёт не придёт дважды и не потеряется
+SQL_UPDATE_USER_SCHEDULE = '''
+    UPDATE users
+    SET timezone = %(timezone)s,
+        report_time = %(report_time)s,
+        next_report_at = ((((next_report_at - interval '1 day') AT TIME ZONE %(timezone)s)::date + 1)
+                          + %(report_time)s::time) AT TIME ZONE %(timezone)s
+    WHERE user_id = %(user_id)s
+'''
+# Точное имя пояса из базы часовых поясов Postgres (регистр в запросе не важен)
+SQL_FIND_TIMEZONE = '''
+    SELECT name FROM pg_timezone_names
+    WHERE lower(name) = lower(%s)
+    ORDER BY name = %s DESC
+    LIMIT 1
+'''
+# Сумма трат за день по каждому пользователю - для предотрисовки картинок кофе
+# day_over: у пользователя этот день уже закончился (западнее МСК в 8:30 он ещё идёт)
+SQL_DAILY_TOTALS = '''
+    SELECT t.user_id, SUM(t.total) AS total,
+           (now() AT TIME ZONE u.timezone)::date > t.day AS day_over
+    FROM daily_category_totals t
+    JOIN users u ON u.user_id = t.user_id
+    WHERE t.day = %s AND t.count > 0
+    GROUP BY t.user_id, t.day, u.timezone
+'''
+SQL_GET_COFFEE_FILE_ID = 'SELECT file_id FROM coffee_file_ids WHERE cache_key = %s'
+SQL_SAVE_COFFEE_FILE_ID = '''
+    INSERT INTO coffee_file_ids (cache_key, file_id)
+    VALUES (%s, %s)
+    ON CONFLICT (cache_key) DO NOTHING
+'''
+SQL_SAVE_COFFEE_SHARE = '''
+    INSERT INTO coffee_shares (user_id, file_id, caption, updated_at)
+    VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id)
+    DO UPDATE SET file_id = EXCLUDED.file_id, caption = EXCLUDED.caption, updated_at = EXCLUDED.updated_at
+'''
+SQL_LOAD_COFFEE_SHARES = '''
+    SELECT user_id, file_id, caption
+    FROM coffee_shares
+    WHERE updated_at >= CURRENT_TIMESTAMP - make_interval(secs => %s)
+    ORDER BY updated_at DESC
+    LIMIT %s
+'''
+# Персистентность бота: user_data и состояния диалогов одного пользователя одним запросом
+SQL_LOAD_PERSISTED_USER = '''
+    SELECT NULL AS name, NULL AS conv_key, data FROM bot_user_data WHERE user_id = %(user_id)s
+    UNION ALL
+    SELECT name, conv_key, state FROM bot_conversations WHERE user_id = %(user_id)s
+'''
+SQL_SAVE_PERSISTED_USER_DATA = '''
+    INSERT INTO bot_user_data (user_id, data, updated_at)
+    SELECT *, CURRENT_TIMESTAMP FROM unnest(%s::bigint[], %s::bytea[])
+    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+'''
+SQL_DROP_PERSISTED_USER_DATA = 'DELETE FROM bot_user_data WHERE user_id = ANY(%s)'
+SQL_SAVE_PERSISTED_CONVERSATIONS = '''
+    INSERT INTO bot_conversations (name, conv_key, user_id, state, updated_at)
+    SELECT *, CURRENT_TIMESTAMP FROM unnest(%s::text[], %s::text[], %s::bigint[], %s::bytea[])
+    ON CONFLICT (name, conv_key) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+'''
+SQL_DROP_PERSISTED_CONVERSATIONS = '''
+    DELETE FROM bot_conversations AS c
+    USING unnest(%s::text[], %s::text[]) AS d(name, conv_key)
+    WHERE c.name = d.name AND c.conv_key = d.conv_key
+'''
+# Сколько строк за раз тянуть из серверного курсора при рассылке
+REPORT_FETCH_SIZE = int(os.environ.get("REPORT_FETCH_SIZE", 2000))
+# Аренда забранных отчётов, сек: должна быть дольше рассылки одной пачки
+REPORT_LEASE_SECONDS = int(os.environ.get("REPORT_LEASE_SECONDS", 900))
+# Сколько тиков подряд отчёт может упасть с временной ошибкой, прежде чем его пропустят
+REPORT_MAX_FAILURES = int(os.environ.get("REPORT_MAX_FAILURES", 5))
+
 def get_db_connection():
     """Подключение к PostgreSQL"""
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
-def init_database():
-    """Инициализация таблиц в PostgreSQL"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username VARCHAR(255),
-            first_name VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица трат
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS expenses (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            amount DECIMAL(10, 2) NOT NULL,
-            category VARCHAR(255) NOT NULL,
-            date VARCHAR(10) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
-    logger.info("✅ База данных PostgreSQL инициализирована")
+    db_connections_opened.inc(kind="direct")
+    return psycopg.connect(DATABASE_URL, row_factory=dict_row, **sync_connection_kwargs())
+def _stats_since(days, today=None):
+    """Дата начала периода для статистики за N дней (today - местная дата пользователя)"""
+    return (today or datetime.now().date()) - timedelta(days=days)
+def _build_stats(categories):
+    """Собирает словарь статистики из строк category/total"""
+    if categories:
+        total = sum(cat['total'] for cat in categories)
+        return {
+            'has_data': True,
+            'total': float(total),
+            'categories': [
+                {'category': cat['category'], 'total': float(cat['total'])}
+                for cat in categories
+            ]
+        }
+    else:
+        return {
+            'has_data': False,
+            'total': 0,
+            'categories': []
+        }
+@timed_query
 def add_or_update_user(user_id, username, first_name):
-    """Добавляет или обновляет пользователя"""
+    """Добавляет или обновляет пользователя (в БД пишем, только если профиль изменился)"""
+    if known_users.get(user_id) == (username, first_name):
+        return
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        INSERT INTO users (user_id, username, first_name)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (user_id) 
-        DO UPDATE SET username = %s, first_name = %s
-    ''', (user_id, username, first_name, username, first_name))
+    cursor.execute(SQL_UPSERT_USER, (user_id, username, first_name))
     
     conn.commit()
     cursor.close()
     conn.close()
+    known_users.set(user_id, (username, first_name))
+@timed_query
 def get_all_users():
     """Возвращает список всех пользователей"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT user_id, username, first_name FROM users')
+    cursor.execute(SQL_ALL_USERS)
     users = cursor.fetchall()
     
     cursor.close()
     conn.close()
     return users
+@timed_query
 def save_expense(user_id, amount, category, date):
     """Сохраняет трату в базу"""
     try:
@@ -75,21 +434,19 @@ def save_expense(user_id, amount, category, date):
         cursor = conn.cursor()
         
         # ✅ Убедимся, что пользователь существует (на случай если не вызывался /start)
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-        ''', (user_id, 'unknown', 'Unknown'))
+        known = user_id in known_users
+        if not known:
+            cursor.execute(SQL_ENSURE_USER, (user_id, 'unknown', 'Unknown'))
         
         # Сохраняем трату
-        cursor.execute('''
-            INSERT INTO expenses (user_id, amount, category, date)
-            VALUES (%s, %s, %s, %s)
-        ''', (user_id, amount, category, date))
+        cursor.execute(SQL_INSERT_EXPENSE, (user_id, amount, category, date))
         
         conn.commit()
         cursor.close()
         conn.close()
+        if not known:
+            known_users.set(user_id, None)
+        read_cache.invalidate_user(user_id)
         
         logger.info(f"💰 Расход сохранен: user={user_id}, amount={amount}, category={category}")
         return True
@@ -99,97 +456,51 @@ def save_expense(user_id, amount, category, date):
         logger.exception("Полный traceback:")
         return False
         
+@timed_query
 def get_user_stats(user_id, days=1):
     """Статистика пользователя за N дней"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    from datetime import datetime, timedelta
-    # 👇 ИЗМЕНЕНО: теперь дата в формате ISO
-    target_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-    
-    cursor.execute('''
-        SELECT category, SUM(amount) as total
-        FROM expenses
-        WHERE user_id = %s AND date >= %s
-        GROUP BY category
-        ORDER BY total DESC
-    ''', (user_id, target_date))
+    cursor.execute(SQL_USER_STATS, (user_id, _stats_since(days)))
     
     categories = cursor.fetchall()
     cursor.close()
     conn.close()
     
-    if categories:
-        total = sum(cat['total'] for cat in categories)
-        return {
-            'has_data': True,
-            'total': float(total),
-            'categories': [
-                {'category': cat['category'], 'total': float(cat['total'])}
-                for cat in categories
-            ]
-        }
-    else:
-        return {
-            'has_data': False,
-            'total': 0,
-            'categories': []
-        }
-def get_user_operations(user_id: int, limit: int = 30) -> list:
-    """Последние операции пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT date, category, amount 
-        FROM expenses 
-        WHERE user_id = %s 
-        ORDER BY id DESC 
-        LIMIT %s
-    ''', (user_id, limit))
-    
-    operations = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    
-    return operations
+    return _build_stats(categories)
 
+@timed_query
 def get_user_operations(user_id: int, limit: int = 30) -> list:
     """Последние операции пользователя с ID записей"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT id, date, category, amount 
-        FROM expenses 
-        WHERE user_id = %s 
-        ORDER BY id DESC 
-        LIMIT %s
-    ''', (user_id, limit))
+    cursor.execute(SQL_USER_OPERATIONS, (user_id, limit))
     
     operations = cursor.fetchall()
     cursor.close()
     conn.close()
     
     return operations
+@timed_query
 def delete_expense(expense_id: int) -> bool:
     """Удаляет трату по ID"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            DELETE FROM expenses 
-            WHERE id = %s
-        ''', (expense_id,))
+        cursor.execute(SQL_DELETE_EXPENSE, (expense_id,))
+        deleted = cursor.fetchone()
+        if deleted:
+            cursor.execute(SQL_CLEANUP_TOTALS, (deleted['user_id'], deleted['date'], deleted['category']))
         
         conn.commit()
-        deleted_count = cursor.rowcount
         cursor.close()
         conn.close()
         
-        if deleted_count > 0:
+        if deleted:
+            read_cache.invalidate_user(deleted['user_id'])
             logger.info(f"🗑️ Трата удалена: id={expense_id}")
             return True
         else:
@@ -199,19 +510,568 @@ def delete_expense(expense_id: int) -> bool:
     except Exception as e:
         logger.error(f"❌ Ошибка удаления траты: {type(e).__name__}: {e}")
         return False
+@timed_query
 def get_expense_by_id(expense_id: int):
     """Получает трату по ID (опционально, для доп. проверок)"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT id, user_id, date, category, amount 
-        FROM expenses 
-        WHERE id = %s
-    ''', (expense_id,))
+    cursor.execute(SQL_EXPENSE_BY_ID, (expense_id,))
     
     expense = cursor.fetchone()
     cursor.close()
     conn.close()
     
     return expense
+@timed_query
+def rebuild_daily_totals(user_id: int = None) -> int:
+    """Пересчитывает daily_category_totals из expenses (для всех или одного пользователя)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # SHARE-блокировка не даёт писать траты, пока агрегат пересобирается
+    cursor.execute('LOCK TABLE expenses IN SHARE MODE')
+    cursor.execute(SQL_REBUILD_TOTALS_DELETE, {'user_id': user_id})
+    cursor.execute(SQL_REBUILD_TOTALS_INSERT, {'user_id': user_id})
+    rows = cursor.rowcount
+    
+    conn.commit()
+    cursor.close()
+    conn.close()
+    logger.info(f"🔁 Агрегаты пересчитаны: строк={rows}, user={user_id or 'все'}")
+    return rows
+
+# ==================== ASYNC-ПУЛ ====================
+# Асинхронные версии функций выше. Соединения берутся из общего пула,
+# поэтому обработчики бота не блокируют event loop и не открывают
+# новое TCP-соединение на каждое нажатие кнопки.
+
+async def _on_pool_connect(conn):
+    """Вызывается пулом для каждого нового соединения"""
+    db_connections_opened.inc(kind="pool")
+async def open_pool():
+    """Открывает асинхронный пул соединений (вызывается при старте бота)"""
+    global _pool
+    if _pool is not None:
+        return _pool
+    _pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        kwargs={'row_factory': dict_row, **connection_kwargs()},
+        # Проверяем соединение перед выдачей, чтобы не отдать «мёртвое» после рестарта БД
+        check=AsyncConnectionPool.check_connection,
+        configure=_on_pool_connect,
+        name="tratyallday",
+        open=False,
+    )
+    await _pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logger.info(f"✅ Пул соединений открыт: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}")
+    return _pool
+async def close_pool():
+    """Закрывает пул соединений"""
+    global _pool
+    if _pool is None:
+        return
+    await _pool.close()
+    _pool = None
+    logger.info("🔌 Пул соединений закрыт")
+async def start_cache_listener():
+    """Запускает фоновую задачу, сбрасывающую read_cache по NOTIFY (вызывается при старте бота)"""
+    global _cache_listener
+    if _cache_listener is None and STATS_CACHE_TTL:
+        _cache_listener = asyncio.get_running_loop().create_task(_listen_read_cache())
+async def stop_cache_listener():
+    """Останавливает слушателя NOTIFY"""
+    global _cache_listener
+    if _cache_listener is None:
+        return
+    task, _cache_listener = _cache_listener, None
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+async def _listen_read_cache():
+    """Отдельное соединение (не из пула): LISTEN держит его всё время работы"""
+    delay = 1.0
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                await conn.execute(f'LISTEN {READ_CACHE_CHANNEL}')
+                # Пока никто не слушал, уведомления терялись - доверять кэшу нельзя
+                read_cache.clear()
+                delay = 1.0
+                logger.info("👂 Слушаю сброс кэша чтений от других процессов")
+                async for notify in conn.notifies():
+                    read_cache.invalidate_user(int(notify.payload))
+        except Exception as e:
+            logger.error(f"❌ Слушатель сброса кэша отключился: {type(e).__name__}: {e}")
+        read_cache.clear()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, CACHE_LISTENER_RETRY_MAX)
+def get_pool() -> AsyncConnectionPool:
+    """Возвращает открытый пул (ошибка, если open_pool ещё не вызывался)"""
+    if _pool is None:
+        raise RuntimeError("❌ Пул соединений не открыт, вызовите open_pool()")
+    return _pool
+@asynccontextmanager
+async def transaction():
+    """
+    Единица работы: все запросы *_async внутри блока идут через одно соединение
+    пула и фиксируются одним COMMIT, а при исключении откатываются все вместе
+
+        async with transaction():
+            await add_or_update_user_async(user.id, user.username, user.first_name)
+            await update_user_schedule_async(user.id, report_time=report_time)
+
+    Вложенный блок - SAVEPOINT в той же транзакции. Кэши (чтений, известных
+    пользователей, расписаний) обновляются только после COMMIT, а чтения внутри
+    блока идут мимо кэша. Траты через expense_writer пишутся его фоновой
+    задачей - в транзакцию они не попадают.
+    """
+    uow = _current_uow()
+    if uow is not None:
+        async with uow['conn'].transaction():
+            yield uow['conn']
+        return
+    async with get_pool().connection() as conn:
+        uow = {'conn': conn, 'users': set(), 'on_commit': [], 'closed': False}
+        token = _unit_of_work.set(uow)
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            uow['closed'] = True
+            _unit_of_work.reset(token)
+    for user_id in uow['users']:
+        read_cache.invalidate_user(user_id)
+    for callback, args in uow['on_commit']:
+        callback(*args)
+def _current_uow():
+    """Открытая transaction() (задача, созданная внутри блока и пережившая его, её уже не видит)"""
+    uow = _unit_of_work.get()
+    if uow is None or uow['closed']:
+        return None
+    return uow
+@asynccontextmanager
+async def _connection():
+    """Соединение открытой transaction() или своё из пула (тогда каждый вызов - своя транзакция)"""
+    uow = _current_uow()
+    if uow is not None:
+        yield uow['conn']
+        return
+    async with get_pool().connection() as conn:
+        yield conn
+def _invalidate_user(user_id: int):
+    """Сброс кэша чтений пользователя; внутри transaction() - после её COMMIT"""
+    uow = _current_uow()
+    if uow is not None:
+        uow['users'].add(user_id)
+    else:
+        read_cache.invalidate_user(user_id)
+def _after_commit(callback, *args):
+    """Вызывает callback сразу или, внутри transaction(), после её COMMIT"""
+    uow = _current_uow()
+    if uow is not None:
+        uow['on_commit'].append((callback, args))
+    else:
+        callback(*args)
+async def _cached(user_id: int, key, load):
+    """Чтение через read_cache; внутри transaction() - мимо кэша (данные могут быть не зафиксированы)"""
+    if _current_uow() is not None:
+        return await load()
+    return await read_cache.get_or_load(user_id, key, load)
+@timed_query
+async def add_or_update_user_async(user_id, username, first_name):
+    """Добавляет или обновляет пользователя (async, только если профиль изменился)"""
+    if known_users.get(user_id) == (username, first_name):
+        return
+    async with _connection() as conn:
+        await conn.execute(SQL_UPSERT_USER, (user_id, username, first_name))
+    _after_commit(known_users.set, user_id, (username, first_name))
+@timed_query
+async def get_all_users_async():
+    """Возвращает список всех пользователей (async)"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_ALL_USERS)
+        return await cursor.fetchall()
+@timed_query
+async def save_expense_async(user_id, amount, category, date):
+    """Сохраняет трату в базу (async)"""
+    try:
+        logger.info(f"📝 Попытка сохранения: user={user_id}, amount={amount}, category={category}, date={date}")
+        # Блок connection() сам делает commit при выходе (или rollback при ошибке)
+        try:
+            known = user_id in known_users
+            async with _connection() as conn:
+                if not known:
+                    await conn.execute(SQL_ENSURE_USER, (user_id, 'unknown', 'Unknown'))
+                await conn.execute(SQL_INSERT_EXPENSE, (user_id, amount, category, date))
+            if not known:
+                _after_commit(known_users.set, user_id, None)
+        finally:
+            _invalidate_user(user_id)
+        logger.info(f"💰 Расход сохранен: user={user_id}, amount={amount}, category={category}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения: {type(e).__name__}: {e}")
+        logger.exception("Полный traceback:")
+        if _current_uow() is not None:
+            # Транзакция уже прервана - пусть откатится целиком
+            raise
+        return False
+@timed_query
+async def save_expenses_batch_async(expenses: list):
+    """
+    Сохраняет пачку трат [(user_id, amount, category, date), ...] одной транзакцией
+
+    В отличие от save_expense_async ошибки не глотаются: вызывающий сам решает,
+    что делать с пачкой.
+    """
+    user_ids, amounts, categories, dates = (list(column) for column in zip(*expenses))
+    # psycopg не умеет массивы из смешанных типов (float/int, str/date) - приводим к одному
+    amounts = [Decimal(str(amount)) for amount in amounts]
+    dates = [str(date) for date in dates]
+    unknown = [user_id for user_id in set(user_ids) if user_id not in known_users]
+    try:
+        async with _connection() as conn:
+            if unknown:
+                await conn.execute(SQL_ENSURE_USERS_BATCH, (unknown,))
+            await conn.execute(SQL_INSERT_EXPENSES_BATCH, (user_ids, amounts, categories, dates))
+        for user_id in unknown:
+            _after_commit(known_users.set, user_id, None)
+    finally:
+        for user_id in set(user_ids):
+            _invalidate_user(user_id)
+    logger.info(f"💰 Пачка трат сохранена: {len(expenses)} шт.")
+@timed_query
+async def get_user_stats_async(user_id, days=1, today=None):
+    """Статистика пользователя за N дней (async, через кэш)"""
+    since = _stats_since(days, today)
+    async def load():
+        async with _connection() as conn:
+            cursor = await conn.execute(SQL_USER_STATS, (user_id, since))
+            categories = await cursor.fetchall()
+        return _build_stats(categories)
+    return await _cached(user_id, ('stats', since), load)
+@timed_query
+async def get_user_operations_async(user_id: int, limit: int = 30) -> list:
+    """Последние операции пользователя с ID записей (async, через кэш)"""
+    async def load():
+        async with _connection() as conn:
+            cursor = await conn.execute(SQL_USER_OPERATIONS, (user_id, limit))
+            return await cursor.fetchall()
+    return await _cached(user_id, ('operations', limit), load)
+@timed_query
+async def get_period_stats_async(user_id: int, start, end, prev_start=None, prev_end=None) -> dict:
+    """
+    Статистика за период [start, end] со сравнением (async, через кэш)
+
+    Сравниваемый период по умолчанию - столько же дней сразу перед start.
+    Возвращает has_data, total, prev_total, categories (category, total,
+    prev_total; по убыванию total) и days - сумма за каждый день периода,
+    включая дни без трат.
+    """
+    if prev_start is None:
+        prev_end = start - timedelta(days=1)
+        prev_start = prev_end - (end - start)
+    params = {'user_id': user_id, 'start': start, 'end': end, 'prev_start': prev_start, 'prev_end': prev_end}
+    async def load():
+        async with _connection() as conn:
+            cursor = await conn.execute(SQL_PERIOD_STATS, params)
+            rows = await cursor.fetchall()
+        totals = {'total': 0.0, 'prev_total': 0.0}
+        categories = []
+        by_day = {}
+        for row in rows:
+            total = float(row['total'] or 0)
+            if row['level'] == 3:
+                totals = {'total': total, 'prev_total': float(row['prev_total'] or 0)}
+            elif row['level'] == 1:
+                categories.append({'category': row['category'], 'total': total, 'prev_total': float(row['prev_total'] or 0)})
+            elif row['total'] is not None:
+                by_day[row['day']] = total
+        categories.sort(key=lambda cat: (-cat['total'], cat['category']))
+        days = [
+            {'day': start + timedelta(days=i), 'total': by_day.get(start + timedelta(days=i), 0.0)}
+            for i in range((end - start).days + 1)
+        ]
+        return {
+            'start': start, 'end': end, 'prev_start': prev_start, 'prev_end': prev_end,
+            'has_data': totals['total'] > 0,
+            **totals,
+            'categories': categories,
+            'days': days,
+        }
+    return await _cached(user_id, ('period', start, end, prev_start, prev_end), load)
+@timed_query
+async def get_user_operations_page_async(user_id: int, limit: int = 10, before: int = None, after: int = None) -> dict:
+    """
+    Страница операций пользователя (новые сверху, async, через кэш)
+
+    before - id, старше которого показать (кнопка «старее»), after - id,
+    новее которого (кнопка «новее»); без них - самые свежие. Возвращает
+    operations и флаги has_older / has_newer для кнопок навигации.
+    """
+    async def load():
+        async with _connection() as conn:
+            if after is not None:
+                cursor = await conn.execute(SQL_USER_OPERATIONS_AFTER, (user_id, after, limit + 1))
+                rows = await cursor.fetchall()
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    rows.reverse()
+                    return {'operations': rows, 'has_older': True, 'has_newer': True}
+                # Дошли до самых свежих - отдаём полную первую страницу
+            if before is not None:
+                cursor = await conn.execute(SQL_USER_OPERATIONS_BEFORE, (user_id, before, limit + 1))
+            else:
+                cursor = await conn.execute(SQL_USER_OPERATIONS, (user_id, limit + 1))
+            rows = await cursor.fetchall()
+        return {'operations': rows[:limit], 'has_older': len(rows) > limit, 'has_newer': before is not None}
+    return await _cached(user_id, ('operations_page', limit, before, after), load)
+@timed_query
+async def delete_expense_async(expense_id: int) -> bool:
+    """Удаляет трату по ID (async)"""
+    try:
+        async with _connection() as conn:
+            cursor = await conn.execute(SQL_DELETE_EXPENSE, (expense_id,))
+            deleted = await cursor.fetchone()
+            if deleted:
+                await conn.execute(SQL_CLEANUP_TOTALS, (deleted['user_id'], deleted['date'], deleted['category']))
+        if deleted:
+            _invalidate_user(deleted['user_id'])
+            logger.info(f"🗑️ Трата удалена: id={expense_id}")
+            return True
+        else:
+            logger.warning(f"⚠️ Трата не найдена: id={expense_id}")
+            return False
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления траты: {type(e).__name__}: {e}")
+        if _current_uow() is not None:
+            # Транзакция уже прервана - пусть откатится целиком
+            raise
+        return False
+@timed_query
+async def update_expense_async(user_id: int, expense_id: int, amount: float, category: str):
+    """
+    Перезаписывает сумму и категорию траты пользователя (async, один запрос)
+
+    id и дата траты не меняются. Возвращает обновлённую строку (id, user_id,
+    date, category, amount) или None, если трата не найдена или не его.
+    """
+    params = {'id': expense_id, 'user_id': user_id, 'amount': amount, 'category': category}
+    try:
+        async with _connection() as conn:
+            cursor = await conn.execute(SQL_UPDATE_EXPENSE, params)
+            updated = await cursor.fetchone()
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления траты: {type(e).__name__}: {e}")
+        if _current_uow() is not None:
+            raise
+        return None
+    if updated:
+        _invalidate_user(user_id)
+        logger.info(f"✏️ Трата обновлена: id={expense_id}, {amount} руб., {category}")
+    else:
+        logger.warning(f"⚠️ Трата не найдена: id={expense_id}, user={user_id}")
+    return updated
+@timed_query
+async def get_expense_by_id_async(expense_id: int):
+    """Получает трату по ID (async)"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_EXPENSE_BY_ID, (expense_id,))
+        return await cursor.fetchone()
+@timed_query
+async def iter_daily_reports_async(day, top=3):
+    """
+    Отчёты всех пользователей за день одним запросом (вместо get_user_stats на каждого)
+
+    Строки читаются серверным курсором порциями, поэтому память не растёт
+    с числом пользователей. Для каждого пользователя отдаётся словарь
+    user_id, first_name + поля как у get_user_stats (has_data, total, categories)
+    с топ-N категорий.
+    """
+    async with _connection() as conn:
+        cursor = conn.cursor(name="daily_report")
+        cursor.itersize = REPORT_FETCH_SIZE
+        await cursor.execute(SQL_DAILY_REPORT, {'day': day, 'top': top})
+        report = None
+        async for row in cursor:
+            if report is None or report['user_id'] != row['user_id']:
+                if report is not None:
+                    yield report
+                report = {
+                    'user_id': row['user_id'],
+                    'first_name': row['first_name'],
+                    'has_data': row['user_total'] is not None,
+                    'total': float(row['user_total'] or 0),
+                    'categories': []
+                }
+            if row['category'] is not None:
+                report['categories'].append({'category': row['category'], 'total': float(row['total'])})
+        if report is not None:
+            yield report
+        await cursor.close()
+@timed_query
+async def claim_due_reports_async(limit: int, top=3, lease: int = REPORT_LEASE_SECONDS) -> list:
+    """
+    Забирает до limit отчётов, время которых по часам пользователя наступило
+
+    Один запрос: отбор, аренда на lease секунд и топ-N категорий за местное
+    «вчера» каждого. Пока аренда не истекла, второй процесс (бот и
+    daily_report.py) этих пользователей не возьмёт. После рассылки вызовите
+    finish_reports_async, иначе отчёты уйдут повторно по истечении аренды.
+    Словари как у iter_daily_reports_async плюс day - за какую дату отчёт.
+    """
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_CLAIM_DUE_REPORTS, {'limit': limit, 'top': top, 'lease': lease})
+        rows = await cursor.fetchall()
+    reports = []
+    for row in rows:
+        if not reports or reports[-1]['user_id'] != row['user_id']:
+            reports.append({
+                'user_id': row['user_id'],
+                'first_name': row['first_name'],
+                'day': row['day'],
+                'has_data': row['user_total'] is not None,
+                'total': float(row['user_total'] or 0),
+                'categories': []
+            })
+        if row['category'] is not None:
+            reports[-1]['categories'].append({'category': row['category'], 'total': float(row['total'])})
+    return reports
+@timed_query
+async def finish_reports_async(done: list, retry: list):
+    """
+    Закрывает забранные отчёты: done - [(user_id, day)] отправленные (или с
+    постоянной ошибкой), им next_report_at переносится на следующий день;
+    retry - [(user_id, day)] с временной ошибкой, их аренда снимается, а после
+    REPORT_MAX_FAILURES неудачных тиков подряд отчёт за day пропускается
+    """
+    if not done and not retry:
+        return
+    async with _connection() as conn:
+        if done:
+            user_ids, days = (list(column) for column in zip(*done))
+            await conn.execute(SQL_COMPLETE_REPORTS, (user_ids, days))
+        if retry:
+            user_ids, days = (list(column) for column in zip(*retry))
+            cursor = await conn.execute(SQL_RELEASE_REPORTS, {
+                'user_ids': user_ids, 'days': days, 'max_failures': REPORT_MAX_FAILURES,
+            })
+            skipped = [row['user_id'] for row in await cursor.fetchall() if row['skipped']]
+            if skipped:
+                logger.warning(f"⚠️ Отчёт пропущен после {REPORT_MAX_FAILURES} неудачных попыток: {skipped}")
+@timed_query
+async def get_user_schedule_async(user_id: int):
+    """Часовой пояс, время отчёта и смещение от UTC в секундах (None, если пользователя нет)"""
+    schedule = user_schedules.get(user_id)
+    if schedule is not None:
+        return schedule
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_USER_SCHEDULE, (user_id,))
+        schedule = await cursor.fetchone()
+    if schedule is not None:
+        _after_commit(user_schedules.set, user_id, schedule)
+    return schedule
+@timed_query
+async def find_timezone_async(name: str):
+    """Каноническое имя часового пояса (Europe/Moscow) или None, если такого нет"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_FIND_TIMEZONE, (name, name))
+        row = await cursor.fetchone()
+    return row['name'] if row else None
+@timed_query
+async def update_user_schedule_async(user_id: int, timezone: str = None, report_time=None):
+    """Меняет пояс и/или время отчёта; возвращает новое расписание (None, если пользователя нет)"""
+    current = await get_user_schedule_async(user_id)
+    if current is None:
+        return None
+    params = {
+        'user_id': user_id,
+        'timezone': timezone or current['timezone'],
+        'report_time': current['report_time'] if report_time is None else report_time,
+    }
+    async with _connection() as conn:
+        await conn.execute(SQL_UPDATE_USER_SCHEDULE, params)
+    user_schedules.pop(user_id)
+    return await get_user_schedule_async(user_id)
+@timed_query
+async def get_daily_totals_async(day) -> list:
+    """
+    [(user_id, сумма за день, день закончился)] для всех, у кого в этот день
+    были траты; третье поле - прошла ли полночь после day по часам пользователя
+    """
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_DAILY_TOTALS, (day,))
+        return [(row['user_id'], float(row['total']), row['day_over']) for row in await cursor.fetchall()]
+@timed_query
+async def get_coffee_file_id_async(cache_key: str):
+    """file_id уже загруженной в Telegram картинки кофе (или None)"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_GET_COFFEE_FILE_ID, (cache_key,))
+        row = await cursor.fetchone()
+    return row['file_id'] if row else None
+@timed_query
+async def save_coffee_file_id_async(cache_key: str, file_id: str):
+    """Запоминает file_id картинки кофе (первый сохранённый выигрывает)"""
+    async with _connection() as conn:
+        await conn.execute(SQL_SAVE_COFFEE_FILE_ID, (cache_key, file_id))
+@timed_query
+async def save_coffee_share_async(user_id: int, file_id: str, caption: str):
+    """Запоминает последнюю картинку кофе пользователя"""
+    async with _connection() as conn:
+        await conn.execute(SQL_SAVE_COFFEE_SHARE, (user_id, file_id, caption))
+@timed_query
+async def load_coffee_shares_async(max_age_seconds: int, limit: int) -> list:
+    """Свежие картинки для шеринга, от новых к старым"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_LOAD_COFFEE_SHARES, (max_age_seconds, limit))
+        return await cursor.fetchall()
+@timed_query
+async def rebuild_daily_totals_async(user_id: int = None) -> int:
+    """Пересчитывает daily_category_totals из expenses (async)"""
+    async with _connection() as conn:
+        # SHARE-блокировка не даёт писать траты, пока агрегат пересобирается
+        await conn.execute('LOCK TABLE expenses IN SHARE MODE')
+        await conn.execute(SQL_REBUILD_TOTALS_DELETE, {'user_id': user_id})
+        cursor = await conn.execute(SQL_REBUILD_TOTALS_INSERT, {'user_id': user_id})
+        rows = cursor.rowcount
+    if user_id is None:
+        _after_commit(read_cache.clear)
+    else:
+        _invalidate_user(user_id)
+    logger.info(f"🔁 Агрегаты пересчитаны: строк={rows}, user={user_id or 'все'}")
+    return rows
+@timed_query
+async def load_persisted_user_async(user_id: int) -> list:
+    """Сохранённые user_data (name IS NULL) и состояния диалогов пользователя"""
+    async with _connection() as conn:
+        cursor = await conn.execute(SQL_LOAD_PERSISTED_USER, {'user_id': user_id})
+        return await cursor.fetchall()
+@timed_query
+async def save_persisted_batch_async(user_data: dict, dropped_users: list, conversations: dict):
+    """
+    Пишет накопленные изменения персистентности одной транзакцией
+
+    user_data: {user_id: bytes}; conversations: {(name, conv_key): (user_id, bytes | None)},
+    где None - диалог завершён и строку нужно удалить.
+    """
+    saved = {key: value for key, value in conversations.items() if value[1] is not None}
+    ended = [key for key, value in conversations.items() if value[1] is None]
+    async with _connection() as conn:
+        if user_data:
+            await conn.execute(SQL_SAVE_PERSISTED_USER_DATA, (list(user_data), list(user_data.values())))
+        if dropped_users:
+            await conn.execute(SQL_DROP_PERSISTED_USER_DATA, (dropped_users,))
+        if saved:
+            names, conv_keys = (list(column) for column in zip(*saved))
+            user_ids, states = (list(column) for column in zip(*saved.values()))
+            await conn.execute(SQL_SAVE_PERSISTED_CONVERSATIONS, (names, conv_keys, user_ids, states))
+        if ended:
+            names, conv_keys = (list(column) for column in zip(*ended))
+            await conn.execute(SQL_DROP_PERSISTED_CONVERSATIONS, (names, conv_keys))
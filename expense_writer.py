@@ -0,0 +1,85 @@
+# expense_writer.py - пакетная (write-behind) запись трат
+import os
+import time
+import asyncio
+import logging
+from database import save_expense_async, save_expenses_batch_async
+logger = logging.getLogger(__name__)
+# 1 - обработчики ставят траты в очередь, фоновая задача пишет их пачками
+EXPENSE_BATCH_MODE = os.environ.get("EXPENSE_BATCH_MODE", "0") == "1"
+EXPENSE_BATCH_SIZE = int(os.environ.get("EXPENSE_BATCH_SIZE", 200))  # сбросить пачку после N строк
+EXPENSE_BATCH_DELAY_MS = int(os.environ.get("EXPENSE_BATCH_DELAY_MS", 50))  # ...или через M мс
+class ExpenseBatchWriter:
+    """
+    Копит траты и пишет их пачкой в одной транзакции
+
+    save() возвращает управление только после коммита своей пачки,
+    поэтому пользователь видит «✅ Запись добавлена» лишь для уже
+    сохранённых трат - надёжность та же, что у save_expense_async.
+    """
+    def __init__(self, enabled=EXPENSE_BATCH_MODE, batch_size=EXPENSE_BATCH_SIZE, delay_ms=EXPENSE_BATCH_DELAY_MS):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.delay = delay_ms / 1000
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.rows = 0
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"📦 Пакетная запись трат: до {self.batch_size} строк / {self.delay * 1000:.0f} мс")
+    async def stop(self):
+        """Дописывает всё, что осталось в очереди, и останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+    async def save(self, user_id, amount, category, date) -> bool:
+        """Сохраняет трату; True - трата закоммичена"""
+        if self._task is None:
+            return await save_expense_async(user_id=user_id, amount=amount, category=category, date=date)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((user_id, amount, category, date), future))
+        return await future
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+    async def _flush(self, batch):
+        expenses = [expense for expense, _ in batch]
+        try:
+            await save_expenses_batch_async(expenses)
+            results = [True] * len(batch)
+        except Exception as e:
+            # Одна плохая строка не должна ронять чужие траты - пишем по одной
+            logger.error(f"❌ Ошибка пакетной записи ({len(batch)} шт.): {type(e).__name__}: {e}")
+            results = []
+            for user_id, amount, category, date in expenses:
+                results.append(await save_expense_async(user_id=user_id, amount=amount, category=category, date=date))
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+expense_writer = ExpenseBatchWriter()
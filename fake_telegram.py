@@ -0,0 +1,186 @@
+# fake_telegram.py - локальный фейковый Bot API для офлайн-прогонов и нагрузочных тестов
+#
+# Бот подключается к нему через TELEGRAM_API_URL=http://127.0.0.1:8081/bot.
+# Апдейты отдаются через getUpdates (polling) или POST-ятся на адрес из setWebhook.
+# Ответы бота (sendMessage, sendPhoto, ...) передаются в on_reply.
+import json
+import time
+import logging
+import threading
+import itertools
+import urllib.request
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+logger = logging.getLogger(__name__)
+BOT_INFO = {'id': 1000000001, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+# Методы, в ответ на которые бот ждёт объект Message
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+def _parse_body(content_type: str, body: bytes) -> dict:
+    """Параметры запроса PTB: JSON, urlencoded или multipart (sendPhoto с файлом)"""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                params[name] = {'filename': part.get_filename(), 'size': len(payload)}
+            else:
+                params[name] = payload.decode('utf-8')
+        return params
+    return {key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()}
+class FakeTelegram:
+    """
+    Фейковый Bot API на стандартной библиотеке
+
+    on_reply(method, params) вызывается из потока HTTP-сервера на каждый
+    запрос бота, кроме служебных (getMe, getUpdates, setWebhook, ...).
+    """
+    def __init__(self, host="127.0.0.1", port=8081, on_reply=None):
+        self.host = host
+        self.port = port
+        self.on_reply = on_reply
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.calls = {}
+        self._updates = []
+        self._cond = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._server = None
+        self._thread = None
+    @property
+    def api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+    def start(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят разными send(): без этого Nagle + delayed ACK дают +40 мс на запрос
+            disable_nagle_algorithm = True
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                params = _parse_body(self.headers.get('Content-Type', ''), body)
+                payload = json.dumps(fake.handle(method, params)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            do_GET = do_POST
+            def log_message(self, *args):
+                pass
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"🧪 Фейковый Bot API: {self.api_url}")
+    def stop(self):
+        if self._server:
+            with self._cond:
+                self._cond.notify_all()
+            self._server.shutdown()
+            self._server.server_close()
+    # ---------- апдейты для бота ----------
+    def push_update(self, update: dict) -> dict:
+        """Ставит апдейт в очередь getUpdates или сразу отправляет на вебхук"""
+        update = dict(update, update_id=next(self._update_ids))
+        if self.webhook_url:
+            self._post_webhook(update)
+        else:
+            with self._cond:
+                self._updates.append(update)
+                self._cond.notify_all()
+        return update
+    def _post_webhook(self, update: dict):
+        headers = {'Content-Type': 'application/json'}
+        if self.webhook_secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook_secret
+        request = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode(), headers=headers)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Подтверждённые (update_id < offset) больше не отдаём
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+    # ---------- методы Bot API ----------
+    def handle(self, method: str, params: dict) -> dict:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return {'ok': True, 'result': BOT_INFO}
+        if method == 'getUpdates':
+            return {'ok': True, 'result': self._get_updates(params)}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            self.webhook_secret = params.get('secret_token')
+            return {'ok': True, 'result': True}
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return {'ok': True, 'result': True}
+        if method == 'getWebhookInfo':
+            return {'ok': True, 'result': {'url': self.webhook_url or '', 'has_custom_certificate': False,
+                                           'pending_update_count': len(self._updates)}}
+        if self.on_reply:
+            self.on_reply(method, params)
+        if method in MESSAGE_METHODS:
+            return {'ok': True, 'result': self._message(method, params)}
+        return {'ok': True, 'result': True}
+    def _message(self, method: str, params: dict) -> dict:
+        chat_id = int(params.get('chat_id') or 0)
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_INFO,
+        }
+        if method == 'sendPhoto':
+            # file_id по отправленному file_id сохраняем, на загрузку файла - выдаём новый
+            photo = params.get('photo')
+            file_id = photo if isinstance(photo, str) else f"fake-photo-{next(self._file_ids)}"
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1000, 'height': 1000}]
+            if params.get('caption'):
+                message['caption'] = params['caption']
+        else:
+            message['text'] = params.get('text', '')
+        return message
+def make_message_update(user_id: int, text: str, first_name: str = "Load") -> dict:
+    """Апдейт с текстовым сообщением пользователя в личке (update_id проставит push_update)"""
+    message = {
+        'message_id': int(time.time() * 1000) % 2_000_000_000,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': first_name},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': first_name, 'username': f"user{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': 0, 'message': message}
+if __name__ == '__main__':
+    # python fake_telegram.py [port] - просто поднять сервер и логировать ответы бота
+    import sys
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    fake = FakeTelegram(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081,
+                        on_reply=lambda method, params: logger.info(f"➡️ {method} {params.get('chat_id')}"))
+    fake.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
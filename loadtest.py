@@ -0,0 +1,221 @@
+# loadtest.py - нагрузочный прогон bot.py против фейкового Bot API и локального Postgres
+#
+#   DATABASE_URL=postgresql://... python loadtest.py --spawn-bot --users 50 --iterations 10 --seed
+#
+# N виртуальных пользователей параллельно проходят настоящие сценарии бота:
+# «💸 Добавить траты» → сумма → категория, /fix, статистика, операции, индекс кофе.
+# Задержка шага - от отправки апдейта до текстового ответа бота этому пользователю.
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from fake_telegram import FakeTelegram, make_message_update
+logger = logging.getLogger(__name__)
+# Виртуальные пользователи живут в отдельном диапазоне id, чтобы не смешиваться с настоящими
+USER_ID_BASE = 9_000_000_000
+# После этих методов бот закончил шаг (фото индекса кофе идёт перед финальным текстом)
+TEXT_METHODS = {'sendMessage', 'editMessageText'}
+SCENARIOS = ['expense', 'expense', 'fix', 'stats', 'operations', 'coffee']
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+def keyboard_buttons(params: dict) -> list:
+    """Тексты кнопок reply-клавиатуры из ответа бота"""
+    markup = params.get('reply_markup')
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    rows = (markup or {}).get('keyboard') or []
+    return [button['text'] if isinstance(button, dict) else button for row in rows for button in row]
+# «📄 Операции» и /fix с кнопками листания отвечают двумя сообщениями - шаг
+# заканчивается последним: с reply-клавиатурой и с просьбой ввести номер траты
+def with_reply_keyboard(params: dict) -> bool:
+    return bool(keyboard_buttons(params))
+def fix_list_done(params: dict) -> bool:
+    text = params.get('text', '')
+    return "💬" in text or text.startswith("📭")
+class LoadTest:
+    def __init__(self, fake: FakeTelegram, timeout: float = 30):
+        self.fake = fake
+        self.timeout = timeout
+        self.latencies = {}
+        self.timeouts = {}
+        self.photos = 0
+        self._inbox = {}
+        self._loop = None
+    def on_reply(self, method, params):
+        """Вызывается из потока фейкового сервера"""
+        try:
+            chat_id = int(params.get('chat_id') or 0)
+        except (TypeError, ValueError):
+            return
+        inbox = self._inbox.get(chat_id)
+        if inbox is not None:
+            self._loop.call_soon_threadsafe(inbox.put_nowait, (method, params))
+    async def step(self, user_id: int, label: str, text: str, until=None) -> dict:
+        """
+        Отправляет сообщение и ждёт текстовый ответ, на котором шаг закончен
+
+        until(params) отличает последнее сообщение шага от промежуточных (по
+        умолчанию подходит любое текстовое). Возвращает его параметры или {}
+        по таймауту.
+        """
+        inbox = self._inbox[user_id]
+        # Хвост прошлого шага (например, после таймаута) не должен засчитаться этому
+        while not inbox.empty():
+            inbox.get_nowait()
+        started = time.perf_counter()
+        await asyncio.to_thread(self.fake.push_update, make_message_update(user_id, text))
+        deadline = started + self.timeout
+        while True:
+            try:
+                method, params = await asyncio.wait_for(inbox.get(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                self.timeouts[label] = self.timeouts.get(label, 0) + 1
+                return {}
+            if method == 'sendPhoto':
+                self.photos += 1
+            if method in TEXT_METHODS and (until is None or until(params)):
+                self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+                return params
+    async def scenario(self, user_id: int, name: str):
+        if name == 'expense':
+            await self.step(user_id, 'expense.begin', "💸 Добавить траты")
+            reply = await self.step(user_id, 'expense.amount', str(random.randint(50, 5000)))
+            await self.step(user_id, 'expense.category', random.choice(keyboard_buttons(reply) or ["🚕 Транспорт"]))
+        elif name == 'fix':
+            reply = await self.step(user_id, 'fix.list', "/fix", until=fix_list_done)
+            if "💬" not in reply.get('text', ''):
+                return
+            reply = await self.step(user_id, 'fix.select', "1")
+            if random.random() < 0.3:
+                await self.step(user_id, 'fix.delete', "🗑️ Удалить")
+                return
+            await self.step(user_id, 'fix.rewrite', "🔄 Перезаписать")
+            reply = await self.step(user_id, 'fix.amount', str(random.randint(50, 5000)))
+            await self.step(user_id, 'fix.category', random.choice(keyboard_buttons(reply) or ["🚕 Транспорт"]))
+        elif name == 'stats':
+            await self.step(user_id, 'stats', "📈 Статистика")
+        elif name == 'operations':
+            await self.step(user_id, 'operations', "📄 Операции", until=with_reply_keyboard)
+        elif name == 'coffee':
+            await self.step(user_id, 'coffee', "☕ Индекс кофе")
+    async def virtual_user(self, user_id: int, iterations: int, think: float):
+        self._inbox[user_id] = asyncio.Queue()
+        await self.step(user_id, 'start', "/start")
+        for _ in range(iterations):
+            await self.scenario(user_id, random.choice(SCENARIOS))
+            if think:
+                await asyncio.sleep(random.uniform(0, think))
+    async def run(self, users: int, iterations: int, think: float = 0) -> dict:
+        self._loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        await asyncio.gather(*(self.virtual_user(USER_ID_BASE + i, iterations, think) for i in range(users)))
+        elapsed = time.perf_counter() - started
+        steps = sum(len(v) for v in self.latencies.values())
+        everything = [x for v in self.latencies.values() for x in v]
+        return {
+            'users': users,
+            'iterations': iterations,
+            'elapsed': elapsed,
+            'steps': steps,
+            'throughput': steps / elapsed if elapsed else 0.0,
+            'timeouts': sum(self.timeouts.values()),
+            'photos': self.photos,
+            'latency': {
+                label: {
+                    'count': len(values),
+                    'p50': percentile(values, 0.5),
+                    'p95': percentile(values, 0.95),
+                    'p99': percentile(values, 0.99),
+                    'timeouts': self.timeouts.get(label, 0),
+                }
+                for label, values in sorted(self.latencies.items()) + [('ALL', everything)]
+            },
+            'api_calls': dict(self.fake.calls),
+        }
+async def seed_yesterday(users: int):
+    """По одной трате за вчера каждому виртуальному пользователю - чтобы индекс кофе рисовался"""
+    from database import open_pool, close_pool, save_expenses_batch_async
+    # «Вчера» по часам бота (пояс новых пользователей - Москва), а не по часам машины
+    yesterday = str((datetime.now(ZoneInfo("Europe/Moscow")) - timedelta(days=1)).date())
+    await open_pool()
+    try:
+        await save_expenses_batch_async([
+            (USER_ID_BASE + i, random.randint(100, 30000), "Нагрузочный тест", yesterday) for i in range(users)
+        ])
+    finally:
+        await close_pool()
+def spawn_bot(fake: FakeTelegram, mode: str, webhook_port: int) -> subprocess.Popen:
+    env = dict(os.environ, TELEGRAM_API_URL=fake.api_url, BOT_MODE=mode)
+    env.setdefault('BOT_TOKEN', '1000000001:fake')
+    if mode == 'webhook':
+        env.update(WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}", WEBHOOK_PORT=str(webhook_port),
+                   WEBHOOK_LISTEN="127.0.0.1")
+    bot = subprocess.Popen([sys.executable, 'bot.py'], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                           stdout=subprocess.DEVNULL, stderr=open('loadtest_bot.log', 'w'))
+    # Бот готов, когда начал забирать апдейты (polling) или зарегистрировал вебхук
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError("❌ bot.py завершился при старте, см. loadtest_bot.log")
+        if (mode == 'webhook' and fake.webhook_url) or (mode != 'webhook' and fake.calls.get('getUpdates')):
+            return bot
+        time.sleep(0.1)
+    bot.kill()
+    raise RuntimeError("❌ bot.py не поднялся за 60 с, см. loadtest_bot.log")
+def print_report(report: dict):
+    print(f"\n👥 Пользователей: {report['users']} × {report['iterations']} сценариев")
+    print(f"⏱️ {report['elapsed']:.1f} с, шагов: {report['steps']}, "
+          f"пропускная способность: {report['throughput']:.1f} шаг/с, таймаутов: {report['timeouts']}")
+    print(f"🖼️ Отправлено фото: {report['photos']}\n")
+    print(f"{'шаг':<18}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'таймауты':>10}")
+    for label, row in report['latency'].items():
+        print(f"{label:<18}{row['count']:>8}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}"
+              f"{row['p99'] * 1000:>10.1f}{row['timeouts']:>10}")
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейкового Bot API")
+    parser.add_argument('--users', type=int, default=20, help="виртуальных пользователей")
+    parser.add_argument('--iterations', type=int, default=5, help="сценариев на пользователя")
+    parser.add_argument('--think', type=float, default=0, help="пауза между сценариями, до N секунд")
+    parser.add_argument('--timeout', type=float, default=30, help="ожидание ответа на шаг, сек")
+    parser.add_argument('--port', type=int, default=8081, help="порт фейкового Bot API")
+    parser.add_argument('--spawn-bot', action='store_true', help="запустить bot.py самому")
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling', help="режим бота при --spawn-bot")
+    parser.add_argument('--webhook-port', type=int, default=8443)
+    parser.add_argument('--seed', action='store_true', help="добавить вчерашние траты для индекса кофе")
+    parser.add_argument('--json', help="сохранить отчёт в JSON-файл")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    if args.seed:
+        asyncio.run(seed_yesterday(args.users))
+    fake = FakeTelegram(port=args.port)
+    test = LoadTest(fake, timeout=args.timeout)
+    fake.on_reply = test.on_reply
+    fake.start()
+    bot = spawn_bot(fake, args.mode, args.webhook_port) if args.spawn_bot else None
+    if not bot:
+        print(f"🧪 Жду бота: TELEGRAM_API_URL={fake.api_url}")
+    try:
+        report = asyncio.run(test.run(args.users, args.iterations, args.think))
+    finally:
+        if bot:
+            bot.send_signal(signal.SIGTERM)
+            bot.wait(timeout=30)
+        fake.stop()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+if __name__ == '__main__':
+    main()
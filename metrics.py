@@ -0,0 +1,215 @@
+# metrics.py - метрики в формате Prometheus без внешних зависимостей
+#
+# Включаются переменной METRICS_PORT: бот поднимает http://METRICS_ADDR:METRICS_PORT/metrics.
+# Без неё (и без QUERY_TRACE) декораторы возвращают исходную функцию, а счётчики ничего не делают.
+import os
+import time
+import logging
+import threading
+import functools
+import inspect
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from query_trace import QUERY_TRACE, current_handler, current_function
+logger = logging.getLogger(__name__)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "127.0.0.1")
+METRICS_ENABLED = METRICS_PORT > 0
+# Границы бакетов гистограмм задержки, сек
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (10_000, 25_000, 50_000, 100_000, 200_000, 400_000, 800_000)
+_registry = []
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+class _Metric:
+    kind = None
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+class Counter(_Metric):
+    kind = "counter"
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+class Gauge(_Metric):
+    kind = "gauge"
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+class Histogram(_Metric):
+    kind = "histogram"
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счётчики по бакетам..., +Inf], сумма
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            else:
+                state[0][-1] += 1
+            state[1] += value
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+# ==================== МЕТРИКИ БОТА ====================
+handler_seconds = Histogram("bot_handler_seconds", "Время обработчика бота", ["handler"])
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках бота", ["handler"])
+query_seconds = Histogram("db_query_seconds", "Время функции database.py", ["function"])
+query_errors = Counter("db_query_errors_total", "Ошибки функций database.py", ["function"])
+db_connections_opened = Counter("db_connections_opened_total", "Открыто соединений с PostgreSQL", ["kind"])
+render_seconds = Histogram("coffee_render_seconds", "Отрисовка картинки кофе по этапам", ["stage"])
+render_bytes = Histogram("coffee_render_bytes", "Размер готового JPEG", buckets=BYTES_BUCKETS)
+render_pool_seconds = Histogram("render_pool_seconds", "Задача в пуле отрисовки", ["phase"])
+render_pool_rejected = Counter("render_pool_rejected_total", "Отказы пула отрисовки (очередь полна)")
+broadcast_messages = Counter("broadcast_messages_total", "Сообщения рассылки по итогу", ["result"])
+broadcast_rate_limited = Counter("broadcast_rate_limited_total", "Ответы 429 от Telegram во время рассылки")
+broadcast_progress = Gauge("broadcast_progress_messages", "Обработано сообщений в текущей рассылке")
+broadcast_running = Gauge("broadcast_running", "1, пока идёт рассылка")
+broadcast_throughput = Gauge("broadcast_last_throughput", "Сообщений в секунду в последней рассылке")
+broadcast_duration = Gauge("broadcast_last_duration_seconds", "Длительность последней рассылки")
+# ==================== ДЕКОРАТОРЫ ====================
+def _timed(histogram, errors, label, name, context_var):
+    """Декоратор для функций, корутин и асинхронных генераторов
+
+    context_var получает имя функции на время вызова - по нему query_trace
+    подписывает запросы обработчиком и функцией database.py.
+    """
+    def decorator(fn):
+        if not (METRICS_ENABLED or QUERY_TRACE):
+            return fn
+        labels = {label: name or fn.__name__}
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                # Генератор продолжается в контексте того, кто его итерирует, поэтому
+                # имя ставим только на время каждого шага
+                agen = fn(*args, **kwargs)
+                try:
+                    while True:
+                        token = context_var.set(labels[label])
+                        try:
+                            item = await agen.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            context_var.reset(token)
+                        yield item
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    await agen.aclose()
+                    histogram.observe(time.perf_counter() - started, **labels)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                token = context_var.set(labels[label])
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    context_var.reset(token)
+                    histogram.observe(time.perf_counter() - started, **labels)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                token = context_var.set(labels[label])
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    context_var.reset(token)
+                    histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+def timed_handler(fn=None, *, name=None):
+    """@timed_handler - гистограмма bot_handler_seconds{handler=...}"""
+    decorator = _timed(handler_seconds, handler_errors, "handler", name, current_handler)
+    return decorator(fn) if fn is not None else decorator
+def timed_query(fn=None, *, name=None):
+    """@timed_query - гистограмма db_query_seconds{function=...}"""
+    decorator = _timed(query_seconds, query_errors, "function", name, current_function)
+    return decorator(fn) if fn is not None else decorator
+# ==================== HTTP ====================
+def render_all() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = render_all().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    def log_message(self, *args):
+        pass
+_server = None
+def start_server():
+    """Поднимает /metrics в фоновом потоке (если задан METRICS_PORT)"""
+    global _server
+    if not METRICS_ENABLED or _server is not None:
+        return
+    _server = ThreadingHTTPServer((METRICS_ADDR, METRICS_PORT), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"📈 Метрики: http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
@@ -0,0 +1,278 @@
+# migrations.py - версионированные миграции схемы PostgreSQL
+import sys
+import logging
+from database import get_db_connection, rebuild_daily_totals
+logger = logging.getLogger(__name__)
+# Ключ advisory-блокировки, чтобы две реплики не накатывали миграции одновременно
+MIGRATIONS_LOCK_ID = 7_202_401
+
+# Старые версии бота писали expenses.date не только в ISO (ISO - более поздняя
+# правка): ДД.ММ.ГГГГ и т.п. Формат определяем по регулярке, разбираем to_date
+LEGACY_DATE_FORMATS = [
+    (r'^\d{4}-\d{1,2}-\d{1,2}$', 'YYYY-MM-DD'),
+    (r'^\d{1,2}\.\d{1,2}\.\d{4}$', 'DD.MM.YYYY'),
+    (r'^\d{1,2}\.\d{1,2}\.\d{2}$', 'DD.MM.YY'),
+    (r'^\d{1,2}/\d{1,2}/\d{4}$', 'DD/MM/YYYY'),
+]
+LEGACY_DATE_MATCH = " OR ".join(f"btrim(date::text) ~ '{regex}'" for regex, _ in LEGACY_DATE_FORMATS)
+LEGACY_DATE_TO_DATE = "CASE " + " ".join(
+    f"WHEN btrim(date::text) ~ '{regex}' THEN to_date(btrim(date::text), '{fmt}')"
+    for regex, fmt in LEGACY_DATE_FORMATS
+) + " END"
+
+# Миграции применяются строго по возрастанию версии и никогда не меняются задним числом.
+# Новая правка схемы = новая запись в конце списка.
+MIGRATIONS = [
+    (1, "Базовые таблицы users и expenses", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            date VARCHAR(10) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+    ]),
+    (2, "expenses.date: VARCHAR(10) -> DATE", [
+        # Исключение из правила выше: с date::date миграция проходила только на базах,
+        # где все даты уже в ISO, - для них результат тот же. Строки в неизвестном
+        # формате не ломают ALTER посередине, а перечисляются в ошибке до него
+        f'''
+        DO $$
+        DECLARE
+            unknown TEXT;
+        BEGIN
+            SELECT string_agg(format('id=%s: %L', id, date), ', ') INTO unknown
+            FROM (SELECT id, date FROM expenses WHERE NOT ({LEGACY_DATE_MATCH}) ORDER BY id LIMIT 20) bad;
+            IF unknown IS NOT NULL THEN
+                RAISE EXCEPTION 'expenses.date в неизвестном формате (первые 20): %', unknown
+                    USING HINT = 'Исправьте эти строки на ГГГГ-ММ-ДД и перезапустите миграции';
+            END IF;
+        END
+        $$
+        ''',
+        f'ALTER TABLE expenses ALTER COLUMN date TYPE DATE USING {LEGACY_DATE_TO_DATE}',
+    ]),
+    (3, "Покрывающие индексы для статистики и списка операций", [
+        # get_user_stats: WHERE user_id = ? AND date >= ? -> index-only scan
+        '''
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_date
+        ON expenses (user_id, date) INCLUDE (category, amount)
+        ''',
+        # get_user_operations: WHERE user_id = ? ORDER BY id DESC LIMIT ?
+        '''
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_id_desc
+        ON expenses (user_id, id DESC) INCLUDE (date, category, amount)
+        ''',
+    ]),
+    (4, "Индекс по дате для общего ежедневного отчёта", [
+        # iter_daily_reports_async: WHERE date = ? по всем пользователям сразу
+        '''
+        CREATE INDEX IF NOT EXISTS idx_expenses_date
+        ON expenses (date) INCLUDE (user_id, category, amount)
+        ''',
+    ]),
+    (5, "Кэш file_id отрисованных картинок кофе", [
+        '''
+        CREATE TABLE IF NOT EXISTS coffee_file_ids (
+            cache_key VARCHAR(255) PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (6, "Последняя картинка кофе пользователя для шеринга", [
+        '''
+        CREATE TABLE IF NOT EXISTS coffee_shares (
+            user_id BIGINT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            caption TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (7, "Дневные агрегаты по категориям + заполнение из expenses", [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_category_totals (
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            total DECIMAL(14, 2) NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day, category)
+        )
+        ''',
+        # Общий ежедневный отчёт: WHERE day = ? по всем пользователям
+        '''
+        CREATE INDEX IF NOT EXISTS idx_daily_totals_day
+        ON daily_category_totals (day) INCLUDE (user_id, category, total, count)
+        ''',
+        '''
+        INSERT INTO daily_category_totals (user_id, day, category, total, count)
+        SELECT user_id, date, category, SUM(amount), COUNT(*)
+        FROM expenses
+        GROUP BY user_id, date, category
+        ON CONFLICT (user_id, day, category) DO NOTHING
+        ''',
+    ]),
+    (8, "Персистентность бота: user_data и состояния диалогов", [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name VARCHAR(64) NOT NULL,
+            conv_key TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state BYTEA NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, conv_key)
+        )
+        ''',
+        # Ленивая загрузка: все диалоги одного пользователя
+        'CREATE INDEX IF NOT EXISTS idx_bot_conversations_user ON bot_conversations (user_id)',
+    ]),
+    (9, "Часовой пояс и время утреннего отчёта у каждого пользователя", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone TEXT NOT NULL DEFAULT 'Europe/Moscow'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS report_time TIME NOT NULL DEFAULT '09:00'",
+        # Когда отправить следующий отчёт; новым пользователям - завтра в 9:00 МСК
+        '''
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS next_report_at TIMESTAMPTZ NOT NULL
+        DEFAULT ((((now() AT TIME ZONE 'Europe/Moscow')::date + 1) + time '09:00') AT TIME ZONE 'Europe/Moscow')
+        ''',
+        # Существующим - ближайшие 9:00 МСК: сегодняшний отчёт, если он ещё не ушёл
+        '''
+        UPDATE users
+        SET next_report_at = (((now() AT TIME ZONE 'Europe/Moscow') - interval '9 hours')::date + 1
+                              + time '09:00') AT TIME ZONE 'Europe/Moscow'
+        ''',
+        # claim_due_reports_async: WHERE next_report_at <= now() - только те, кому пора
+        'CREATE INDEX IF NOT EXISTS idx_users_next_report_at ON users (next_report_at)',
+    ]),
+    (10, "Аренда забранных утренних отчётов", [
+        # next_report_at переносится после отправки, а до неё отчёт держит аренда
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS report_lease_until TIMESTAMPTZ',
+    ]),
+    (11, "Удаление индексов expenses, которые больше никто не читает", [
+        # Статистика и отчёты читают daily_category_totals, а эти индексы только
+        # замедляли каждую вставку траты. Списку операций и пересчёту агрегата
+        # одного пользователя хватает idx_expenses_user_id_desc (index-only scan)
+        'DROP INDEX IF EXISTS idx_expenses_date',
+        'DROP INDEX IF EXISTS idx_expenses_user_date',
+    ]),
+    (12, "NOTIFY read_cache при изменении трат - сброс кэша чтений на всех репликах", [
+        # Один NOTIFY на пользователя и оператор; доставляется после COMMIT, кем бы ни была запись
+        '''
+        CREATE OR REPLACE FUNCTION notify_read_cache() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('read_cache', user_id::text) FROM (SELECT DISTINCT user_id FROM old_rows) changed;
+            ELSE
+                PERFORM pg_notify('read_cache', user_id::text) FROM (SELECT DISTINCT user_id FROM new_rows) changed;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS expenses_notify_insert ON expenses',
+        '''
+        CREATE TRIGGER expenses_notify_insert AFTER INSERT ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_read_cache()
+        ''',
+        'DROP TRIGGER IF EXISTS expenses_notify_update ON expenses',
+        '''
+        CREATE TRIGGER expenses_notify_update AFTER UPDATE ON expenses
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_read_cache()
+        ''',
+        'DROP TRIGGER IF EXISTS expenses_notify_delete ON expenses',
+        '''
+        CREATE TRIGGER expenses_notify_delete AFTER DELETE ON expenses
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_read_cache()
+        ''',
+    ]),
+    (13, "Счётчик неудачных попыток утреннего отчёта подряд", [
+        # После REPORT_MAX_FAILURES тиков с временной ошибкой отчёт за этот день пропускается
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS report_failures INTEGER NOT NULL DEFAULT 0',
+    ]),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+def _get_current_version(cursor) -> int:
+    """Текущая версия схемы (0, если таблицы schema_version ещё нет)"""
+    cursor.execute("SELECT to_regclass('schema_version') AS tbl")
+    if cursor.fetchone()['tbl'] is None:
+        return 0
+    cursor.execute('SELECT COALESCE(MAX(version), 0) AS version FROM schema_version')
+    return cursor.fetchone()['version']
+def run_migrations():
+    """Накатывает недостающие миграции. Если схема актуальна - DDL не выполняется."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        current = _get_current_version(cursor)
+        conn.commit()
+        if current >= LATEST_VERSION:
+            logger.info(f"✅ Схема БД актуальна (версия {current})")
+            return current
+
+        # Берём блокировку и перечитываем версию: её могла поднять другая реплика
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            current = _get_current_version(cursor)
+            conn.commit()
+
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info(f"🛠️ Миграция {version}: {description}")
+                # Каждая миграция - отдельная транзакция вместе с записью о версии
+                with conn.transaction():
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute(
+                        'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                        (version, description)
+                    )
+                current = version
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+            conn.commit()
+
+        logger.info(f"✅ Миграции применены, версия схемы: {current}")
+        return current
+    finally:
+        cursor.close()
+        conn.close()
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    run_migrations()
+    # python migrations.py --rebuild-totals [user_id] - пересобрать daily_category_totals
+    if "--rebuild-totals" in sys.argv:
+        args = sys.argv[sys.argv.index("--rebuild-totals") + 1:]
+        rebuild_daily_totals(int(args[0]) if args else None)
@@ -0,0 +1,210 @@
+# pg_persistence.py - персистентность PTB в PostgreSQL (user_data + состояния ConversationHandler)
+import os
+import json
+import time
+import pickle
+import asyncio
+import logging
+import telegram
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+from cache import LRUCache
+from database import load_persisted_user_async, save_persisted_batch_async
+logger = logging.getLogger(__name__)
+# 1 - хранить незаконченные диалоги и user_data в БД (переживают рестарт, работают с несколькими репликами)
+BOT_PERSISTENCE = os.environ.get("BOT_PERSISTENCE", "0") == "1"
+# Как часто PTB отдаёт накопленные изменения; всё, что накопилось за интервал, пишется одной транзакцией
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", 1.0))
+# Через сколько секунд перечитывать пользователя из БД (его могла обслужить другая реплика).
+# 0 - перед каждым апдейтом, если у этого процесса нет несохранённых изменений пользователя
+PERSISTENCE_RELOAD_TTL = float(os.environ.get("PERSISTENCE_RELOAD_TTL", 0))
+# Для скольких пользователей помнить время загрузки и последний записанный user_data;
+# вытесненный просто перечитается из БД при следующем апдейте
+PERSISTENCE_TRACKED_USERS = int(os.environ.get("PERSISTENCE_TRACKED_USERS", 50000))
+class PostgresPersistence(BasePersistence):
+    """
+    user_data и состояния диалогов в таблицах bot_user_data / bot_conversations
+
+    - при старте ничего не читается: пользователь подгружается лениво
+      в refresh_user_data() перед обработкой его апдейта;
+    - update_* только складывают изменения в буфер, буфер пишется пачкой;
+    - chat_data, bot_data и callback_data боту не нужны и не хранятся.
+
+    ConversationHandler проверяет своё состояние раньше, чем PTB вызывает
+    refresh_user_data(), поэтому в группу -1 нужно добавить loader_handler():
+    он гарантирует загрузку пользователя до проверки диалогов.
+    """
+    def __init__(self, flush_interval=PERSISTENCE_FLUSH_INTERVAL, reload_ttl=PERSISTENCE_RELOAD_TTL,
+                 tracked_users=PERSISTENCE_TRACKED_USERS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.reload_ttl = reload_ttl
+        self._handlers = {}
+        # user_id -> (когда загружен из БД, pickle user_data, который сейчас в БД)
+        self._synced = LRUCache(tracked_users)
+        # user_id -> pickle user_data, который пишется прямо сейчас
+        self._writing = {}
+        # user_id -> номер последнего апдейта, изменения которого ещё не в БД
+        self._unsynced = {}
+        self._seq = 0
+        self._dirty_users = {}
+        self._dropped_users = set()
+        self._dirty_conversations = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+    def track_conversations(self, *handlers):
+        """Регистрирует ConversationHandler'ы, чьи состояния подгружаются лениво"""
+        for handler in handlers:
+            if not (handler.persistent and handler.name and handler.per_user):
+                raise ValueError(f"❌ Диалог {handler.name!r} должен быть persistent, с name и per_user")
+            self._handlers[handler.name] = handler
+    def _user_of(self, name, key):
+        # Ключ диалога PTB: (chat_id, user_id, ...) или (user_id, ...) при per_chat=False
+        return key[1] if self._handlers[name].per_chat else key[0]
+    # ---------- загрузка ----------
+    async def get_user_data(self):
+        return {}
+    async def get_conversations(self, name):
+        # PTB вызывает это при инициализации, когда у диалога уже есть TrackingDict
+        if name in self._handlers:
+            _check_ptb_internals(self._handlers[name])
+        return {}
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id not in self._unsynced:
+            synced = self._synced.get(user_id)
+            if synced is None or time.monotonic() - synced[0] >= self.reload_ttl:
+                await self._load_user(user_id, user_data)
+        # Дальше обработчик может поменять данные: до записи в БД память главнее
+        self._seq += 1
+        self._unsynced[user_id] = self._seq
+    async def _load_user(self, user_id, user_data):
+        rows = await load_persisted_user_async(user_id)
+        data = {}
+        states = {name: {} for name in self._handlers}
+        for row in rows:
+            if row['name'] is None:
+                data = pickle.loads(row['data'])
+            elif row['name'] in states:
+                states[row['name']][tuple(json.loads(row['conv_key']))] = pickle.loads(row['data'])
+        user_data.clear()
+        user_data.update(data)
+        for name, handler in self._handlers.items():
+            conversations = handler._conversations
+            # Состояния, которых в БД уже нет, завершены (возможно, другой репликой)
+            for key in [k for k in conversations if self._user_of(name, k) == user_id]:
+                conversations.data.pop(key, None)
+            conversations.update_no_track(states[name])
+        self._synced.set(user_id, (time.monotonic(), pickle.dumps(data)))
+    # ---------- буфер изменений ----------
+    def _stored_blob(self, user_id):
+        """user_data, который уже в БД или пишется туда прямо сейчас"""
+        if user_id in self._writing:
+            return self._writing[user_id]
+        synced = self._synced.get(user_id)
+        return synced[1] if synced else None
+    async def update_user_data(self, user_id, data):
+        blob = pickle.dumps(data)
+        seq = self._unsynced.get(user_id)
+        if user_id not in self._dropped_users and blob == self._stored_blob(user_id):
+            # PTB отдаёт user_data после каждого апдейта, а меняется он редко - одинаковое не пишем
+            self._dirty_users.pop(user_id, None)
+            if user_id not in self._writing and seq is not None:
+                del self._unsynced[user_id]
+            return
+        self._dropped_users.discard(user_id)
+        self._dirty_users[user_id] = (blob, seq)
+        self._schedule_flush()
+    async def drop_user_data(self, user_id):
+        self._dirty_users.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        synced = self._synced.get(user_id)
+        if synced:
+            # В БД строка вот-вот исчезнет: следующий user_data записывается, даже если совпадёт
+            self._synced.set(user_id, (synced[0], None))
+        self._schedule_flush()
+    async def update_conversation(self, name, key, new_state):
+        if name not in self._handlers:
+            return
+        state = None if new_state is None else pickle.dumps(new_state)
+        self._dirty_conversations[(name, json.dumps(list(key)))] = (self._user_of(name, key), state)
+        self._schedule_flush()
+    def _schedule_flush(self):
+        # PTB вызывает update_* пачкой через asyncio.gather - пишем всю пачку одним заходом
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+    async def _flush(self):
+        async with self._flush_lock:
+            # То, что пришло во время записи, уходит следующей пачкой
+            while self._dirty_users or self._dropped_users or self._dirty_conversations:
+                if not await self._write_batch():
+                    return
+    async def _write_batch(self) -> bool:
+        dirty_users, self._dirty_users = self._dirty_users, {}
+        dropped_users, self._dropped_users = self._dropped_users, set()
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        self._writing = {user_id: blob for user_id, (blob, _) in dirty_users.items()}
+        try:
+            await save_persisted_batch_async(self._writing, list(dropped_users), conversations)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи персистентности: {type(e).__name__}: {e}")
+            # Возвращаем в буфер то, что не успели перезаписать более свежими данными
+            for user_id, value in dirty_users.items():
+                self._dirty_users.setdefault(user_id, value)
+            self._dropped_users |= dropped_users - set(self._dirty_users)
+            for key, value in conversations.items():
+                self._dirty_conversations.setdefault(key, value)
+            return False
+        finally:
+            self._writing = {}
+        # Пользователь синхронизирован, если после снимка не пришло новых апдейтов
+        now = time.monotonic()
+        for user_id, (blob, seq) in dirty_users.items():
+            synced = self._synced.get(user_id)
+            self._synced.set(user_id, (synced[0] if synced else now, blob))
+            if seq is not None and self._unsynced.get(user_id) == seq:
+                del self._unsynced[user_id]
+        logger.debug(f"💾 Персистентность: user_data={len(dirty_users)}, диалогов={len(conversations)}")
+        return True
+    async def flush(self):
+        """Дописывает буфер при остановке бота"""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush()
+    # ---------- не используется ботом ----------
+    async def get_chat_data(self):
+        return {}
+    async def get_bot_data(self):
+        return {}
+    async def get_callback_data(self):
+        return None
+    async def update_chat_data(self, chat_id, data):
+        pass
+    async def update_bot_data(self, data):
+        pass
+    async def update_callback_data(self, data):
+        pass
+    async def drop_chat_data(self, chat_id):
+        pass
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    async def refresh_bot_data(self, bot_data):
+        pass
+def _check_ptb_internals(handler):
+    """
+    Ленивая загрузка диалогов опирается на внутренности PTB (проверено на 21.x):
+    ConversationHandler._conversations - TrackingDict с .data и update_no_track().
+    Если их нет, бот падает при старте, а не теряет диалоги молча.
+    """
+    conversations = getattr(handler, '_conversations', None)
+    if not (hasattr(conversations, 'update_no_track') and isinstance(getattr(conversations, 'data', None), dict)):
+        raise RuntimeError(
+            f"❌ python-telegram-bot {telegram.__version__}: у ConversationHandler нет _conversations "
+            f"с update_no_track() и .data - PostgresPersistence нужна версия из requirements.txt"
+        )
+async def _noop(update, context):
+    pass
+def loader_handler():
+    """Обработчик для группы -1: только вызывает refresh_user_data до проверки диалогов"""
+    return TypeHandler(Update, _noop)
@@ -0,0 +1,169 @@
+# query_trace.py - трассировка запросов database.py и сбор EXPLAIN для медленных
+#
+# QUERY_TRACE=1 подменяет курсоры psycopg на трассирующие: каждый execute()
+# записывает длительность, число строк, функцию database.py и обработчик бота.
+# Медленные SELECT (дольше SLOW_QUERY_MS) выборочно прогоняются через
+# EXPLAIN (ANALYZE, BUFFERS) на отдельном соединении и пишутся в ротируемый лог.
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import threading
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+import psycopg
+logger = logging.getLogger(__name__)
+QUERY_TRACE = os.environ.get("QUERY_TRACE", "0") == "1"
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+# Доля медленных запросов, для которых снимаем EXPLAIN ANALYZE (он выполняет запрос ещё раз)
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE", 0.1))
+# Не чаще одного EXPLAIN на один и тот же запрос за этот интервал, сек
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get("SLOW_QUERY_EXPLAIN_INTERVAL", 60))
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", "slow_queries.log")
+EXPLAIN_TIMEOUT_MS = int(os.environ.get("EXPLAIN_TIMEOUT_MS", 30000))
+# Сколько разных (функция, обработчик, запрос) держать в сводке
+MAX_TRACKED = 500
+# Кто сейчас выполняется: ставятся декораторами timed_handler / timed_query из metrics.py
+current_handler = ContextVar("current_handler", default=None)
+current_function = ContextVar("current_function", default=None)
+_slow_log = logging.getLogger("slow_queries")
+_slow_log.propagate = False
+def _init_slow_log():
+    if _slow_log.handlers:
+        return
+    handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    _slow_log.addHandler(handler)
+    _slow_log.setLevel(logging.INFO)
+# Комментарии -- и /* */ вне строк, идентификаторов в кавычках и $$-блоков
+_SQL_COMMENT = re.compile(
+    r"(?P<keep>'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$)|--[^\n]*|/\*.*?\*/",
+    re.S,
+)
+def _fingerprint(query) -> str:
+    text = query.as_string(None) if hasattr(query, 'as_string') else str(query)
+    # Сначала комментарии: после склейки в одну строку -- съел бы весь хвост запроса
+    text = _SQL_COMMENT.sub(lambda m: m.group('keep') or " ", text)
+    return " ".join(text.split())
+def _is_read_only(fingerprint: str) -> bool:
+    """EXPLAIN ANALYZE выполняет запрос - снимаем его только для чтения"""
+    head = fingerprint.lstrip('( ').upper()
+    if not (head.startswith('SELECT') or head.startswith('WITH')):
+        return False
+    words = set(head.replace('(', ' ').split())
+    return not words & {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'LOCK', 'FOR'}
+class QueryTracer:
+    """Сводка по запросам и отбор медленных для EXPLAIN"""
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, sample=SLOW_QUERY_EXPLAIN_SAMPLE,
+                 explain_interval=SLOW_QUERY_EXPLAIN_INTERVAL):
+        self.threshold = threshold_ms / 1000
+        self.sample = sample
+        self.explain_interval = explain_interval
+        self._stats = {}
+        self._last_explain = {}
+        self._lock = threading.Lock()
+        self._tasks = set()
+    def record(self, query, params, duration: float, rows: int):
+        """Учитывает выполненный запрос; True - запрос медленный и его стоит объяснить"""
+        fingerprint = _fingerprint(query)
+        if not fingerprint:
+            # Пустой запрос - проверка соединения пулом
+            return False
+        key =(current_function.get(), current_handler.get(), fingerprint)
+        slow = duration >= self.threshold
+        with self._lock:
+            item = self._stats.get(key)
+            if item is None:
+                if len(self._stats) >= MAX_TRACKED:
+                    return False
+                item = self._stats[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'rows': 0, 'slow': 0}
+            item['count'] += 1
+            item['total'] += duration
+            item['max'] = max(item['max'], duration)
+            item['rows'] += max(rows, 0)
+            item['slow'] += slow
+        if not slow:
+            return False
+        _slow_log.info(
+            f"SLOW {duration * 1000:.1f} ms rows={rows} function={key[0]} handler={key[1]}\n"
+            f"  {fingerprint}\n  params={params!r}"
+        )
+        return self._want_explain(fingerprint)
+    def _want_explain(self, fingerprint: str) -> bool:
+        if not _is_read_only(fingerprint) or random.random() >= self.sample:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_explain.get(fingerprint, -self.explain_interval) < self.explain_interval:
+                return False
+            self._last_explain[fingerprint] = now
+        return True
+    def explain_sync(self, query, params):
+        try:
+            with psycopg.connect(os.environ.get("DATABASE_URL"), autocommit=True,
+                                 options=f"-c statement_timeout={EXPLAIN_TIMEOUT_MS}") as conn:
+                plan = conn.execute(f"EXPLAIN (ANALYZE, BUFFERS) {_fingerprint(query)}", params).fetchall()
+            self._log_plan(query, plan)
+        except Exception as e:
+            logger.error(f"❌ EXPLAIN не удался: {type(e).__name__}: {e}")
+    def explain_later(self, query, params):
+        """EXPLAIN в фоне, на своём соединении: обработчик бота его не ждёт"""
+        task = asyncio.get_running_loop().create_task(self._explain_async(query, params))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    async def _explain_async(self, query, params):
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                os.environ.get("DATABASE_URL"), autocommit=True,
+                options=f"-c statement_timeout={EXPLAIN_TIMEOUT_MS}"
+            ) as conn:
+                cursor = await conn.execute(f"EXPLAIN (ANALYZE, BUFFERS) {_fingerprint(query)}", params)
+                plan = await cursor.fetchall()
+            self._log_plan(query, plan)
+        except Exception as e:
+            logger.error(f"❌ EXPLAIN не удался: {type(e).__name__}: {e}")
+    def _log_plan(self, query, plan):
+        lines = "\n".join(f"    {row[0]}" for row in plan)
+        _slow_log.info(f"EXPLAIN {_fingerprint(query)}\n{lines}")
+    def top(self, limit=10, order_by='total') -> list:
+        """Самые тяжёлые запросы: суммарное время, max, число медленных"""
+        with self._lock:
+            items = [
+                {'function': key[0], 'handler': key[1], 'query': key[2], **value}
+                for key, value in self._stats.items()
+            ]
+        items.sort(key=lambda item: item[order_by], reverse=True)
+        return items[:limit]
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+tracer = QueryTracer()
+class TracedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            if tracer.record(query, params, time.perf_counter() - started, self.rowcount):
+                tracer.explain_sync(query, params)
+class TracedAsyncCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            if tracer.record(query, params, time.perf_counter() - started, self.rowcount):
+                tracer.explain_later(query, params)
+def connection_kwargs() -> dict:
+    """Доп. параметры соединения для database.py: трассирующие курсоры, если трассировка включена"""
+    if not QUERY_TRACE:
+        return {}
+    _init_slow_log()
+    return {'cursor_factory': TracedAsyncCursor}
+def sync_connection_kwargs() -> dict:
+    if not QUERY_TRACE:
+        return {}
+    _init_slow_log()
+    return {'cursor_factory': TracedCursor}
@@ -0,0 +1,109 @@
+# render_pool.py - отрисовка картинок вне event loop, в пуле воркеров с ограниченной очередью
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from coffee_render import load_templates
+import metrics
+logger = logging.getLogger(__name__)
+# thread - потоки (Pillow отпускает GIL на декодировании/кодировании), process - отдельные процессы
+RENDER_POOL_MODE = os.environ.get("RENDER_POOL_MODE", "thread")
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+# Сколько задач может ждать в очереди сверх занятых воркеров; дальше - отказ "занято"
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", 16))
+# По скольким последним отрисовкам считать перцентили
+LATENCY_WINDOW = 500
+class RenderPoolBusy(Exception):
+    """Очередь отрисовки заполнена - пользователю нужно ответить «попробуй позже»"""
+def _timed_call(fn, args, kwargs):
+    """Выполняется в воркере: результат + время начала и длительность отрисовки"""
+    started = time.time()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, started, time.perf_counter() - t0
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+class RenderPool:
+    """Пул воркеров для Pillow: не блокирует бота и не копит бесконечную очередь"""
+    def __init__(self, mode=RENDER_POOL_MODE, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE_SIZE):
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._render_times = deque(maxlen=LATENCY_WINDOW)
+        self._wait_times = deque(maxlen=LATENCY_WINDOW)
+    def start(self):
+        if self._executor is not None:
+            return
+        if self.mode == "process":
+            # spawn: не форкаем процесс с уже запущенным event loop и потоками
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_templates,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+        logger.info(f"🎨 Пул отрисовки: {self.mode}, воркеров={self.workers}, очередь={self.queue_size}")
+    def shutdown(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+    @property
+    def queue_depth(self) -> int:
+        """Сколько задач ждут свободного воркера"""
+        return max(0, self.in_flight - self.workers)
+    async def submit(self, fn, *args, **kwargs):
+        """Запускает fn в пуле; если очередь полна - сразу RenderPoolBusy"""
+        if self._executor is None:
+            self.start()
+        if self.queue_depth >= self.queue_size:
+            self.rejected += 1
+            metrics.render_pool_rejected.inc()
+            raise RenderPoolBusy()
+        self.in_flight += 1
+        submitted = time.time()
+        try:
+            future = self._executor.submit(_timed_call, fn, args, kwargs)
+            result, started, render_time = await asyncio.wrap_future(future)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        self._render_times.append(render_time)
+        self._wait_times.append(max(0.0, started - submitted))
+        metrics.render_pool_seconds.observe(render_time, phase="render")
+        metrics.render_pool_seconds.observe(max(0.0, started - submitted), phase="wait")
+        if isinstance(result, bytes):
+            metrics.render_bytes.observe(len(result))
+        return result
+    def stats(self) -> dict:
+        """Текущая загрузка и задержки (для подбора размера пула)"""
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'render_p50': _percentile(self._render_times, 0.5),
+            'render_p95': _percentile(self._render_times, 0.95),
+            'wait_p50': _percentile(self._wait_times, 0.5),
+            'wait_p95': _percentile(self._wait_times, 0.95),
+        }
+render_pool = RenderPool()
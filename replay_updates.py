@@ -0,0 +1,62 @@
+# replay_updates.py - отправка записанных апдейтов в бота, запущенного в режиме webhook
+#
+#   BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET=s python bot.py
+#   python replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret s
+#
+# Файл: по одному апдейту (JSON) на строку, JSON-массив апдейтов
+# или сохранённый ответ getUpdates ({"ok": true, "result": [...]}).
+import sys
+import json
+import time
+import asyncio
+import argparse
+import httpx
+def load_updates(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('{') and '"result"' in text.split('\n', 1)[0]:
+        return json.loads(text)['result']
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+async def replay(updates: list, url: str, secret: str = None, concurrency: int = 1, repeat: int = 1):
+    """POST-ит апдейты на url; возвращает {код ответа: количество}"""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    statuses = {}
+    queue = asyncio.Queue()
+    # Каждому повтору - свои update_id, чтобы апдейты не выглядели дублями
+    step = max((u.get('update_id', 0) for u in updates), default=0) + 1
+    for round_no in range(repeat):
+        for update in updates:
+            queue.put_nowait(dict(update, update_id=update.get('update_id', 0) + round_no * step))
+    async def worker(client):
+        while not queue.empty():
+            update = queue.get_nowait()
+            try:
+                response = await client.post(url, json=update, headers=headers)
+                key = response.status_code
+            except httpx.HTTPError as e:
+                key = type(e).__name__
+            statuses[key] = statuses.get(key, 0) + 1
+    async with httpx.AsyncClient(timeout=30) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return statuses
+def main():
+    parser = argparse.ArgumentParser(description="Прогон записанных апдейтов через webhook бота")
+    parser.add_argument('file', help="файл с апдейтами")
+    parser.add_argument('--url', default="http://127.0.0.1:8443/telegram")
+    parser.add_argument('--secret', default=None, help="значение WEBHOOK_SECRET бота")
+    parser.add_argument('--concurrency', type=int, default=1, help="одновременных запросов")
+    parser.add_argument('--repeat', type=int, default=1, help="сколько раз прогнать файл")
+    args = parser.parse_args()
+    updates = load_updates(args.file)
+    started = time.perf_counter()
+    statuses = asyncio.run(replay(updates, args.url, args.secret, args.concurrency, args.repeat))
+    elapsed = time.perf_counter() - started
+    total = sum(statuses.values())
+    print(f"📨 Отправлено: {total} за {elapsed:.2f} с ({total / elapsed:.0f}/с)")
+    for status, count in sorted(statuses.items(), key=str):
+        print(f"   {status}: {count}")
+    sys.exit(0 if set(statuses) <= {200} else 1)
+if __name__ == '__main__':
+    main()
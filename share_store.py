@@ -0,0 +1,40 @@
+# share_store.py - последняя картинка кофе каждого пользователя для инлайн-кнопки «Поделиться»
+import os
+import logging
+from cache import LRUCache
+from database import save_coffee_share_async, load_coffee_shares_async
+logger = logging.getLogger(__name__)
+SHARE_STORE_SIZE = int(os.environ.get("SHARE_STORE_SIZE", 50000))
+SHARE_STORE_TTL = int(os.environ.get("SHARE_STORE_TTL", 2 * 24 * 3600))  # сек
+# 1 - дублировать записи в таблицу coffee_shares и поднимать их после рестарта
+SHARE_STORE_PERSIST = os.environ.get("SHARE_STORE_PERSIST", "0") == "1"
+class ShareStore:
+    """
+    user_id -> {'file_id', 'caption'}
+
+    Инлайн-запросы читают только из памяти; БД (если включена) нужна
+    лишь для того, чтобы пережить рестарт.
+    """
+    def __init__(self, maxsize=SHARE_STORE_SIZE, ttl=SHARE_STORE_TTL, persist=SHARE_STORE_PERSIST):
+        self._memory = LRUCache(maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.persist = persist
+    def get(self, user_id: int):
+        return self._memory.get(user_id)
+    async def set(self, user_id: int, file_id: str, caption: str):
+        self._memory.set(user_id, {'file_id': file_id, 'caption': caption})
+        if self.persist:
+            try:
+                await save_coffee_share_async(user_id, file_id, caption)
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить картинку для шеринга: {e}")
+    async def load(self):
+        """Прогревает память свежими записями из БД (при старте бота)"""
+        if not self.persist:
+            return
+        rows = await load_coffee_shares_async(self.ttl, self._memory.maxsize)
+        # Самые старые первыми, чтобы самые свежие оказались в конце LRU
+        for row in reversed(rows):
+            self._memory.set(row['user_id'], {'file_id': row['file_id'], 'caption': row['caption']})
+        logger.info(f"✅ Загружено картинок для шеринга: {len(rows)}")
+share_store = ShareStore()
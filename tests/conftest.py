@@ -0,0 +1,6 @@
+# Модули бота лежат в корне репозитория, тесты - в tests/
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# bot.py без токена не импортируется; сетью тесты не пользуются
+os.environ.setdefault("BOT_TOKEN", "1000000001:test")
@@ -0,0 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+import pytest
+import bot
+import coffee_prerender
+from bot import parse_user_date, parse_utc_offset
+from coffee_render import COFFEE_PRICE
+# ==================== parse_utc_offset ====================
+@pytest.mark.parametrize("text, expected", [
+    ("+3", "Etc/GMT-3"),
+    ("UTC+3", "Etc/GMT-3"),
+    ("utc+3", "Etc/GMT-3"),
+    ("GMT-5", "Etc/GMT+5"),
+    ("+0", "Etc/UTC"),
+    ("UTC-0", "Etc/UTC"),
+    ("-12", "Etc/GMT+12"),
+    ("+14", "Etc/GMT-14"),
+])
+def test_parse_utc_offset(text, expected):
+    assert parse_utc_offset(text) == expected
+@pytest.mark.parametrize("text", ["", "3", "UTC", "UTC3", "+", "+3:30", "+3.5", "++3", "-13", "+15", "Europe/Moscow"])
+def test_parse_utc_offset_rejects(text):
+    assert parse_utc_offset(text) is None
+# ==================== parse_user_date ====================
+TODAY = date(2025, 3, 10)
+@pytest.mark.parametrize("text, expected", [
+    ("05.01.2024", date(2024, 1, 5)),
+    ("2024-01-05", date(2024, 1, 5)),
+    ("05.01", date(2025, 1, 5)),
+    ("5.1", date(2025, 1, 5)),
+    ("29.02.2024", date(2024, 2, 29)),
+])
+def test_parse_user_date(text, expected):
+    assert parse_user_date(text, TODAY) == expected
+@pytest.mark.parametrize("text", ["", "вчера", "32.01", "29.02", "01/05/2024", "2024-13-01"])
+def test_parse_user_date_rejects(text):
+    # 29.02 без года - текущий (невисокосный) год
+    with pytest.raises(ValueError):
+        parse_user_date(text, TODAY)
+# ==================== coffee_index_handler ====================
+class FakeMessage:
+    def __init__(self):
+        self.photos = []
+    async def reply_photo(self, photo, caption, reply_markup=None):
+        self.photos.append((photo, caption))
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"uploaded:{len(self.photos)}")])
+    async def reply_text(self, text, reply_markup=None):
+        pass
+class FakeFileIds:
+    """Кэш file_id без БД: в предотрисовке всё загружено, в обработчике - пусто"""
+    def __init__(self, prerendered):
+        self.prerendered = prerendered
+        self.saved = {}
+    async def get(self, key):
+        return f"file:{key}" if self.prerendered else self.saved.get(key)
+    async def put(self, key, file_id):
+        self.saved[key] = file_id
+    @asynccontextmanager
+    async def lock(self, key):
+        yield
+def test_coffee_index_renders_again_after_expense_update(monkeypatch):
+    user_id = 1
+    now = datetime(2025, 1, 2, 12, tzinfo=timezone.utc)
+    day = date(2025, 1, 1)
+    totals = {'total': 3 * COFFEE_PRICE}
+    async def daily_totals(day):
+        return [(user_id, totals['total'], True)]
+    async def user_time(user_id):
+        return now
+    async def period_stats(user_id, start, end):
+        assert start == end == day
+        return {'has_data': True, 'total': totals['total']}
+    async def submit(fn, **kwargs):
+        return f"image:{kwargs['cups']}"
+    async def share(user_id, file_id, caption):
+        pass
+    monkeypatch.setattr(coffee_prerender, "get_daily_totals_async", daily_totals)
+    monkeypatch.setattr(coffee_prerender, "coffee_file_ids", FakeFileIds(prerendered=True))
+    prerender = coffee_prerender.CoffeePrerender(storage_chat_id=-100)
+    asyncio.run(prerender.run(bot=None, day=day))
+    monkeypatch.setattr(bot, "coffee_prerender", prerender)
+    monkeypatch.setattr(bot, "coffee_file_ids", FakeFileIds(prerendered=False))
+    monkeypatch.setattr(bot, "get_user_time", user_time)
+    monkeypatch.setattr(bot, "get_period_stats_async", period_stats)
+    monkeypatch.setattr(bot, "render_pool", SimpleNamespace(submit=submit))
+    monkeypatch.setattr(bot, "share_store", SimpleNamespace(set=share))
+    def press():
+        message = FakeMessage()
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message)
+        asyncio.run(bot.coffee_index_handler(update, None))
+        return message.photos
+    # Сумма не менялась - готовая картинка без отрисовки
+    [(photo, caption)] = press()
+    assert photo.startswith("file:") and "3 чашек" in caption
+    # Вчерашнюю трату исправили после предотрисовки - картинка рисуется заново
+    totals['total'] = 5 * COFFEE_PRICE
+    [(photo, caption)] = press()
+    assert photo == "image:5" and "5 чашек" in caption
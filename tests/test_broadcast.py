@@ -0,0 +1,137 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from telegram.error import RetryAfter, Forbidden, NetworkError, TimedOut, BadRequest
+import broadcast
+from broadcast import TokenBucket, Broadcaster, is_retryable
+class FakeClock:
+    """Время, которое идёт только в asyncio.sleep"""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+    def monotonic(self):
+        return self.now
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    real_sleep = asyncio.sleep
+    async def sleep(delay, result=None):
+        fake.slept.append(delay)
+        fake.now += max(0.0, delay)
+        await real_sleep(0)
+        return result
+    monkeypatch.setattr(broadcast, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return fake
+# ==================== TokenBucket ====================
+def test_bucket_allows_burst_then_waits(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=2, capacity=3)
+        for _ in range(3):
+            await bucket.acquire()
+        assert clock.slept == []
+        await bucket.acquire()
+    asyncio.run(scenario())
+    assert clock.slept == [pytest.approx(0.5)]
+def test_bucket_refills_with_time_up_to_capacity(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=1, capacity=2)
+        await bucket.acquire()
+        await bucket.acquire()
+        clock.now += 10
+        await bucket.acquire()
+        await bucket.acquire()
+        assert clock.slept == []
+        await bucket.acquire()
+    asyncio.run(scenario())
+    assert clock.slept == [pytest.approx(1.0)]
+def test_bucket_pause_blocks_and_empties_bucket(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=10, capacity=5)
+        bucket.pause(3)
+        started = clock.now
+        await bucket.acquire()
+        return clock.now - started
+    # 3 с паузы, потом ещё ждём один токен (бакет опустошён)
+    assert asyncio.run(scenario()) == pytest.approx(3.1)
+def test_bucket_capacity_is_at_least_one(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=1, capacity=0)
+        await bucket.acquire()
+    asyncio.run(scenario())
+    assert clock.slept == []
+# ==================== Broadcaster ====================
+def run_broadcast(send, jobs, **kwargs):
+    results = {}
+    # rate=1: после паузы токен приходит ровно через секунду (фейковые часы без дробей)
+    kwargs.setdefault('rate', 1)
+    kwargs.setdefault('burst', 1000)
+    kwargs.setdefault('per_chat_interval', 0)
+    kwargs.setdefault('backoff', 0)
+    stats = asyncio.run(Broadcaster(send, on_result=results.__setitem__, **kwargs).run(jobs))
+    return stats, results
+def test_retry_after_does_not_count_against_max_retries(clock):
+    attempts = []
+    async def send(chat_id, payload):
+        attempts.append(chat_id)
+        if len(attempts) <= 5:
+            raise RetryAfter(1)
+    stats, results = run_broadcast(send, [(1, "hi")], max_retries=1)
+    assert (stats.sent, stats.failed, stats.rate_limited) == (1, 0, 5)
+    assert results == {1: None}
+def test_retry_after_is_capped_by_max_attempts(clock):
+    attempts = []
+    async def send(chat_id, payload):
+        attempts.append(chat_id)
+        raise RetryAfter(1)
+    stats, results = run_broadcast(send, [(1, "hi")], max_attempts=4)
+    assert len(attempts) == 4
+    assert (stats.sent, stats.failed, stats.rate_limited) == (0, 1, 4)
+    # Рассылка сдалась, но 429 - временная ошибка: отчёт вернётся следующему тику
+    assert isinstance(results[1], RetryAfter) and is_retryable(results[1])
+def test_network_errors_are_retried_up_to_max_retries(clock):
+    attempts = []
+    async def send(chat_id, payload):
+        attempts.append(chat_id)
+        raise NetworkError("boom")
+    stats, results = run_broadcast(send, [(1, "hi")], max_retries=2)
+    assert len(attempts) == 3
+    assert (stats.sent, stats.failed, stats.retried) == (0, 1, 2)
+    assert isinstance(results[1], NetworkError) and is_retryable(results[1])
+def test_forbidden_fails_without_retry(clock):
+    attempts = []
+    async def send(chat_id, payload):
+        attempts.append(chat_id)
+        raise Forbidden("bot was blocked by the user")
+    stats, results = run_broadcast(send, [(1, "hi")])
+    assert len(attempts) == 1
+    assert stats.failed == 1 and stats.errors["Forbidden"] == 1
+    assert not is_retryable(results[1])
+def test_per_chat_interval_holds_for_concurrent_jobs(clock):
+    sent_at = []
+    async def send(chat_id, payload):
+        sent_at.append((chat_id, clock.now))
+        await asyncio.sleep(0)
+    jobs = [(1, "a"), (1, "b"), (1, "c"), (2, "x")]
+    stats, _ = run_broadcast(send, jobs, per_chat_interval=1.0, concurrency=4)
+    assert stats.sent == 4
+    chat_1 = [at for chat_id, at in sent_at if chat_id == 1]
+    assert all(later - earlier >= 1.0 for earlier, later in zip(chat_1, chat_1[1:]))
+    # Другой чат пауза первого не задерживает
+    assert [at for chat_id, at in sent_at if chat_id == 2] == [1000.0]
+def test_timed_out_is_not_retried(clock):
+    attempts = []
+    async def send(chat_id, payload):
+        attempts.append(chat_id)
+        raise TimedOut()
+    stats, results = run_broadcast(send, [(1, "hi")])
+    # Сообщение могло дойти - повтор прислал бы его второй раз
+    assert len(attempts) == 1 and stats.failed == 1
+    assert not is_retryable(results[1])
+def test_unknown_errors_are_permanent(clock):
+    async def send(chat_id, payload):
+        raise ValueError("broken payload")
+    stats, results = run_broadcast(send, [(1, "hi")])
+    assert stats.failed == 1
+    assert not is_retryable(results[1])
+    assert not is_retryable(BadRequest("chat not found"))
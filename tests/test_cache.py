@@ -0,0 +1,174 @@
+import asyncio
+import pytest
+import cache
+from cache import LRUCache, UserReadThroughCache
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache.time, "monotonic", fake)
+    return fake
+# ==================== LRUCache ====================
+def test_lru_get_set_and_counters():
+    lru = LRUCache(2)
+    assert lru.get("a") is None
+    lru.set("a", 1)
+    assert lru.get("a") == 1
+    assert "a" in lru and "b" not in lru
+    assert (lru.hits, lru.misses) == (1, 1)
+def test_lru_evicts_least_recently_used():
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert "b" not in lru
+    assert lru.get("a") == 1 and lru.get("c") == 3
+    assert len(lru) == 2
+def test_lru_ttl(clock):
+    lru = LRUCache(10, ttl=5)
+    lru.set("a", 1)
+    clock.now += 4.9
+    assert lru.get("a") == 1
+    clock.now += 0.2
+    assert lru.get("a", "gone") == "gone"
+    assert len(lru) == 0
+def test_lru_pop_and_clear():
+    lru = LRUCache(10)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.pop("a") == 1
+    assert lru.pop("a", "missing") == "missing"
+    lru.clear()
+    assert len(lru) == 0
+# ==================== UserReadThroughCache ====================
+def counting_loader(value="v"):
+    calls = []
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return value
+    return load, calls
+def test_read_through_hit_after_miss(clock):
+    rc = UserReadThroughCache(10, ttl=60)
+    load, calls = counting_loader()
+    async def scenario():
+        assert await rc.get_or_load(1, "k", load) == "v"
+        assert await rc.get_or_load(1, "k", load) == "v"
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert (rc.hits, rc.misses) == (1, 1)
+def test_read_through_ttl_expiry(clock):
+    rc = UserReadThroughCache(10, ttl=60)
+    load, calls = counting_loader()
+    async def scenario():
+        await rc.get_or_load(1, "k", load)
+        clock.now += 61
+        await rc.get_or_load(1, "k", load)
+    asyncio.run(scenario())
+    assert len(calls) == 2
+def test_read_through_drops_expired_keys_and_caps_keys_per_user(clock):
+    rc = UserReadThroughCache(10, ttl=60, max_keys=3)
+    load, _ = counting_loader()
+    async def scenario():
+        await rc.get_or_load(1, "old", load)
+        clock.now += 61
+        for key in ("a", "b", "c", "d"):
+            await rc.get_or_load(1, key, load)
+    asyncio.run(scenario())
+    entries = rc._users.get(1)
+    assert list(entries) == ["b", "c", "d"]
+def test_read_through_evicts_users_lru(clock):
+    rc = UserReadThroughCache(2, ttl=60)
+    load, calls = counting_loader()
+    async def scenario():
+        for user_id in (1, 2, 3):
+            await rc.get_or_load(user_id, "k", load)
+        await rc.get_or_load(1, "k", load)
+    asyncio.run(scenario())
+    assert len(calls) == 4
+    assert rc.stats()['users'] == 2
+def test_read_through_invalidate_user(clock):
+    rc = UserReadThroughCache(10, ttl=60)
+    load, calls = counting_loader()
+    async def scenario():
+        await rc.get_or_load(1, "k", load)
+        await rc.get_or_load(2, "k", load)
+        rc.invalidate_user(1)
+        await rc.get_or_load(1, "k", load)
+        await rc.get_or_load(2, "k", load)
+    asyncio.run(scenario())
+    assert len(calls) == 3
+    assert rc.invalidations == 1
+def test_read_through_collapses_concurrent_misses():
+    rc = UserReadThroughCache(10, ttl=60)
+    calls = []
+    async def scenario():
+        release = asyncio.Event()
+        async def load():
+            calls.append(1)
+            await release.wait()
+            return "v"
+        waiters = [asyncio.create_task(rc.get_or_load(1, "k", load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*waiters)
+    assert asyncio.run(scenario()) == ["v"] * 5
+    assert len(calls) == 1
+    assert (rc.misses, rc.collapsed) == (1, 4)
+def test_read_through_error_reaches_all_waiters_and_is_not_cached():
+    rc = UserReadThroughCache(10, ttl=60)
+    calls = []
+    async def scenario():
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0)
+            raise RuntimeError("db down")
+        results = await asyncio.gather(
+            *(rc.get_or_load(1, "k", failing) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        async def ok():
+            return "v"
+        assert await rc.get_or_load(1, "k", ok) == "v"
+    asyncio.run(scenario())
+    assert len(calls) == 1
+def test_read_through_cancelling_first_caller_keeps_load_for_others():
+    rc = UserReadThroughCache(10, ttl=60)
+    async def scenario():
+        release = asyncio.Event()
+        async def load():
+            await release.wait()
+            return "v"
+        first = asyncio.create_task(rc.get_or_load(1, "k", load))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(rc.get_or_load(1, "k", load))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == "v"
+        assert first.cancelled()
+        # Результат загрузки попал в кэш, хотя её начавший вызов отменён
+        assert await rc.get_or_load(1, "k", None) == "v"
+    asyncio.run(scenario())
+def test_read_through_write_during_load_is_not_cached():
+    rc = UserReadThroughCache(10, ttl=60)
+    calls = []
+    async def scenario():
+        release = asyncio.Event()
+        async def load():
+            calls.append(1)
+            await release.wait()
+            return len(calls)
+        pending = asyncio.create_task(rc.get_or_load(1, "k", load))
+        await asyncio.sleep(0)
+        rc.invalidate_user(1)
+        release.set()
+        assert await pending == 1
+        assert await rc.get_or_load(1, "k", load) == 2
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import asyncio
+from datetime import date
+import pytest
+import coffee_prerender
+from coffee_prerender import CoffeePrerender
+from coffee_render import COFFEE_PRICE
+DAY = date(2025, 1, 1)
+class FakeFileIds:
+    """Все картинки уже загружены: предотрисовка ничего не рисует"""
+    async def get(self, key):
+        return f"file:{key}"
+@pytest.fixture
+def prerender(monkeypatch):
+    async def totals(day):
+        return [(1, 3 * COFFEE_PRICE, True), (2, 10 * COFFEE_PRICE, True)]
+    monkeypatch.setattr(coffee_prerender, "get_daily_totals_async", totals)
+    monkeypatch.setattr(coffee_prerender, "coffee_file_ids", FakeFileIds())
+    prerender = CoffeePrerender(storage_chat_id=-100)
+    stats = asyncio.run(prerender.run(bot=None, day=DAY))
+    assert (stats['users'], stats['rendered'], stats['ready']) == (2, 0, 2)
+    return prerender
+def test_get_returns_prerendered_for_same_total(prerender):
+    coffee = prerender.get(1, DAY, 3 * COFFEE_PRICE)
+    assert coffee['cups'] == 3
+    assert "3 чашек" in coffee['caption']
+def test_get_ignores_other_day_and_unknown_user(prerender):
+    assert prerender.get(1, date(2025, 1, 2), 3 * COFFEE_PRICE) is None
+    assert prerender.get(3, DAY, 3 * COFFEE_PRICE) is None
+def test_get_ignores_entry_after_total_changed(prerender):
+    # Трату исправили после предотрисовки: число чашек другое - картинку рисуют заново
+    assert prerender.get(1, DAY, 5 * COFFEE_PRICE) is None
+    assert prerender.get(2, DAY, 0) is None
+    # Правка в пределах той же чашки картинку не меняет
+    assert prerender.get(2, DAY, 10 * COFFEE_PRICE + 1)['cups'] == 10
+def test_user_whose_day_is_not_over_waits_for_catch_up(monkeypatch):
+    over = {3: False}
+    async def totals(day):
+        return [(1, 3 * COFFEE_PRICE, True), (3, 4 * COFFEE_PRICE, over[3])]
+    monkeypatch.setattr(coffee_prerender, "get_daily_totals_async", totals)
+    monkeypatch.setattr(coffee_prerender, "coffee_file_ids", FakeFileIds())
+    prerender = CoffeePrerender(storage_chat_id=-100)
+    stats = asyncio.run(prerender.run(bot=None, day=DAY))
+    assert (stats['ready'], stats['waiting']) == (1, 1)
+    # В 8:30 МСК у пользователя 3 «вчера» ещё идёт - картинки нет, её догонят перед его отчётом
+    assert prerender.get(3, DAY, 4 * COFFEE_PRICE) is None
+    assert not prerender.needs_catch_up(DAY, [1])
+    assert prerender.needs_catch_up(DAY, [1, 3])
+    over[3] = True
+    asyncio.run(prerender.run(bot=None, day=DAY))
+    assert prerender.get(3, DAY, 4 * COFFEE_PRICE)['cups'] == 4
+    assert not prerender.needs_catch_up(DAY, [1, 3])
@@ -0,0 +1,191 @@
+# Тесты с настоящим Postgres: TEST_DATABASE_URL=postgresql://localhost/traty_test pytest tests
+# ⚠️ Миграции накатываются на эту базу, тестовые пользователи удаляются после каждого теста
+import os
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+import pytest
+import database as db
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+USER = 900_000_001
+OTHER = 900_000_002
+@pytest.fixture
+def run(monkeypatch):
+    """Выполняет корутину с открытым пулом тестовой базы"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    monkeypatch.setattr(db, "DATABASE_URL", TEST_DATABASE_URL)
+    from migrations import run_migrations
+    run_migrations()
+    def cleanup():
+        with db.get_db_connection() as conn:
+            conn.execute('DELETE FROM expenses WHERE user_id = ANY(%s)', ([USER, OTHER],))
+            conn.execute('DELETE FROM daily_category_totals WHERE user_id = ANY(%s)', ([USER, OTHER],))
+            conn.execute('DELETE FROM users WHERE user_id = ANY(%s)', ([USER, OTHER],))
+        db.known_users.clear()
+        db.read_cache.clear()
+    async def with_pool(coro_fn):
+        await db.open_pool()
+        try:
+            return await coro_fn()
+        finally:
+            await db.close_pool()
+    cleanup()
+    yield lambda coro_fn: asyncio.run(with_pool(coro_fn))
+    cleanup()
+async def _totals(user_id):
+    async with db.get_pool().connection() as conn:
+        cursor = await conn.execute(
+            'SELECT day, category, total, count FROM daily_category_totals WHERE user_id = %s ORDER BY day, category',
+            (user_id,))
+        return await cursor.fetchall()
+async def _expense_ids(user_id):
+    async with db.get_pool().connection() as conn:
+        cursor = await conn.execute('SELECT id FROM expenses WHERE user_id = %s ORDER BY id', (user_id,))
+        return [row['id'] for row in await cursor.fetchall()]
+# ==================== get_user_operations_page_async ====================
+def _ids(page):
+    return [row['id'] for row in page['operations']]
+def test_operations_page_keyset(run):
+    async def scenario():
+        # Траты другого пользователя вперемешку - в страницы попадать не должны
+        await db.save_expenses_batch_async(
+            [(user, 100 + i, "Транспорт", "2025-01-01") for i in range(25) for user in (USER, OTHER)])
+        ids = await _expense_ids(USER)
+        first = await db.get_user_operations_page_async(USER, 10)
+        assert _ids(first) == ids[:-11:-1]
+        assert (first['has_older'], first['has_newer']) == (True, False)
+        middle = await db.get_user_operations_page_async(USER, 10, before=ids[15])
+        assert _ids(middle) == ids[14:4:-1]
+        assert (middle['has_older'], middle['has_newer']) == (True, True)
+        last = await db.get_user_operations_page_async(USER, 10, before=ids[5])
+        assert _ids(last) == ids[4::-1]
+        assert (last['has_older'], last['has_newer']) == (False, True)
+        # «Новее» с последней страницы возвращает среднюю
+        back = await db.get_user_operations_page_async(USER, 10, after=ids[4])
+        assert _ids(back) == ids[14:4:-1]
+        assert (back['has_older'], back['has_newer']) == (True, True)
+        # Новее осталось не больше страницы - это первая страница
+        for after in (ids[14], ids[20], ids[-1]):
+            page = await db.get_user_operations_page_async(USER, 10, after=after)
+            assert _ids(page) == _ids(first)
+            assert (page['has_older'], page['has_newer']) == (True, False)
+    run(scenario)
+def test_operations_page_exactly_one_page(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100 + i, "Транспорт", "2025-01-01") for i in range(10)])
+        ids = await _expense_ids(USER)
+        page = await db.get_user_operations_page_async(USER, 10)
+        assert _ids(page) == ids[::-1]
+        assert (page['has_older'], page['has_newer']) == (False, False)
+        empty = await db.get_user_operations_page_async(USER, 10, before=ids[0])
+        assert empty['operations'] == [] and not empty['has_older']
+    run(scenario)
+# ==================== update_expense_async и daily_category_totals ====================
+DAY = date(2025, 1, 1)
+async def _assert_totals_match_rebuild(user_id):
+    """Агрегат после инкрементальных правок совпадает с пересчитанным с нуля"""
+    incremental = await _totals(user_id)
+    await db.rebuild_daily_totals_async(user_id)
+    assert incremental == await _totals(user_id)
+    return incremental
+def test_update_expense_moves_amount_to_new_category(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY), (USER, 50, "Транспорт", DAY)])
+        expense_id = (await _expense_ids(USER))[0]
+        updated = await db.update_expense_async(USER, expense_id, 120, "Развлечения")
+        assert (updated['category'], float(updated['amount'])) == ("Развлечения", 120)
+        totals = await _assert_totals_match_rebuild(USER)
+        assert [(row['category'], float(row['total']), row['count']) for row in totals] == [
+            ("Развлечения", 120, 1), ("Транспорт", 50, 1)]
+    run(scenario)
+def test_update_expense_same_category_changes_amount_only(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY), (USER, 50, "Транспорт", DAY)])
+        expense_id = (await _expense_ids(USER))[0]
+        await db.update_expense_async(USER, expense_id, 30, "Транспорт")
+        totals = await _assert_totals_match_rebuild(USER)
+        assert [(row['category'], float(row['total']), row['count']) for row in totals] == [("Транспорт", 80, 2)]
+    run(scenario)
+def test_update_expense_drops_emptied_category(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY), (USER, 50, "Развлечения", DAY)])
+        expense_id = (await _expense_ids(USER))[0]
+        await db.update_expense_async(USER, expense_id, 100, "Развлечения")
+        totals = await _assert_totals_match_rebuild(USER)
+        assert [(row['category'], float(row['total']), row['count']) for row in totals] == [("Развлечения", 150, 2)]
+    run(scenario)
+def test_update_expense_of_another_user_is_ignored(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY), (OTHER, 1, "Транспорт", DAY)])
+        expense_id = (await _expense_ids(USER))[0]
+        assert await db.update_expense_async(OTHER, expense_id, 1, "Развлечения") is None
+        totals = await _assert_totals_match_rebuild(USER)
+        assert [(row['category'], float(row['total'])) for row in totals] == [("Транспорт", 100)]
+    run(scenario)
+# ==================== get_daily_totals_async ====================
+def test_daily_totals_mark_days_not_over_yet(run):
+    async def scenario():
+        future = date.today() + timedelta(days=3)
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY), (USER, 50, "Транспорт", future)])
+        assert (USER, 100.0, True) in await db.get_daily_totals_async(DAY)
+        # По часам пользователя (любой пояс) этот день ещё не закончился
+        assert (USER, 50.0, False) in await db.get_daily_totals_async(future)
+    run(scenario)
+# ==================== read_cache и NOTIFY ====================
+def _notify_elsewhere(sql, params=None):
+    """Запись «другой реплики»: своё соединение, мимо кэша этого процесса"""
+    with db.get_db_connection() as conn:
+        conn.execute(sql, params)
+async def _eventually(check):
+    for _ in range(100):
+        if await check():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+def test_write_by_another_process_invalidates_read_cache(run):
+    async def scenario():
+        await db.save_expenses_batch_async([(USER, 100, "Транспорт", DAY)])
+        await db.start_cache_listener()
+        try:
+            # Слушатель подключился, когда до него дошёл пробный NOTIFY
+            before = db.read_cache.invalidations
+            async def listening():
+                _notify_elsewhere("SELECT pg_notify(%s, %s)", (db.READ_CACHE_CHANNEL, str(OTHER)))
+                await asyncio.sleep(0.05)
+                return db.read_cache.invalidations > before
+            assert await _eventually(listening)
+            assert (await db.get_period_stats_async(USER, DAY, DAY))['total'] == 100
+            _notify_elsewhere(db.SQL_INSERT_EXPENSE, (USER, 50, "Транспорт", DAY))
+            async def fresh():
+                return (await db.get_period_stats_async(USER, DAY, DAY))['total'] == 150
+            assert await _eventually(fresh)
+        finally:
+            await db.stop_cache_listener()
+    run(scenario)
+# ==================== finish_reports_async ====================
+def test_report_is_skipped_after_repeated_failures(run, monkeypatch):
+    monkeypatch.setattr(db, "REPORT_MAX_FAILURES", 3)
+    async def next_report_at():
+        async with db.get_pool().connection() as conn:
+            cursor = await conn.execute(
+                'SELECT next_report_at, report_failures FROM users WHERE user_id = %s', (USER,))
+            return await cursor.fetchone()
+    async def scenario():
+        await db.add_or_update_user_async(USER, "test", "Test")
+        async with db.get_pool().connection() as conn:
+            await conn.execute("UPDATE users SET next_report_at = now() - interval '1 hour' WHERE user_id = %s", (USER,))
+        due = await next_report_at()
+        day = date.today() - timedelta(days=1)
+        for failures in (1, 2):
+            await db.finish_reports_async([], [(USER, day)])
+            assert await next_report_at() == {'next_report_at': due['next_report_at'], 'report_failures': failures}
+        # Третья временная ошибка подряд - отчёт за day пропускается, следующий - завтра
+        await db.finish_reports_async([], [(USER, day)])
+        skipped = await next_report_at()
+        assert skipped['report_failures'] == 0
+        assert skipped['next_report_at'] > datetime.now(timezone.utc)
+        # Успешная отправка тоже обнуляет счётчик
+        await db.finish_reports_async([], [(USER, day)])
+        await db.finish_reports_async([(USER, day)], [])
+        assert (await next_report_at())['report_failures'] == 0
+    run(scenario)
@@ -0,0 +1,51 @@
+# Миграции на «старой» базе: отдельная схема в TEST_DATABASE_URL, удаляется после теста
+import os
+from datetime import date
+import psycopg
+import pytest
+import database as db
+import migrations
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+SCHEMA = "migrations_test"
+@pytest.fixture
+def legacy_db(monkeypatch):
+    """Соединение со схемой, где есть только таблицы первой версии бота (date - VARCHAR)"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        conn.execute(f'CREATE SCHEMA {SCHEMA}')
+    url = TEST_DATABASE_URL + ("&" if "?" in TEST_DATABASE_URL else "?") + f"options=-csearch_path%3D{SCHEMA}"
+    monkeypatch.setattr(db, "DATABASE_URL", url)
+    with db.get_db_connection() as conn:
+        for statement in migrations.MIGRATIONS[0][2]:
+            conn.execute(statement)
+        conn.execute("INSERT INTO users (user_id, username, first_name) VALUES (1, 'old', 'Old')")
+    yield db.get_db_connection
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+def _insert_dates(connect, dates):
+    with connect() as conn:
+        for value in dates:
+            conn.execute("INSERT INTO expenses (user_id, amount, category, date) VALUES (1, 100, 'Транспорт', %s)",
+                         (value,))
+def test_legacy_date_formats_are_converted(legacy_db):
+    _insert_dates(legacy_db, ["2024-01-05", "05.01.2024", " 5.1.2024 ", "05.01.24", "05/01/2024"])
+    assert migrations.run_migrations() == migrations.LATEST_VERSION
+    with legacy_db() as conn:
+        rows = conn.execute('SELECT date FROM expenses').fetchall()
+        totals = conn.execute('SELECT day, total, count FROM daily_category_totals').fetchall()
+    assert {row['date'] for row in rows} == {date(2024, 1, 5)}
+    assert [(row['day'], float(row['total']), row['count']) for row in totals] == [(date(2024, 1, 5), 500, 5)]
+def test_unknown_date_format_is_reported_before_alter(legacy_db):
+    _insert_dates(legacy_db, ["2024-01-05", "вчера"])
+    with pytest.raises(psycopg.errors.RaiseException, match="id=2: 'вчера'"):
+        migrations.run_migrations()
+    with legacy_db() as conn:
+        version = conn.execute('SELECT MAX(version) AS version FROM schema_version').fetchone()['version']
+        column = conn.execute(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = 'expenses' AND column_name = 'date'", (SCHEMA,)).fetchone()
+    # Ничего не сломано наполовину: миграция 2 не применена, колонка всё ещё строковая
+    assert version == 1
+    assert column['data_type'] == 'character varying'
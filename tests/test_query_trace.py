@@ -0,0 +1,17 @@
+from psycopg import sql
+from database import SQL_UPSERT_USER
+from query_trace import _fingerprint
+def test_fingerprint_strips_line_comment_before_joining_lines():
+    fingerprint = _fingerprint(SQL_UPSERT_USER)
+    assert "--" not in fingerprint
+    # Хвост после комментария остаётся в запросе
+    assert fingerprint.endswith("WHERE (users.username, users.first_name) "
+                                "IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name)")
+def test_fingerprint_strips_block_comments():
+    assert _fingerprint("SELECT /* все\nполя */ *\nFROM users /* конец */") == "SELECT * FROM users"
+def test_fingerprint_keeps_comment_markers_inside_literals():
+    query = "SELECT '--не комментарий', \"a/*b\", $$ -- тоже $$ FROM t -- комментарий\nWHERE x = 'it''s'"
+    assert _fingerprint(query) == "SELECT '--не комментарий', \"a/*b\", $$ -- тоже $$ FROM t WHERE x = 'it''s'"
+def test_fingerprint_of_composed_query():
+    query = sql.SQL("SELECT {} -- id\nFROM users").format(sql.Identifier("user_id"))
+    assert _fingerprint(query) == 'SELECT "user_id" FROM users'
@@ -0,0 +1,73 @@
+# text_render.py - отрисовка текста с контуром за один проход и кэш растров текста
+#
+# Растр строки (маска контура + маска заливки) строится один раз и дальше только
+# накладывается через paste. Повторяющиеся куски - дата, «N чашек кофе» - между
+# картинками не растеризуются заново.
+import os
+import threading
+from PIL import Image, ImageDraw
+from cache import LRUCache
+TEXT_MASK_CACHE_SIZE = int(os.environ.get("TEXT_MASK_CACHE_SIZE", 256))
+_masks = LRUCache(TEXT_MASK_CACHE_SIZE)
+# Рендер идёт из потоков пула отрисовки, а LRUCache не потокобезопасен
+_masks_lock = threading.Lock()
+def _font_key(font):
+    return (getattr(font, 'path', None) or id(font), getattr(font, 'size', None))
+def text_mask(text: str, font, stroke_width: int = 0):
+    """
+    Маски строки: (stroke, fill, (left, top), advance, (ink_left, ink_right))
+
+    stroke - заливка вместе с контуром (None без контура), fill - только буквы.
+    Обе одного размера; (left, top) - смещение левого верхнего угла маски
+    относительно точки, в которую рисовал бы draw.text; advance - ширина строки
+    для раскладки соседних кусков; ink_* - края букв без контура.
+    """
+    key = (_font_key(font), text, stroke_width)
+    with _masks_lock:
+        cached = _masks.get(key)
+    if cached is not None:
+        return cached
+    left, top, right, bottom = font.getbbox(text, stroke_width=stroke_width)
+    size = (max(right - left, 1), max(bottom - top, 1))
+    fill = Image.new("L", size)
+    ImageDraw.Draw(fill).text((-left, -top), text, font=font, fill=255)
+    stroke = None
+    if stroke_width:
+        stroke = Image.new("L", size)
+        ImageDraw.Draw(stroke).text((-left, -top), text, font=font, fill=255, stroke_width=stroke_width)
+    ink_left, _, ink_right, _ = font.getbbox(text) if stroke_width else (left, 0, right, 0)
+    entry = (stroke, fill, (left, top), font.getlength(text), (ink_left, ink_right))
+    with _masks_lock:
+        _masks.set(key, entry)
+    return entry
+def line_width(parts, font, stroke_width: int = 0) -> float:
+    """Ширина букв строки из кусков без контура - как textbbox для всей строки"""
+    if isinstance(parts, str):
+        parts = (parts,)
+    entries = [text_mask(part, font, stroke_width) for part in parts]
+    advance = sum(entry[3] for entry in entries[:-1])
+    return advance + entries[-1][4][1] - entries[0][4][0]
+def draw_text(img: Image.Image, xy, parts, font, fill="black", stroke_width: int = 0, stroke_fill="black"):
+    """
+    Рисует строку в точке xy (как draw.text): сначала контур, затем буквы
+
+    parts - строка или несколько кусков подряд. Резать стоит по пробелам, на
+    повторяющиеся фрагменты: каждый кусок кэшируется отдельно.
+    """
+    if isinstance(parts, str):
+        parts = (parts,)
+    x, y = xy
+    for part in parts:
+        stroke, mask, (left, top), advance, _ = text_mask(part, font, stroke_width)
+        box = (round(x) + left, round(y) + top)
+        if stroke is not None:
+            img.paste(stroke_fill, box, stroke)
+        img.paste(fill, box, mask)
+        x += advance
+def draw_text_centered(img: Image.Image, y, parts, font, fill="black", stroke_width: int = 0, stroke_fill="black"):
+    """draw_text по центру картинки по горизонтали"""
+    x = (img.width - line_width(parts, font, stroke_width)) / 2
+    draw_text(img, (x, y), parts, font, fill, stroke_width, stroke_fill)
+def cache_stats() -> dict:
+    with _masks_lock:
+        return {'size': len(_masks), 'hits': _masks.hits, 'misses': _masks.misses}